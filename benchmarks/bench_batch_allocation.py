@@ -0,0 +1,78 @@
+"""
+Benchmark: cost of allocating one more line as a Batch fills up, and as a Product
+collects more batches.
+
+Batch keeps a running allocated quantity, so the cost of Batch.allocate (and of
+Product.allocate on top of it) should stay flat no matter how many lines the batch
+already holds. Product keeps its batches in ETA order, so the cost should not grow
+with the number of open batches either.
+
+Run from the project root:
+
+    PYTHONPATH=src python -m benchmarks.bench_batch_allocation
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import time
+from datetime import date, timedelta
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.domain.model import Batch, OrderLine, Product
+
+# Constants
+# ---------
+
+SKU = "BENCH-SOFA"
+FILL_LEVELS = [0, 10_000, 20_000, 40_000, 80_000]
+BATCH_COUNTS = [1, 10, 100, 500, 1_000]
+SAMPLES = 2_000
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+def make_filled_product(lines: int) -> Product:
+    """Product with one batch that already holds `lines` allocated order lines"""
+    batch = Batch("bench-batch", SKU, qty=lines + SAMPLES, eta=None)
+    for i in range(lines):
+        batch.allocate(OrderLine(f"fill-{i}", SKU, 1))
+    return Product(SKU, batches=[batch])
+
+
+def make_product_with_batches(count: int) -> Product:
+    """Product with `count` open batches, added in reverse ETA order"""
+    product = Product(SKU, batches=[])
+    for i in reversed(range(count)):
+        eta = date.today() + timedelta(days=i)
+        product.add_batch(Batch(f"bench-batch-{i}", SKU, qty=SAMPLES, eta=eta))
+    return product
+
+
+def time_allocations(product: Product) -> float:
+    """Average seconds per Product.allocate call over SAMPLES new lines"""
+    lines = [OrderLine(f"sample-{i}", SKU, 1) for i in range(SAMPLES)]
+    start = time.perf_counter()
+    for line in lines:
+        product.allocate(line)
+    return (time.perf_counter() - start) / SAMPLES
+
+
+def main():
+    print(f"{'allocated lines':>16} | {'us per allocate':>16}")
+    print("-" * 35)
+    for lines in FILL_LEVELS:
+        per_call = time_allocations(make_filled_product(lines))
+        print(f"{lines:>16,} | {per_call * 1e6:>16.2f}")
+    print()
+    print(f"{'open batches':>16} | {'us per allocate':>16}")
+    print("-" * 35)
+    for count in BATCH_COUNTS:
+        per_call = time_allocations(make_product_with_batches(count))
+        print(f"{count:>16,} | {per_call * 1e6:>16.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Benchmark: many threads allocating against one hot SKU.
+
+Every allocation bumps products.version_number, so concurrent units of work on the same
+SKU conflict. SqlAlchemyUnitOfWork turns the lost compare-and-swap into
+ConcurrentUpdateError and services.retry_on_conflict re-runs the allocation. This
+reports throughput, how many retries were needed and how many allocations still failed
+after MAX_ATTEMPTS.
+
+With --coalesce-ms the threads go through an AllocationCoalescer instead, which
+allocates the requests that arrive within that window in one unit of work.
+
+Run from the project root (SQLite file in a temp directory by default):
+
+    PYTHONPATH=src python -m benchmarks.bench_contention --threads 16 --allocations 50
+    PYTHONPATH=src python -m benchmarks.bench_contention --coalesce-ms 5
+    PYTHONPATH=src python -m benchmarks.bench_contention --uri postgresql://...
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import argparse
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.adapters import orm
+from batch_allocations.service_layer import services
+from batch_allocations.service_layer.coalescer import AllocationCoalescer
+from batch_allocations.service_layer.unit_of_work import (
+    ConcurrentUpdateError,
+    SqlAlchemyUnitOfWork,
+)
+
+# Constants
+# ---------
+
+SKU = "HOT-SKU"
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+class RetryCounter(logging.Handler):
+    """Counts the retry messages services.retry_on_conflict logs"""
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        with self._lock:
+            self.retries += 1
+
+
+def run(uri: str, threads: int, allocations: int, coalesce_ms: float = 0):
+    engine = create_engine(uri)
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    session_factory = sessionmaker(bind=engine)
+    services.add_batch(
+        "hot-batch",
+        SKU,
+        threads * allocations,
+        None,
+        SqlAlchemyUnitOfWork(session_factory),
+    )
+
+    counter = RetryCounter()
+    services.logger.addHandler(counter)
+    services.logger.setLevel(logging.DEBUG)
+    failures = []  # type: list
+    coalescer = AllocationCoalescer(
+        lambda: SqlAlchemyUnitOfWork(session_factory),
+        window=coalesce_ms / 1000,
+        max_batch=threads,
+    )
+
+    def allocate(orderid):
+        if coalesce_ms:
+            return coalescer.allocate(orderid, SKU, 1)
+        return services.allocate(orderid, SKU, 1, SqlAlchemyUnitOfWork(session_factory))
+
+    def worker(n):
+        for i in range(allocations):
+            try:
+                allocate(f"order-{n}-{i}")
+            except ConcurrentUpdateError as e:
+                failures.append(e)
+
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    total = threads * allocations
+    print(f"threads:             {threads}")
+    print(f"allocations:         {total}")
+    print(f"elapsed:             {elapsed:.2f}s")
+    print(f"throughput:          {(total - len(failures)) / elapsed:.1f} allocations/s")
+    print(f"retries:             {counter.retries}")
+    print(f"failed after retry:  {len(failures)}")
+    if coalesce_ms:
+        print(f"units of work:       {coalescer.batches}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--uri", help="Database URI (default: SQLite file in a temp dir)"
+    )
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--allocations", type=int, default=50, help="Per thread")
+    parser.add_argument(
+        "--coalesce-ms", type=float, default=0, help="AllocationCoalescer window"
+    )
+    args = parser.parse_args()
+
+    if args.uri:
+        run(args.uri, args.threads, args.allocations, args.coalesce_ms)
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        run(
+            f"sqlite:///{os.path.join(tmp, 'contention.db')}",
+            args.threads,
+            args.allocations,
+            args.coalesce_ms,
+        )
+
+
+if __name__ == "__main__":
+    main()
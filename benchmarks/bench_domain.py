@@ -0,0 +1,280 @@
+"""
+Benchmark suite: the domain model's hot paths, and services.allocate on a unit of work
+that does nothing (NullUnitOfWork), over a grid of batches per SKU, lines already
+allocated per batch and ETA layouts.
+
+Each case reports the best of REPEATS runs, in microseconds per call. Results can be
+saved as a JSON baseline and later runs compared against it: cases slower than the
+baseline by more than --threshold are flagged and the exit status is 1, so it can gate a
+change to the model.
+
+Run from the project root:
+
+    PYTHONPATH=src python -m benchmarks.bench_domain --save baseline.json  # Before
+    PYTHONPATH=src python -m benchmarks.bench_domain --compare baseline.json  # After
+    PYTHONPATH=src python -m benchmarks.bench_domain --quick --filter product_allocate
+
+Timings are only comparable on the same machine, Python and load: take the baseline
+where the comparison will run.
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+from datetime import date, timedelta
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Set
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.adapters.repository import ProductRepositoryProtocol
+from batch_allocations.domain.model import Batch, OrderLine, Product
+from batch_allocations.service_layer import services
+from batch_allocations.service_layer.unit_of_work import UnitOfWorkProtocol
+
+# Constants
+# ---------
+
+SKU = "BENCH-LAMP"
+BATCHES_PER_SKU = [1, 10, 100]
+LINES_PER_BATCH = [0, 100, 1_000]
+ETA_LAYOUTS = ["warehouse", "ascending", "descending", "same_day", "random"]
+CALLS = 2_000  # Per run
+REPEATS = 5
+QUICK = dict(calls=200, repeats=2)
+
+DEFAULT_THRESHOLD = 0.20  # 20% slower than the baseline is a regression
+
+# Helper Functions
+# ----------------
+
+
+def etas(layout: str, count: int) -> List[Optional[date]]:
+    """ETAs for `count` batches, in the order they are added to the product"""
+    today = date.today()
+    if layout == "warehouse":
+        return [None] * count
+    if layout == "ascending":
+        return [today + timedelta(days=i) for i in range(count)]
+    if layout == "descending":
+        return [today + timedelta(days=count - i) for i in range(count)]
+    if layout == "same_day":
+        return [today + timedelta(days=7)] * count
+    rng = random.Random(count)  # "random", the same on every run
+    return [today + timedelta(days=rng.randrange(60)) for _ in range(count)]
+
+
+def make_batch(ref: str, eta: Optional[date], lines: int, spare: int) -> Batch:
+    """A batch that already holds `lines` order lines and has `spare` units left"""
+    batch = Batch(ref, SKU, qty=lines + spare, eta=eta)
+    for i in range(lines):
+        batch.allocate(OrderLine(f"{ref}-fill-{i}", SKU, 1))
+    return batch
+
+
+def make_product(batches: int, lines: int, layout: str, spare: int) -> Product:
+    product = Product(SKU, batches=[])
+    for i, eta in enumerate(etas(layout, batches)):
+        product.add_batch(make_batch(f"batch-{i}", eta, lines, spare))
+    return product
+
+
+def new_lines(calls: int) -> List[OrderLine]:
+    return [OrderLine(f"order-{i}", SKU, 1) for i in range(calls)]
+
+
+class DictRepository(ProductRepositoryProtocol):
+    """Products by SKU in a dict: no storage cost at all"""
+
+    def __init__(self):
+        self.seen: Set[Product] = set()
+        self._products: Dict[str, Product] = {}
+
+    def _add(self, product):
+        self._products[product.sku] = product
+
+    def _get(self, sku):
+        return self._products.get(sku)
+
+
+class NullUnitOfWork(UnitOfWorkProtocol):
+    """A unit of work whose commit and rollback do nothing, to time the service alone"""
+
+    def __init__(self):
+        self.products = DictRepository()
+
+    def __enter__(self):
+        return self
+
+    def _commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+class Case(NamedTuple):
+    """`setup(calls)` builds state and returns the function to time (`calls` calls)"""
+
+    name: str
+    setup: Callable[[int], Callable[[], object]]
+
+
+def product_allocate(batches: int, lines: int, layout: str) -> Case:
+    def setup(calls):
+        product = make_product(batches, lines, layout, spare=calls)
+        order_lines = new_lines(calls)
+        return lambda: [product.allocate(line) for line in order_lines]
+
+    return Case(f"product_allocate[{batches}x{lines},{layout}]", setup)
+
+
+def services_allocate(batches: int, lines: int, layout: str) -> Case:
+    def setup(calls):
+        uow = NullUnitOfWork()
+        uow.products.add(make_product(batches, lines, layout, spare=calls))
+        orderids = [f"order-{i}" for i in range(calls)]
+        return lambda: [services.allocate(o, SKU, 1, uow) for o in orderids]
+
+    return Case(f"services_allocate[{batches}x{lines},{layout}]", setup)
+
+
+def batch_can_allocate(lines: int) -> Case:
+    def setup(calls):
+        batch = make_batch("batch", None, lines, spare=1)
+        order_lines = new_lines(calls)
+        return lambda: [batch.can_allocate(line) for line in order_lines]
+
+    return Case(f"batch_can_allocate[{lines}]", setup)
+
+
+def batch_allocated_quantity(lines: int, loaded: bool) -> Case:
+    """
+    With `loaded` every call starts from an unknown running total, as right after
+    SQLAlchemy (re)loads the batch, so it measures rebuilding it from the allocations.
+    """
+
+    def setup(calls):
+        batch = make_batch("batch", None, lines, spare=1)
+
+        def run():
+            for _ in range(calls):
+                if loaded:
+                    batch._allocated_quantity = None
+                _ = batch.allocated_quantity
+
+        return run
+
+    state = "loaded" if loaded else "cached"
+    return Case(f"batch_allocated_quantity[{lines},{state}]", setup)
+
+
+def cases() -> Iterator[Case]:
+    for lines in LINES_PER_BATCH:
+        yield batch_can_allocate(lines)
+        yield batch_allocated_quantity(lines, loaded=False)
+        yield batch_allocated_quantity(lines, loaded=True)
+    for batches in BATCHES_PER_SKU:
+        for lines in LINES_PER_BATCH:
+            for layout in ETA_LAYOUTS:
+                yield product_allocate(batches, lines, layout)
+    for batches in BATCHES_PER_SKU:
+        for layout in ETA_LAYOUTS:
+            yield services_allocate(batches, 0, layout)
+
+
+def measure(case: Case, calls: int, repeats: int) -> float:
+    """Best seconds per call over `repeats` runs, each on fresh state"""
+    best = float("inf")
+    for _ in range(repeats):
+        run = case.setup(calls)
+        start = time.perf_counter()
+        run()
+        best = min(best, (time.perf_counter() - start) / calls)
+    return best
+
+
+def compare(
+    results: Dict[str, float], baseline: Dict[str, float], threshold: float
+) -> List[str]:
+    """The cases more than `threshold` (a fraction) slower than in the baseline"""
+    return [
+        name
+        for name, seconds in results.items()
+        if name in baseline and seconds > baseline[name] * (1 + threshold)
+    ]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--save", metavar="PATH", help="Write the results as a baseline"
+    )
+    parser.add_argument("--compare", metavar="PATH", help="Baseline to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="Slowdown flagged as a regression, as a fraction (default 0.20)",
+    )
+    parser.add_argument("--filter", default="", help="Only cases containing this")
+    parser.add_argument("--quick", action="store_true", help="Fewer, shorter runs")
+    args = parser.parse_args(argv)
+
+    baseline = {}  # type: Dict[str, float]
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    calls, repeats = (
+        (QUICK["calls"], QUICK["repeats"]) if args.quick else (CALLS, REPEATS)
+    )
+
+    results = {}  # type: Dict[str, float]
+    print(f"{'case':<50} {'us/call':>10} {'baseline':>10} {'change':>8}")
+    for case in cases():
+        if args.filter not in case.name:
+            continue
+        seconds = results[case.name] = measure(case, calls, repeats)
+        row = f"{case.name:<50} {seconds * 1e6:>10.3f}"
+        if case.name in baseline:
+            change = seconds / baseline[case.name] - 1
+            flag = "  <-- slower" if change > args.threshold else ""
+            row += f" {baseline[case.name] * 1e6:>10.3f} {change:>+8.1%}{flag}"
+        print(row)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                dict(
+                    python=platform.python_version(),
+                    machine=platform.platform(),
+                    calls=calls,
+                    repeats=repeats,
+                    results=results,  # Seconds per call
+                ),
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+        print(f"\nsaved {len(results)} results to {args.save}")
+
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} case(s) more than {args.threshold:.0%} slower:")
+        for name in regressions:
+            print(f"  {name}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
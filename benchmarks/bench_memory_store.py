@@ -0,0 +1,170 @@
+"""
+Benchmark: services.allocate on the in-memory product store (adapters/memory_store.py)
+against the same calls on SQLite, and how long the store takes to snapshot and to
+recover.
+
+Each run starts --threads threads allocating --allocations lines each, spread over
+--skus SKUs, on:
+
+    sqlite        SqlAlchemyUnitOfWork on a SQLite file
+    memory        InMemoryUnitOfWork, waiting for the write-ahead log's fsync
+    memory-nosync InMemoryUnitOfWork with fsync=False (a machine crash loses the tail)
+
+Then the store is closed and reopened, once replaying the whole log and once from a
+snapshot.
+
+Run from the project root (files in a temp directory by default):
+
+    PYTHONPATH=src python -m benchmarks.bench_memory_store
+    PYTHONPATH=src python -m benchmarks.bench_memory_store --threads 32 --skus 1
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+from typing import Callable, List, Optional
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.adapters import orm
+from batch_allocations.adapters.memory_store import ProductStore
+from batch_allocations.service_layer import services
+from batch_allocations.service_layer.unit_of_work import (
+    ConcurrentUpdateError,
+    InMemoryUnitOfWork,
+    SqlAlchemyUnitOfWork,
+    UnitOfWorkProtocol,
+)
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+def allocate_concurrently(
+    new_uow: Callable[[], UnitOfWorkProtocol],
+    threads: int,
+    allocations: int,
+    skus: int,
+) -> float:
+    """Stocks the SKUs, runs the threads; returns allocations per second"""
+    names = [f"BENCH-SKU-{n}" for n in range(skus)]
+    for sku in names:
+        services.add_batch(f"batch-{sku}", sku, threads * allocations, None, new_uow())
+    failures = []  # type: list
+
+    def worker(n):
+        for i in range(allocations):
+            try:
+                services.allocate(f"order-{n}-{i}", names[(n + i) % skus], 1, new_uow())
+            except ConcurrentUpdateError as e:
+                failures.append(e)
+
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    print(f"  failed after retry: {len(failures)}")
+    return (threads * allocations - len(failures)) / elapsed
+
+
+def bench_sqlite(directory: str, threads: int, allocations: int, skus: int) -> float:
+    engine = create_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    try:
+        session_factory = sessionmaker(bind=engine)
+        return allocate_concurrently(
+            lambda: SqlAlchemyUnitOfWork(session_factory), threads, allocations, skus
+        )
+    finally:
+        clear_mappers()
+        engine.dispose()
+
+
+def bench_memory(
+    directory: str, threads: int, allocations: int, skus: int, fsync: bool
+) -> float:
+    store = ProductStore(directory, fsync=fsync, snapshot_every=0)
+    try:
+        rate = allocate_concurrently(
+            lambda: InMemoryUnitOfWork(store), threads, allocations, skus
+        )
+        print(
+            f"  {store.wal.records} log records in {store.wal.flushes} writes"
+            f" ({store.wal.records / max(store.wal.flushes, 1):.1f} per fsync)"
+        )
+        return rate
+    finally:
+        store.close()
+
+
+def bench_recovery(directory: str):
+    """Reopens the store the memory run left: log replay, then from a snapshot"""
+    start = time.perf_counter()
+    store = ProductStore(directory, snapshot_every=0)
+    replay = time.perf_counter() - start
+    start = time.perf_counter()
+    store.snapshot()
+    snapshot = time.perf_counter() - start
+    store.close()
+    start = time.perf_counter()
+    ProductStore(directory, snapshot_every=0).close()
+    restore = time.perf_counter() - start
+    print(f"recovery, log replay:   {replay * 1000:.1f} ms")
+    print(f"snapshot:               {snapshot * 1000:.1f} ms")
+    print(f"recovery, snapshot:     {restore * 1000:.1f} ms")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--dir", help="Where the files go (default: a temp dir)")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--allocations", type=int, default=200, help="Per thread")
+    parser.add_argument("--skus", type=int, default=4)
+    parser.add_argument(
+        "--sqlite-allocations",
+        type=int,
+        default=25,
+        help="Per thread on SQLite, which is much slower",
+    )
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        rates = {}
+        print(f"{args.threads} threads, {args.skus} SKUs")
+        print("sqlite")
+        rates["sqlite"] = bench_sqlite(
+            tmp, args.threads, args.sqlite_allocations, args.skus
+        )
+        for name, fsync in (("memory", True), ("memory-nosync", False)):
+            print(name)
+            rates[name] = bench_memory(
+                os.path.join(tmp, name),
+                args.threads,
+                args.allocations,
+                args.skus,
+                fsync,
+            )
+        print()
+        for name, rate in rates.items():
+            print(
+                f"{name:<15} {rate:>10.0f} allocations/s"
+                f"  x{rate / rates['sqlite']:.1f}"
+            )
+        print()
+        bench_recovery(os.path.join(tmp, "memory"))
+
+
+if __name__ == "__main__":
+    main()
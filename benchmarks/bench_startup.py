@@ -0,0 +1,97 @@
+"""
+Benchmark: how long a fresh worker process takes from import to its first response.
+
+Each run is a new Python process that imports the Flask app, calls create_app() and
+sends one request that needs the database (POST /allocate for an unknown SKU, so a unit
+of work is opened). It reports the time spent in each step, which shows what the lazy
+factory defers: import and create_app() should not depend on the database at all.
+
+Run from the project root (SQLite file in a temp directory by default):
+
+    PYTHONPATH=src python -m benchmarks.bench_startup --runs 10
+    PYTHONPATH=src python -m benchmarks.bench_startup --uri postgresql://...
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from sqlalchemy import create_engine
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.adapters import orm
+
+# Constants
+# ---------
+
+# Runs in the worker process; prints the timings as JSON
+WORKER = """
+import json, sys, time
+start = time.perf_counter()
+from batch_allocations.entrypoints.flask_app import create_app
+imported = time.perf_counter()
+app = create_app({"DB_URI": sys.argv[1]})
+created = time.perf_counter()
+client = app.test_client()
+r = client.post("/allocate", json={"orderid": "o1", "sku": "NO-SUCH-SKU", "qty": 1})
+assert r.status_code == 400, r.data
+served = time.perf_counter()
+print(json.dumps(dict(
+    imported=imported - start, created=created - imported,
+    first_request=served - created, total=served - start,
+)))
+"""
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+def run(uri: str, runs: int):
+    orm.metadata.create_all(create_engine(uri))  # The schema is created once, elsewhere
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    timings = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-c", WORKER, uri],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        timings.append(json.loads(result.stdout.splitlines()[-1]))
+
+    print(f"runs: {runs}")
+    print(f"{'step':<15}{'median':>10}{'min':>10}{'max':>10}")
+    for step in ("imported", "created", "first_request", "total"):
+        values = [timing[step] * 1000 for timing in timings]
+        print(
+            f"{step:<15}{statistics.median(values):>8.1f}ms{min(values):>8.1f}ms"
+            f"{max(values):>8.1f}ms"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--uri", help="Database URI (default: SQLite file in a temp dir)"
+    )
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.uri:
+        run(args.uri, args.runs)
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        run(f"sqlite:///{os.path.join(tmp, 'startup.db')}", args.runs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Benchmark: allocation throughput as the SKUs are partitioned across more worker
+processes (service_layer/workers.py), the scaling curve.
+
+For each pool size the front end stocks --skus SKUs and sends --allocations allocations
+spread over them, keeping --in-flight commands outstanding, and reports allocations per
+second, the speedup over one worker and the efficiency (speedup / workers). Expect it to
+flatten at the number of cores, or earlier if the front end (one process pickling every
+command) saturates.
+
+Run from the project root (files in a temp directory by default):
+
+    PYTHONPATH=src python -m benchmarks.bench_workers
+    PYTHONPATH=src python -m benchmarks.bench_workers --workers 1,2,4,8,16
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import argparse
+import os
+import tempfile
+import time
+from collections import deque
+from typing import List, Optional
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.service_layer.workers import AllocationWorkers
+
+# Helper Functions
+# ----------------
+
+
+def pool_sizes() -> List[int]:
+    """1, 2, 4... up to the number of CPUs (included)"""
+    cpus = os.cpu_count() or 1
+    sizes = [1]
+    while sizes[-1] * 2 < cpus:
+        sizes.append(sizes[-1] * 2)
+    return sizes + ([cpus] if cpus > 1 else [])
+
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+def run(
+    directory: str,
+    workers: int,
+    skus: int,
+    allocations: int,
+    in_flight: int,
+    fsync: bool,
+) -> float:
+    """Allocations per second with `workers` processes"""
+    names = [f"BENCH-SKU-{n}" for n in range(skus)]
+    with AllocationWorkers(
+        directory, workers=workers, fsync=fsync, snapshot_every=0
+    ) as pool:
+        stocked = [
+            pool.submit("add_batch", sku, f"batch-{sku}", sku, allocations, None)
+            for sku in names
+        ]
+        for future in stocked:
+            future.result()
+
+        outstanding = deque()  # type: deque
+        start = time.perf_counter()
+        for i in range(allocations):
+            if len(outstanding) >= in_flight:
+                outstanding.popleft().result()
+            sku = names[i % skus]
+            outstanding.append(pool.submit("allocate", sku, f"order-{i}", sku, 1))
+        while outstanding:
+            outstanding.popleft().result()
+        return allocations / (time.perf_counter() - start)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--dir", help="Where the files go (default: a temp dir)")
+    parser.add_argument(
+        "--workers",
+        help="Pool sizes, comma separated (default: powers of 2 up to the CPUs)",
+    )
+    parser.add_argument("--skus", type=int, default=256)
+    parser.add_argument("--allocations", type=int, default=50_000)
+    parser.add_argument("--in-flight", type=int, default=1_000)
+    parser.add_argument("--no-fsync", action="store_true")
+    args = parser.parse_args(argv)
+    sizes = [int(n) for n in args.workers.split(",")] if args.workers else pool_sizes()
+
+    print(f"{os.cpu_count()} CPUs, {args.skus} SKUs, {args.allocations} allocations")
+    print(f"{'workers':>8} {'allocations/s':>14} {'speedup':>8} {'efficiency':>11}")
+    baseline = None
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        for workers in sizes:
+            rate = run(
+                os.path.join(tmp, f"pool-{workers}"),
+                workers,
+                args.skus,
+                args.allocations,
+                args.in_flight,
+                fsync=not args.no_fsync,
+            )
+            baseline = baseline or rate
+            speedup = rate / baseline
+            efficiency = speedup / workers
+            print(f"{workers:>8} {rate:>14.0f} {speedup:>7.2f}x {efficiency:>10.0%}")
+
+
+if __name__ == "__main__":
+    main()
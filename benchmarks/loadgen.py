@@ -0,0 +1,300 @@
+"""
+Load generator: drives /add_batch and /allocate over HTTP and reports throughput,
+latency percentiles, the error breakdown and the out-of-stock rate.
+
+The traffic is either replayed from a JSONL log, one request per line, like:
+
+    {"method": "POST", "path": "/allocate", "body": {"orderid": "o1", "qty": 2, ...}}
+
+or synthetic: batches for --skus random SKUs (test/random_refs.py), then --requests
+allocations spread over them, some for unknown SKUs (--invalid-rate). --record saves it
+in the log format. Lines with "setup": true (like those /add_batch requests) are sent
+first, one at a time, and left out of the report.
+
+Without --url the app is started in this process on a SQLite file in a temp directory,
+or on --db-uri (e.g. a local Postgres). With --rate requests are sent on a fixed
+schedule (open loop) and latency counts from when a request was due, so a slow server
+can't hide its backlog; without it each of the --concurrency workers sends as fast as
+responses come back.
+
+Run from the project root:
+
+    PYTHONPATH=src python -m benchmarks.loadgen --requests 2000 --concurrency 16
+    PYTHONPATH=src python -m benchmarks.loadgen --rate 50 --record t.jsonl --json r.json
+    PYTHONPATH=src python -m benchmarks.loadgen --replay t.jsonl --url http://host:5005
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import requests
+
+# Domain Model Modules
+# --------------------
+from test.random_refs import random_batchref, random_orderid, random_sku
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+class Request(NamedTuple):
+    method: str
+    path: str
+    body: Optional[Dict[str, Any]] = None
+
+
+class Result(NamedTuple):
+    request: Request
+    status: Optional[int]  # None: no response
+    latency: float  # Seconds
+    error: str = ""  # Exception name when there was no response
+    body: Optional[Dict[str, Any]] = None
+
+
+def read_log(path: str) -> Tuple[List[Request], List[Request]]:
+    """(the setup requests, the requests to measure)"""
+    setup, traffic = [], []  # type: Tuple[List[Request], List[Request]]
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                request = Request(record["method"], record["path"], record.get("body"))
+                (setup if record.get("setup") else traffic).append(request)
+    return setup, traffic
+
+
+def write_log(path: str, setup: List[Request], traffic: List[Request]):
+    with open(path, "w") as f:
+        for request in setup:
+            f.write(json.dumps(dict(request._asdict(), setup=True)) + "\n")
+        for request in traffic:
+            f.write(json.dumps(request._asdict()) + "\n")
+
+
+def synthetic(
+    skus: int,
+    batches_per_sku: int,
+    allocations: int,
+    batch_qty: int = 100,
+    max_qty: int = 10,
+    invalid_rate: float = 0.0,
+    seed: Optional[int] = None,
+) -> Tuple[List[Request], List[Request]]:
+    """(the /add_batch requests that stock the SKUs, the /allocate requests)"""
+    rng = random.Random(seed)
+    names = set()  # type: set
+    while len(names) < skus:  # random_sku() draws from a small vocabulary
+        names.add(random_sku())
+    stock = sorted(names)
+
+    setup = [
+        Request(
+            "POST",
+            "/add_batch",
+            dict(ref=random_batchref(n), sku=sku, qty=batch_qty, eta=None),
+        )
+        for sku in stock
+        for n in range(batches_per_sku)
+    ]
+    traffic = []
+    for _ in range(allocations):
+        sku = f"UNKNOWN-{random_orderid()}" if rng.random() < invalid_rate else None
+        body = dict(
+            orderid=random_orderid(),
+            sku=sku or rng.choice(stock),
+            qty=rng.randint(1, max_qty),
+        )
+        traffic.append(Request("POST", "/allocate", body))
+    return setup, traffic
+
+
+def run(
+    base_url: str,
+    traffic: List[Request],
+    concurrency: int = 8,
+    rate: float = 0.0,  # Requests per second, 0: as fast as possible
+    timeout: float = 10.0,
+) -> Tuple[List[Result], float]:
+    """Sends requests from `concurrency` threads; returns the results and the time"""
+    results = [None] * len(traffic)  # type: List[Optional[Result]]
+    position = iter(range(len(traffic)))
+    lock = threading.Lock()
+    start = time.perf_counter()
+
+    def worker():
+        session = requests.Session()
+        while True:
+            with lock:
+                i = next(position, None)
+            if i is None:
+                return
+            request = traffic[i]
+            due = start + i / rate if rate else time.perf_counter()
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                response = session.request(
+                    request.method,
+                    base_url + request.path,
+                    json=request.body,
+                    timeout=timeout,
+                )
+            except requests.RequestException as e:
+                results[i] = Result(
+                    request, None, time.perf_counter() - due, type(e).__name__
+                )
+                continue
+            try:
+                body = response.json()
+            except ValueError:
+                body = None
+            results[i] = Result(
+                request, response.status_code, time.perf_counter() - due, body=body
+            )
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [r for r in results if r is not None], time.perf_counter() - start
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest rank percentile of already sorted values"""
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(fraction * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def summarize(results: List[Result], elapsed: float) -> Dict[str, Any]:
+    latencies = sorted(r.latency for r in results)
+    allocations = [
+        r for r in results if r.request.path == "/allocate" and r.status == 201
+    ]
+    out_of_stock = sum(1 for r in allocations if (r.body or {}).get("batchref") is None)
+    outcomes = Counter(
+        f"{r.request.path} {r.status if r.status is not None else r.error}"
+        for r in results
+    )
+    return dict(
+        requests=len(results),
+        seconds=elapsed,
+        throughput=len(results) / elapsed if elapsed else 0.0,
+        latency_ms={
+            name: percentile(latencies, fraction) * 1000
+            for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))
+        }
+        | dict(max=latencies[-1] * 1000 if latencies else 0.0),
+        outcomes=dict(sorted(outcomes.items())),
+        errors=sum(1 for r in results if r.status is None or r.status >= 400),
+        out_of_stock_rate=out_of_stock / len(allocations) if allocations else 0.0,
+    )
+
+
+def print_report(report: Dict[str, Any]):
+    latency = report["latency_ms"]
+    print(f"requests:      {report['requests']}")
+    print(f"elapsed:       {report['seconds']:.2f}s")
+    print(f"throughput:    {report['throughput']:.1f} requests/s")
+    print(
+        f"latency (ms):  p50 {latency['p50']:.2f}  p95 {latency['p95']:.2f}"
+        f"  p99 {latency['p99']:.2f}  max {latency['max']:.2f}"
+    )
+    print(f"errors:        {report['errors']}")
+    print(f"out of stock:  {report['out_of_stock_rate']:.1%} of allocations")
+    for outcome, count in report["outcomes"].items():
+        print(f"  {outcome:<30} {count}")
+
+
+class LocalApp:
+    """The Flask app served from a background thread, as long as the with block lasts"""
+
+    def __init__(self, db_uri: str):
+        self.db_uri = db_uri
+
+    def __enter__(self) -> str:
+        from werkzeug.serving import make_server
+
+        from batch_allocations.entrypoints.flask_app import create_app
+
+        app = create_app({"DB_URI": self.db_uri, "CREATE_SCHEMA": True})
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)  # One line per request
+        self.server = make_server("127.0.0.1", 0, app, threaded=True)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.thread.join()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--url", help="A running app (default: start one here)")
+    parser.add_argument("--db-uri", help="Database for the app started here")
+    parser.add_argument("--replay", metavar="PATH", help="JSONL request log to replay")
+    parser.add_argument("--record", metavar="PATH", help="Save the synthetic traffic")
+    parser.add_argument("--skus", type=int, default=20)
+    parser.add_argument("--batches-per-sku", type=int, default=3)
+    parser.add_argument("--batch-qty", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=1000, help="Allocations")
+    parser.add_argument("--invalid-rate", type=float, default=0.05)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=0.0, help="Requests per second")
+    parser.add_argument("--json", metavar="PATH", help="Write the report as JSON")
+    args = parser.parse_args(argv)
+
+    if args.replay:
+        setup, traffic = read_log(args.replay)
+    else:
+        setup, traffic = synthetic(
+            args.skus,
+            args.batches_per_sku,
+            args.requests,
+            batch_qty=args.batch_qty,
+            invalid_rate=args.invalid_rate,
+            seed=args.seed,
+        )
+        if args.record:
+            write_log(args.record, setup, traffic)
+
+    def load(base_url: str):
+        # Not measured, and one at a time: batches for a new SKU race to create it
+        failed = [r for r in run(base_url, setup, concurrency=1)[0] if r.status != 201]
+        if failed:
+            raise SystemExit(f"{len(failed)} setup requests failed, first: {failed[0]}")
+        results, elapsed = run(base_url, traffic, args.concurrency, args.rate)
+        report = summarize(results, elapsed)
+        print_report(report)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+
+    if args.url:
+        load(args.url.rstrip("/"))
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        db_uri = args.db_uri or f"sqlite:///{os.path.join(tmp, 'loadgen.db')}"
+        with LocalApp(db_uri) as base_url:
+            load(base_url)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Bulk writes that bypass the domain model, for loading batches by the ten thousand (see
+service_layer/ingest.py). Adding a batch doesn't touch the existing ones, so no Product
+invariant is at stake; bumping the products' version_number still makes every cached or
+concurrently loaded Product notice the new stock.
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import csv
+import io
+from typing import Dict, List, Sequence
+
+from sqlalchemy import update
+from sqlalchemy.dialects.postgresql import insert as postgres_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Connection
+
+# Domain Model Modules
+# --------------------
+from ..adapters.orm import batch_stock, products
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+BATCH_COLUMNS = ("reference", "sku", "_purchased_quantity", "eta")
+
+
+def write_batches(conn: Connection, rows: Sequence[Dict]) -> int:
+    """
+    Inserts batch_stock rows (dicts keyed by BATCH_COLUMNS), creating the products they
+    need, in a handful of statements. Batches whose reference already exists are
+    skipped, so a file can be loaded again after a failure. Returns the number of
+    batches inserted.
+    """
+    skus = sorted({row["sku"] for row in rows})  # Sorted: same lock order everywhere
+    if not skus:
+        return 0
+    _insert_missing_products(conn, skus)
+    if conn.dialect.name == "postgresql":
+        inserted = _copy_batches(conn, rows)
+    else:
+        inserted = _insert_batches(conn, rows)
+    conn.execute(
+        update(products)
+        .where(products.c.sku.in_(skus))
+        .values(version_number=products.c.version_number + 1)
+    )
+    return inserted
+
+
+def _insert_ignore(conn: Connection, table):
+    """INSERT ... ON CONFLICT DO NOTHING, for the two databases the app runs on"""
+    if conn.dialect.name == "postgresql":
+        return postgres_insert(table).on_conflict_do_nothing()
+    return sqlite_insert(table).on_conflict_do_nothing()
+
+
+def _insert_missing_products(conn: Connection, skus: List[str]):
+    conn.execute(
+        _insert_ignore(conn, products),
+        [dict(sku=sku, version_number=0) for sku in skus],
+    )
+
+
+def _insert_batches(conn: Connection, rows: Sequence[Dict]) -> int:
+    # One executemany for the whole chunk
+    return conn.execute(_insert_ignore(conn, batch_stock), list(rows)).rowcount
+
+
+def _copy_batches(conn: Connection, rows: Sequence[Dict]) -> int:
+    """COPY into a temporary table, then move the rows whose reference is new"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(
+            [row["reference"], row["sku"], row["_purchased_quantity"], row["eta"] or ""]
+        )
+    buffer.seek(0)
+
+    columns = ", ".join(BATCH_COLUMNS)
+    cursor = conn.connection.dbapi_connection.cursor()  # type: ignore[union-attr]
+    try:
+        cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS batch_stock_in"
+            " (LIKE batch_stock INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+        )
+        cursor.copy_expert(
+            f"COPY batch_stock_in ({columns}) FROM STDIN WITH (FORMAT csv)", buffer
+        )
+        cursor.execute(
+            f"INSERT INTO batch_stock ({columns}) SELECT {columns} FROM batch_stock_in"
+            " ON CONFLICT (reference) DO NOTHING"
+        )
+        return cursor.rowcount
+    finally:
+        cursor.close()
@@ -0,0 +1,140 @@
+"""
+A process wide cache of Product aggregates, shared by units of work (see
+SqlAlchemyRepository).
+
+Entries are detached products as they were after a unit of work committed them. A
+repository hands out a copy attached to its own session (Session.merge(load=False), no
+queries), so the cached instance itself is never changed and a unit of work that rolls
+back leaves it intact. Before that, a single `SELECT version_number` checks that nobody
+changed the product since; if somebody did, the entry is dropped and the product loaded
+in full.
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+# Domain Model Modules
+# --------------------
+from ..domain.model import Product
+
+# Helper Functions
+# ----------------
+
+
+def weigh(product: Product) -> int:
+    """Rows the product was loaded from, the cache's proxy for the memory it takes"""
+    return 1 + sum(1 + len(batch._allocations) for batch in product.batches)
+
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+class ProductCache:
+    """
+    LRU cache of products by SKU.
+
+    Attributes:
+    ----------
+
+    max_entries : int
+        Products kept at most.
+    max_rows : int
+        Rows (products, batches and allocated order lines, see weigh()) kept at most. A
+        single product heavier than that is not cached.
+    hits, misses, stale, evictions : int
+        Lookups served from the cache, lookups that were not (stale ones included),
+        entries found out of date, and entries dropped to make room.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_rows: int = 100_000):
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.rows = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # type: OrderedDict[str, Product]
+        self._weights = {}  # type: Dict[str, int]
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, sku) -> bool:
+        return sku in self._entries
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:  # One consistent snapshot of the counters
+            return dict(
+                entries=len(self),
+                rows=self.rows,
+                hits=self.hits,
+                misses=self.misses,
+                stale=self.stale,
+                evictions=self.evictions,
+            )
+
+    def get(
+        self, sku: str, current_version: Callable[[], Optional[int]]
+    ) -> Optional[Product]:
+        """
+        The cached product, if it is still at `current_version()` (only called when
+        there is an entry, that's the version check query). Returns a detached instance:
+        merge it.
+        """
+        with self._lock:
+            product = self._entries.get(sku)
+            if product is None:
+                self.misses += 1
+                return None
+        version = current_version()
+        with self._lock:
+            if version != product.version_number:
+                self.stale += 1
+                self.misses += 1
+                self._remove(sku, product)
+                return None
+            if sku in self._entries:
+                self._entries.move_to_end(sku)
+            self.hits += 1
+        return product
+
+    def put(self, product: Product):
+        """Caches a detached product. It must not be changed afterwards."""
+        weight = weigh(product)
+        with self._lock:
+            self._remove(product.sku)
+            if weight > self.max_rows:
+                return
+            self._entries[product.sku] = product
+            self._weights[product.sku] = weight
+            self.rows += weight
+            while len(self._entries) > self.max_entries or self.rows > self.max_rows:
+                sku, _ = self._entries.popitem(last=False)
+                self.rows -= self._weights.pop(sku)
+                self.evictions += 1
+
+    def discard(self, sku: str):
+        with self._lock:
+            self._remove(sku)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._weights.clear()
+            self.rows = 0
+
+    def _remove(self, sku: str, product: Optional[Product] = None):
+        # With `product`, only if the entry is still that product (it may have been
+        # replaced while the version was being checked)
+        current = self._entries.get(sku)
+        if current is None or (product is not None and current is not product):
+            return
+        del self._entries[sku]
+        self.rows -= self._weights.pop(sku)
@@ -0,0 +1,230 @@
+"""
+The process wide SQLAlchemy engine(s).
+
+Engines are created on first use, not at import, so importing the app doesn't need a
+reachable database. There is one engine (and so one connection pool) per database URI,
+shared by the Flask app, the units of work and the background dispatchers. The pool is
+configured from config.get_pool_options() and instrumented by PoolMetrics.
+
+get_async_engine() is the same for the asyncio entry point (entrypoints/asgi_app.py), on
+the async driver for the URI (asyncpg, aiosqlite: see the `async` extra).
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import threading
+import time
+from typing import Any, Dict, Optional, cast
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import QueuePool
+
+# Domain Model Modules
+# --------------------
+from ..config import get_pool_options, get_postgres_uri
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+class PoolMetrics:
+    """
+    Counters fed by the pool events of one engine, plus how long checkouts waited.
+
+    Attributes:
+    ----------
+
+    connects : int
+        New DBAPI connections opened (pool growth, overflow, replacing invalidated ones)
+    checkouts, checkins : int
+        Connections handed out and given back.
+    invalidations, soft_invalidations : int
+        Connections thrown away (e.g. the database went away) or marked for replacement.
+    timeouts : int
+        Checkouts that gave up after pool_timeout.
+    wait_seconds, max_wait_seconds : float
+        Time spent in checkouts (waiting for a free connection, or opening one), in
+        total and the longest. wait_seconds / checkouts is the average.
+    """
+
+    COUNTERS = (
+        "connects",
+        "checkouts",
+        "checkins",
+        "invalidations",
+        "soft_invalidations",
+        "timeouts",
+    )
+
+    def __init__(self):
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def _count(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def record_wait(self, seconds: float):
+        with self._lock:
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def attach(self, engine: Engine):
+        """Listens to the engine pool events (kept when the pool is recreated)"""
+        events = dict(
+            connect="connects",
+            checkout="checkouts",
+            checkin="checkins",
+            invalidate="invalidations",
+            soft_invalidate="soft_invalidations",
+        )
+        for event_name, counter in events.items():
+            event.listen(
+                engine, event_name, lambda *args, counter=counter: self._count(counter)
+            )
+        if isinstance(engine.pool, TimedQueuePool):
+            engine.pool.metrics = self
+
+    def snapshot(self, engine: Optional[Engine] = None) -> Dict[str, Any]:
+        """The counters, and the pool's current state if `engine` is given"""
+        with self._lock:
+            stats = {name: getattr(self, name) for name in self.COUNTERS}
+            stats.update(
+                wait_seconds=self.wait_seconds, max_wait_seconds=self.max_wait_seconds
+            )
+        if engine is not None and isinstance(engine.pool, QueuePool):
+            pool = engine.pool
+            stats.update(
+                size=pool.size(),
+                checked_out=pool.checkedout(),
+                checked_in=pool.checkedin(),
+                overflow=max(pool.overflow(), 0),  # Negative while the pool fills up
+            )
+        return stats
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool that reports how long each checkout took to its PoolMetrics"""
+
+    metrics = None  # type: Optional[PoolMetrics]
+
+    def connect(self):
+        if self.metrics is None:
+            return super().connect()
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        except PoolTimeout:
+            self.metrics._count("timeouts")
+            raise
+        finally:
+            self.metrics.record_wait(time.perf_counter() - started)
+
+    def recreate(self) -> QueuePool:
+        pool = cast(TimedQueuePool, super().recreate())  # engine.dispose()
+        pool.metrics = self.metrics
+        return pool
+
+
+_engines = {}  # type: Dict[str, Engine]
+_metrics = {}  # type: Dict[str, PoolMetrics]
+_async_engines = {}  # type: Dict[str, AsyncEngine]
+_lock = threading.Lock()
+
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+}
+
+
+def engine_options(uri: str, isolation_level: Optional[str] = None) -> Dict:
+    """create_engine() options for `uri`. Postgres defaults to REPEATABLE READ"""
+    if uri.startswith("postgresql"):
+        return dict(isolation_level=isolation_level or "REPEATABLE READ")
+    if uri.startswith("sqlite"):
+        return dict(isolation_level="SERIALIZABLE")
+    return {}
+
+
+def get_engine(uri: Optional[str] = None) -> Engine:
+    """The shared engine for `uri` (the app database by default), made on first call"""
+    if uri is None:
+        uri = get_postgres_uri()
+    engine = _engines.get(uri)
+    if engine is None:
+        with _lock:
+            engine = _engines.get(uri)
+            if engine is None:
+                engine = _engines[uri] = _create(uri)
+    return engine
+
+
+def get_pool_metrics(uri: Optional[str] = None) -> PoolMetrics:
+    """The PoolMetrics of the shared engine for `uri`"""
+    get_engine(uri)
+    return _metrics[uri or get_postgres_uri()]
+
+
+def _create(uri: str) -> Engine:
+    options = engine_options(uri)
+    if ":memory:" not in uri and uri != "sqlite://":
+        # In-memory SQLite has a single connection per thread: nothing to pool
+        options.update(get_pool_options(), poolclass=TimedQueuePool)
+    engine = create_engine(uri, **options)
+    _metrics[uri] = PoolMetrics()
+    _metrics[uri].attach(engine)
+    return engine
+
+
+def async_uri(uri: str) -> str:
+    """`uri` on its asyncio driver, e.g. postgresql://... -> postgresql+asyncpg://..."""
+    scheme, sep, rest = uri.partition("://")
+    return ASYNC_DRIVERS.get(scheme, scheme) + sep + rest
+
+
+def get_async_engine(uri: Optional[str] = None) -> AsyncEngine:
+    """
+    The shared AsyncEngine for `uri` (a sync URI, the app's database by default). It has
+    a pool of its own, configured like the sync one.
+    """
+    if uri is None:
+        uri = get_postgres_uri()
+    engine = _async_engines.get(uri)
+    if engine is None:
+        with _lock:
+            engine = _async_engines.get(uri)
+            if engine is None:
+                options = engine_options(uri)
+                if ":memory:" not in uri and uri != "sqlite://":
+                    options.update(get_pool_options())
+                engine = create_async_engine(async_uri(uri), **options)
+                _async_engines[uri] = engine
+    return engine
+
+
+async def dispose_async_engines():
+    """Closes the async engines' connections (from the event loop that used them)"""
+    with _lock:
+        engines = list(_async_engines.values())
+        _async_engines.clear()
+    for engine in engines:
+        await engine.dispose()
+
+
+def dispose_engines():
+    """Closes every pooled connection, e.g. in a worker process right after a fork"""
+    with _lock:
+        engines = list(_engines.values())
+        _engines.clear()
+        _metrics.clear()
+    for engine in engines:
+        engine.dispose()
@@ -0,0 +1,74 @@
+"""
+Consistent hashing of SKUs onto named nodes (worker processes, database shards).
+
+Each node is placed at `replicas` points on a ring of 64 bit hashes, and a SKU belongs
+to the first node point at or after its own hash. Adding or removing a node only moves
+the SKUs between it and its neighbours, about 1/N of them, instead of nearly all as with
+hash % N.
+
+The hash is BLAKE2b, not hash(): it must be the same in every process and on every run.
+"""
+
+# Boilerplate Modules
+# -------------------
+
+from bisect import bisect_left
+from collections import Counter
+from hashlib import blake2b
+from typing import Dict, Iterable, List, Sequence
+
+# Constants
+# ---------
+
+DEFAULT_REPLICAS = 128  # Points per node: the more, the more even the split
+
+# Helper Functions
+# ----------------
+
+
+def stable_hash(key: str) -> int:
+    return int.from_bytes(blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+class HashRing:
+    """
+    Attributes:
+    ----------
+
+    nodes : Sequence[str]
+        Node names. The ring only depends on the names, not on their order.
+    replicas : int
+        Points per node.
+    """
+
+    def __init__(self, nodes: Iterable[str], replicas: int = DEFAULT_REPLICAS):
+        self.nodes = tuple(nodes)
+        if not self.nodes:
+            raise ValueError("A hash ring needs at least one node")
+        if len(set(self.nodes)) != len(self.nodes):
+            raise ValueError(f"Duplicate node names: {self.nodes}")
+        self.replicas = replicas
+        points = sorted(
+            (stable_hash(f"{node}#{replica}"), node)
+            for node in self.nodes
+            for replica in range(replicas)
+        )
+        self._hashes = [h for h, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node_for(self, key: str) -> str:
+        i = bisect_left(self._hashes, stable_hash(key))
+        return self._owners[i % len(self._owners)]
+
+    def spread(self, keys: Iterable[str]) -> Dict[str, int]:
+        """How many of the keys each node gets"""
+        counts = Counter(self.node_for(key) for key in keys)
+        return {node: counts[node] for node in self.nodes}
+
+    def moved(self, other: "HashRing", keys: Sequence[str]) -> List[str]:
+        """The keys that belong to a different node on the other ring"""
+        return [key for key in keys if self.node_for(key) != other.node_for(key)]
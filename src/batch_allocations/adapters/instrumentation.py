@@ -0,0 +1,168 @@
+"""
+Where a unit of work's time goes: statements, time in the database, objects loaded, time
+in the domain (Product.allocate), commit and event dispatch.
+
+Figures go to the QueryStats that is current in the context (a contextvar, so each
+thread and each asyncio task has its own). SqlAlchemyUnitOfWork makes one current for
+itself while it is open; the Flask app makes one per request, which then adds up the
+request's units of work (including retries) and is reported in the response headers.
+
+The SQLAlchemy listeners are installed on every Engine and mapper when this module is
+imported, and do nothing when no QueryStats is current.
+
+In tests, query_budget() fails when a block issues more statements than expected:
+
+    with query_budget(statements=4):
+        services.allocate("o1", "LAMP", 1, uow)
+"""
+
+# Boilerplate Modules
+# -------------------
+
+from __future__ import annotations
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from typing import Dict, Iterator, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Mapper
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+class QueryStats:
+    """
+    Attributes:
+    ----------
+
+    statements : int
+        SQL statements executed (executemany counts once).
+    db_seconds : float
+        Time spent executing them, driver and round trip included.
+    rows : int
+        Objects the ORM loaded (a product, each batch, each order line), cache hits too.
+    allocate_seconds, commit_seconds, dispatch_seconds : float
+        Time in the domain allocating, in SqlAlchemyUnitOfWork.commit() flushing and
+        committing, and publishing the events.
+
+    Notes:
+    ------
+
+    Used as a context manager it becomes the current one; on exit the previous one is
+    restored and gets these figures added to its own.
+    """
+
+    COUNTERS = ("statements", "rows")
+    TIMERS = ("db_seconds", "allocate_seconds", "commit_seconds", "dispatch_seconds")
+
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+        self.db_seconds = 0.0
+        self.allocate_seconds = 0.0
+        self.commit_seconds = 0.0
+        self.dispatch_seconds = 0.0
+        self._outer = None  # type: Optional[QueryStats]
+        self._token: Optional[Token] = None
+
+    def __enter__(self) -> QueryStats:
+        self._outer = _current.get()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._token is not None:
+            _current.reset(self._token)
+            self._token = None
+        if self._outer is not None:
+            self._outer.add(self)
+
+    def add(self, other: QueryStats):
+        for name in self.COUNTERS + self.TIMERS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def as_dict(self) -> Dict[str, float]:
+        return {name: getattr(self, name) for name in self.COUNTERS + self.TIMERS}
+
+    def server_timing(self) -> str:
+        """A Server-Timing header value (milliseconds, shown by the browser devtools)"""
+        return ", ".join(
+            f'{name[: -len("_seconds")]};dur={getattr(self, name) * 1000:.3f}'
+            + (f';desc="{self.statements} statements"' if name == "db_seconds" else "")
+            for name in self.TIMERS
+        )
+
+
+_current = ContextVar(
+    "query_stats", default=None
+)  # type: ContextVar[Optional[QueryStats]]
+
+
+def current() -> Optional[QueryStats]:
+    return _current.get()
+
+
+@contextmanager
+def timed(name: str) -> Iterator[None]:
+    """Adds the time the block takes to the current QueryStats' `name` timer"""
+    stats = _current.get()
+    if stats is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        setattr(stats, name, getattr(stats, name) + time.perf_counter() - started)
+
+
+class QueryBudgetExceededError(AssertionError):
+    pass
+
+
+@contextmanager
+def query_budget(statements: int) -> Iterator[QueryStats]:
+    """Raises QueryBudgetExceededError if the block issues over `statements` queries"""
+    with QueryStats() as stats:
+        yield stats
+    if stats.statements > statements:
+        raise QueryBudgetExceededError(
+            f"{stats.statements} statements, budget was {statements}"
+        )
+
+
+# SQLAlchemy listeners
+# --------------------
+
+
+# The start time goes on the statement's execution context, which is dropped with it:
+# a statement that raises never gets after_cursor_execute
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None and context is not None:
+        context.query_stats_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    started = getattr(context, "query_stats_started", None)
+    if stats is None or started is None:
+        return
+    stats.statements += 1
+    stats.db_seconds += time.perf_counter() - started
+
+
+def _count_loaded(target, context):
+    stats = _current.get()
+    if stats is not None:
+        stats.rows += 1
+
+
+event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+event.listen(Mapper, "load", _count_loaded)
@@ -0,0 +1,641 @@
+"""
+Products kept in memory as the source of truth, made durable by a write-ahead log.
+
+ProductStore holds every Product aggregate. A unit of work
+(unit_of_work.InMemoryUnitOfWork) locks the products it touches and the domain changes
+them in place; their collections are journaled (JournaledBatches, JournaledAllocations),
+so the store knows what changed. Commit appends those changes to the log as one record
+and waits until it is on disk; rollback undoes them from the same journal.
+
+The log is group committed: a writer thread writes every record appended since its last
+fsync and fsyncs once, so concurrent commits share the cost of the fsync. Every
+`snapshot_every` commits the products are written to a snapshot and the log segments it
+covers are deleted. Opening the store loads the latest snapshot and replays the log
+segments after it.
+
+Files in `directory`:
+
+    snapshot-<n>.json  Every product, covering the log segments before n
+    wal-<n>.log        JSON lines: {"sku", "version", "ops"}, one per committed change
+
+Notes:
+------
+
+Replay is idempotent: a record is skipped if the product's version is already at or past
+the record's. That is what lets a snapshot be taken while commits go on, one product at
+a time.
+
+Only one process may open a directory. There is no database, so the SKU index, product
+cache and outbox don't apply.
+"""
+
+# Boilerplate Modules
+# -------------------
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import zlib
+from datetime import date
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, Type
+
+# Domain Model Modules
+# --------------------
+from ..domain.model import Batch, OrderLine, Product
+
+# Constants
+# ---------
+
+logger = logging.getLogger(__name__)
+
+LOCK_STRIPES = (
+    1024  # Products are locked through a fixed set of locks, by hash of the SKU
+)
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+class Journal:
+    """
+    Where a product's journaled collections record their changes. `ops` is the list of
+    the unit of work that has the product checked out, None otherwise (changing it then
+    is a bug).
+    """
+
+    def __init__(self):
+        self.ops = None  # type: Optional[List[Tuple]]
+
+    def record(self, op: Tuple):
+        if self.ops is None:
+            raise RuntimeError("Product changed outside of a unit of work")
+        self.ops.append(op)
+
+
+class JournaledAllocations(set):
+    """Batch._allocations that records the order lines allocated and deallocated"""
+
+    def __init__(self, lines, journal: Journal, batchref: str):
+        super().__init__(lines)
+        self.journal = journal
+        self.batchref = batchref
+
+    def add(self, line: OrderLine):
+        if line not in self:
+            self.journal.record(("allocate", self.batchref, line.orderid, line.qty))
+            super().add(line)
+
+    def remove(self, line: OrderLine):
+        super().remove(line)
+        self.journal.record(("deallocate", self.batchref, line.orderid, line.qty))
+
+    def discard(self, line):
+        if line in self:
+            self.remove(line)
+
+
+class JournaledBatches(list):
+    """Product.batches that records the batches added"""
+
+    def __init__(self, batches, journal: Journal):
+        super().__init__(batches)
+        self.journal = journal
+        for batch in self:
+            journal_allocations(batch, journal)
+
+    def append(self, batch: Batch):
+        eta = None if batch.eta is None else batch.eta.isoformat()
+        self.journal.record(
+            ("add_batch", batch.reference, batch._purchased_quantity, eta)
+        )
+        journal_allocations(batch, self.journal)
+        super().append(batch)
+
+
+def _replace_collection(obj, name: str, collection):
+    # Straight into __dict__: once the orm mappers are started (the Flask app starts
+    # them) assigning the attribute would copy the collection into one of SQLAlchemy's
+    obj.__dict__[name] = collection
+
+
+def journal_allocations(batch: Batch, journal: Journal):
+    if not isinstance(batch._allocations, JournaledAllocations):
+        _replace_collection(
+            batch,
+            "_allocations",
+            JournaledAllocations(batch._allocations, journal, batch.reference),
+        )
+
+
+def journaled(product: Product) -> Product:
+    """Gives the product journaled collections sharing one Journal (batches.journal)"""
+    if not isinstance(product.batches, JournaledBatches):
+        _replace_collection(
+            product, "batches", JournaledBatches(product.batches, Journal())
+        )
+    return product
+
+
+def journal_of(product: Product) -> Journal:
+    return product.batches.journal  # type: ignore[attr-defined]
+
+
+def _find_batch(product: Product, batchref: str) -> Batch:
+    return next(b for b in product.batches if b.reference == batchref)
+
+
+def apply(product: Product, op: Tuple):
+    """Redoes a journaled change, without journaling it again"""
+    kind = op[0]
+    if kind == "add_batch":
+        _, ref, qty, eta = op
+        batch = Batch(
+            ref, product.sku, qty, None if eta is None else date.fromisoformat(eta)
+        )
+        journal_allocations(batch, journal_of(product))
+        list.append(product.batches, batch)
+    elif kind == "allocate":
+        _, ref, orderid, qty = op
+        batch = _find_batch(product, ref)
+        set.add(batch._allocations, OrderLine(orderid, product.sku, qty))
+        batch._allocated_quantity = None
+    elif kind == "deallocate":
+        _, ref, orderid, qty = op
+        batch = _find_batch(product, ref)
+        set.discard(batch._allocations, OrderLine(orderid, product.sku, qty))
+        batch._allocated_quantity = None
+    product._batch_index = None
+
+
+def undo(product: Product, op: Tuple):
+    """Reverts a journaled change, without journaling it"""
+    kind = op[0]
+    if kind == "add_batch":
+        list.remove(product.batches, _find_batch(product, op[1]))
+    elif kind == "allocate":
+        apply(product, ("deallocate",) + tuple(op[1:]))
+    elif kind == "deallocate":
+        apply(product, ("allocate",) + tuple(op[1:]))
+    product._batch_index = None
+
+
+def to_json(product: Product) -> Dict[str, Any]:
+    return dict(
+        sku=product.sku,
+        version=product.version_number,
+        batches=[
+            dict(
+                ref=batch.reference,
+                qty=batch._purchased_quantity,
+                eta=None if batch.eta is None else batch.eta.isoformat(),
+                allocations=sorted(
+                    [line.orderid, line.qty] for line in batch._allocations
+                ),
+            )
+            for batch in product.batches
+        ],
+    )
+
+
+def from_json(record: Dict[str, Any]) -> Product:
+    sku = record["sku"]
+    batches = []
+    for b in record["batches"]:
+        eta = None if b["eta"] is None else date.fromisoformat(b["eta"])
+        batch = Batch(b["ref"], sku, b["qty"], eta)
+        batch._allocations = {OrderLine(o, sku, qty) for o, qty in b["allocations"]}
+        batch._allocated_quantity = None
+        batches.append(batch)
+    return journaled(Product(sku, batches, version_number=record["version"]))
+
+
+class WriteAheadLog:
+    """
+    Appends records to the current segment from a writer thread, one write and one fsync
+    for all the records waiting (group commit). append() returns a sequence number, and
+    wait(seq) blocks until that record is durable.
+
+    Attributes:
+    ----------
+
+    records, flushes : int
+        Records written, and the writes (fsyncs) they took.
+    """
+
+    def __init__(self, directory: str, segment: int, fsync: bool = True):
+        self.directory = directory
+        self.segment = segment
+        self.fsync = fsync
+        self.records = 0
+        self.flushes = 0
+        self._file = open(segment_path(directory, segment), "ab")
+        self._pending = []  # type: List[bytes]
+        self._appended = 0
+        self._durable = 0
+        self._rotate_to = None  # type: Optional[int]
+        self._error = None  # type: Optional[BaseException]
+        self._closed = False
+        self._cond = threading.Condition()
+        self._writer = threading.Thread(target=self._write, name="wal", daemon=True)
+        self._writer.start()
+
+    def append(self, record: Dict[str, Any]) -> int:
+        line = json.dumps(record, separators=(",", ":")).encode() + b"\n"
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Write-ahead log is closed")
+            if self._error is not None:  # The store no longer matches the disk
+                raise OSError("Write-ahead log failed") from self._error
+            self._pending.append(line)
+            self._appended += 1
+            self._cond.notify_all()
+            return self._appended
+
+    def wait(self, seq: int):
+        with self._cond:
+            while self._durable < seq and self._error is None:
+                self._cond.wait()
+            if self._durable < seq:
+                raise OSError("Write-ahead log failed") from self._error
+
+    def rotate(self) -> int:
+        """Starts a new segment for the records not written yet; returns its number"""
+        with self._cond:
+            self._rotate_to = self.segment + 1
+            self._cond.notify_all()
+            while self._rotate_to is not None and self._error is None:
+                self._cond.wait()
+            return self.segment
+
+    def _write(self):
+        while True:
+            with self._cond:
+                while not (self._pending or self._rotate_to or self._closed):
+                    self._cond.wait()
+                if self._rotate_to is not None:
+                    self._file.close()
+                    self.segment = self._rotate_to
+                    self._file = open(segment_path(self.directory, self.segment), "ab")
+                    self._rotate_to = None
+                    self._cond.notify_all()
+                if not self._pending and self._closed:
+                    return
+                lines, self._pending = self._pending, []
+                upto = self._appended
+            try:
+                self._file.write(b"".join(lines))
+                self._file.flush()
+                if self.fsync:
+                    os.fsync(self._file.fileno())
+            except BaseException as e:
+                logger.exception("write-ahead log failed")
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self.records += len(lines)
+                self.flushes += 1
+                self._durable = upto
+                self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._writer.join()
+        self._file.close()
+
+
+def segment_path(directory: str, segment: int) -> str:
+    return os.path.join(directory, f"wal-{segment:08d}.log")
+
+
+def snapshot_path(directory: str, segment: int) -> str:
+    return os.path.join(directory, f"snapshot-{segment:08d}.json")
+
+
+def _numbered(directory: str, prefix: str, suffix: str) -> List[int]:
+    """The n of the files named <prefix>-<n><suffix>, in order"""
+    numbers = []
+    for name in os.listdir(directory):
+        if name.startswith(prefix + "-") and name.endswith(suffix):
+            stem = name[len(prefix) + 1 : -len(suffix)]
+            if stem.isdigit():
+                numbers.append(int(stem))
+    return sorted(numbers)
+
+
+def read_segment(path: str) -> Iterator[Dict[str, Any]]:
+    """The records of a log segment. A last line cut short by a crash is ignored."""
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                logger.warning("ignoring incomplete record at the end of %s", path)
+                return
+            yield json.loads(line)
+
+
+class ProductStore:
+    """
+    Attributes:
+    ----------
+
+    directory : str
+        Where the snapshots and log segments live. Recovered from when the store is
+        created.
+    fsync : bool
+        Wait for the disk on commit. Without it a crash of the machine (not just the
+        process) can lose the last commits.
+    snapshot_every : int
+        Commits between snapshots (taken by a background thread). 0: only snapshot().
+    lock_timeout : float
+        Seconds a unit of work waits for a product another one has checked out before
+        giving up with ConcurrentUpdateError (which services retry). Also what breaks a
+        deadlock between two units of work taking the same products in another order.
+    commits, snapshots : int
+        Units of work that logged changes, and snapshots taken, since the store was
+        opened.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        fsync: bool = True,
+        snapshot_every: int = 100_000,
+        lock_timeout: float = 1.0,
+    ):
+        self.directory = directory
+        self.fsync = fsync
+        self.snapshot_every = snapshot_every
+        self.lock_timeout = lock_timeout
+        self.commits = 0
+        self.snapshots = 0
+        self._products = {}  # type: Dict[str, Product]
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._snapshot_lock = threading.Lock()
+        self._count_lock = threading.Lock()
+        self._snapshot_due = threading.Event()
+        self._closed = False
+        os.makedirs(directory, exist_ok=True)
+        segment = self._recover()
+        self.wal = WriteAheadLog(directory, segment, fsync=fsync)
+        self._since_snapshot = 0
+        self._snapshotter = None  # type: Optional[threading.Thread]
+        if snapshot_every:
+            self._snapshotter = threading.Thread(
+                target=self._snapshot_when_due, name="snapshots", daemon=True
+            )
+            self._snapshotter.start()
+
+    def __len__(self) -> int:
+        return len(self._products)
+
+    # Units of work
+    # -------------
+
+    def lock_for(self, sku: str) -> threading.Lock:
+        return self._locks[zlib.crc32(sku.encode()) % LOCK_STRIPES]
+
+    def get(self, sku: str) -> Optional[Product]:
+        """The live product. The caller must hold lock_for(sku)."""
+        return self._products.get(sku)
+
+    def add(self, product: Product):
+        """Makes a new product visible. The caller must hold lock_for(product.sku)."""
+        if product.sku in self._products:
+            raise ValueError(f"Product {product.sku} already exists")
+        self._products[product.sku] = journaled(product)
+
+    def remove(self, sku: str):
+        self._products.pop(sku, None)
+
+    def log(self, records: List[Dict[str, Any]]) -> int:
+        """Appends the records to the log; returns what to wait() on"""
+        if not records:
+            return 0
+        seq = 0
+        for record in records:
+            seq = self.wal.append(record)
+        with self._count_lock:
+            self.commits += 1
+            self._since_snapshot += 1
+            due = (
+                bool(self.snapshot_every)
+                and self._since_snapshot >= self.snapshot_every
+            )
+            if due:
+                self._since_snapshot = 0
+        if due:
+            self._snapshot_due.set()
+        return seq
+
+    def wait(self, seq: int):
+        """Returns once the records logged up to `seq` are durable"""
+        if seq:
+            self.wal.wait(seq)
+
+    # Snapshots and recovery
+    # ----------------------
+
+    def snapshot(self) -> str:
+        """
+        Writes every product to a new snapshot and deletes the log segments it covers.
+        Commits carry on meanwhile; each product is copied while no unit of work has it.
+        """
+        with self._snapshot_lock:
+            segment = (
+                self.wal.rotate()
+            )  # Earlier segments only hold changes copied below
+            path = snapshot_path(self.directory, segment)
+            with open(path + ".tmp", "w") as f:
+                f.write("[\n")
+                written = 0
+                for sku in list(self._products):
+                    with self.lock_for(sku):
+                        product = self._products.get(
+                            sku
+                        )  # Unless its creation rolled back
+                        if product is None:
+                            continue
+                        line = json.dumps(to_json(product), separators=(",", ":"))
+                    f.write(("," if written else "") + line + "\n")
+                    written += 1
+                f.write("]\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + ".tmp", path)
+            self._fsync_directory()
+            for old in _numbered(self.directory, "snapshot", ".json"):
+                if old < segment:
+                    os.remove(snapshot_path(self.directory, old))
+            for old in _numbered(self.directory, "wal", ".log"):
+                if old < segment:
+                    os.remove(segment_path(self.directory, old))
+            self.snapshots += 1
+            return path
+
+    def _snapshot_when_due(self):
+        while True:
+            self._snapshot_due.wait()
+            self._snapshot_due.clear()
+            if self._closed:
+                return
+            try:
+                self.snapshot()
+            except Exception:
+                logger.exception("snapshot failed")
+
+    def _recover(self) -> int:
+        """Loads the latest snapshot and replays the log; returns the next segment"""
+        snapshots = _numbered(self.directory, "snapshot", ".json")
+        start = snapshots[-1] if snapshots else 0
+        if snapshots:
+            with open(snapshot_path(self.directory, start)) as f:
+                for record in json.load(f):
+                    product = from_json(record)
+                    self._products[product.sku] = product
+        segments = [n for n in _numbered(self.directory, "wal", ".log") if n >= start]
+        replayed = 0
+        for segment in segments:
+            for record in read_segment(segment_path(self.directory, segment)):
+                replayed += self._replay(record)
+        if replayed:
+            logger.info("replayed %d log records", replayed)
+        # A fresh segment: the last one may end with a torn record
+        return max(segments + [start]) + 1
+
+    def _replay(self, record: Dict[str, Any]) -> int:
+        sku = record["sku"]
+        product = self._products.get(sku)
+        if product is None:
+            if record["ops"][0][0] != "create":
+                raise ValueError(f"Log record for unknown product {sku}")
+            product = self._products[sku] = journaled(Product(sku, batches=[]))
+        elif product.version_number >= record["version"]:
+            return 0  # Already in the snapshot
+        for op in record["ops"]:
+            if op[0] != "create":
+                apply(product, tuple(op))
+        product.version_number = record["version"]
+        return 1
+
+    def _fsync_directory(self):
+        if not self.fsync or not hasattr(os, "O_DIRECTORY"):
+            return
+        fd = os.open(self.directory, os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        self._closed = True
+        self._snapshot_due.set()
+        if self._snapshotter is not None:
+            self._snapshotter.join()
+        self.wal.close()
+
+
+class InMemoryRepository:
+    """
+    ProductRepositoryProtocol over a ProductStore, for one unit of work
+    (InMemoryUnitOfWork).
+
+    get() and add() check the product out: they take its lock (one of LOCK_STRIPES, by
+    hash of the SKU) until release(), and point its journal at a list of this unit of
+    work, which changes() turns into log records and undo() reverts. Looking up a SKU
+    that doesn't exist takes its lock too, so two units of work can't both create the
+    product.
+
+    `conflict` is raised when a lock isn't free within the store's lock_timeout.
+    """
+
+    def __init__(self, store: ProductStore, conflict: Type[Exception] = TimeoutError):
+        self.store = store
+        self.conflict = conflict
+        self.seen: Set[Product] = set()
+        self._held = []  # type: List[threading.Lock]
+        # SKU: (product, version when checked out or last committed, journal since then)
+        self._checked_out = {}  # type: Dict[str, Tuple[Product, int, List[Tuple]]]
+
+    def add(self, product: Product) -> None:
+        self._add(product)
+        self.seen.add(product)
+
+    def get(self, sku) -> Product:
+        product = self._get(sku)
+        if product:
+            self.seen.add(product)
+        return product
+
+    def _add(self, product: Product):
+        self._lock(product.sku)
+        self.store.add(product)
+        self._check_out(product, [("create",)])
+
+    def _get(self, sku):
+        self._lock(sku)
+        product = self.store.get(sku)
+        if product is not None and sku not in self._checked_out:
+            self._check_out(product, [])
+        return product
+
+    def _lock(self, sku: str):
+        lock = self.store.lock_for(sku)
+        if any(lock is held for held in self._held):
+            return
+        if not lock.acquire(timeout=self.store.lock_timeout):
+            raise self.conflict(f"Product {sku} is checked out by another unit of work")
+        self._held.append(lock)
+
+    def _check_out(self, product: Product, ops: List[Tuple]):
+        journal_of(product).ops = ops
+        self._checked_out[product.sku] = (product, product.version_number, ops)
+
+    def changes(self) -> List[Dict[str, Any]]:
+        """A log record per product changed since checked out or last committed"""
+        records = []
+        for sku, (product, version, ops) in self._checked_out.items():
+            if not ops:
+                continue
+            if product.version_number <= version:  # Replay relies on versions moving on
+                product.version_number = version + 1
+            records.append(
+                dict(
+                    sku=sku,
+                    version=product.version_number,
+                    ops=[list(op) for op in ops],
+                )
+            )
+        return records
+
+    def committed(self):
+        """The changes are durable: what undo() reverts starts from here"""
+        for sku, (product, _, ops) in list(self._checked_out.items()):
+            ops.clear()
+            self._checked_out[sku] = (product, product.version_number, ops)
+
+    def undo(self):
+        """Reverts the changes since checkout or the last commit, drops their events"""
+        for sku, (product, version, ops) in self._checked_out.items():
+            for op in reversed(ops):
+                if op[0] == "create":
+                    self.store.remove(sku)
+                else:
+                    undo(product, op)
+            if ops:
+                product.version_number = version
+                ops.clear()
+            product.events.clear()
+
+    def release(self):
+        for product, _, _ in self._checked_out.values():
+            journal_of(product).ops = None
+        self._checked_out.clear()
+        for lock in reversed(self._held):
+            lock.release()
+        self._held.clear()
@@ -0,0 +1,294 @@
+"""
+Operational metrics in the Prometheus text exposition format (the Flask GET /metrics).
+
+The collectors are sharded per thread: each thread increments its own dict of values,
+without a lock, and a scrape adds the shards up. The lock is only taken when a thread
+records its first value for a metric, and by the scrape. When a thread has finished its
+shard is folded into the metric's totals, so a server that starts a thread per request
+doesn't accumulate shards.
+
+The application's metrics are defined at the bottom of this module. Gauges are read when
+scraped, from a function registered by the module owning the value (see messagebus.py).
+"""
+
+# Boilerplate Modules
+# -------------------
+
+from __future__ import annotations
+
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+# Constants
+# ---------
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+MAX_SHARDS = 64  # Finished threads' shards are folded once a metric has this many
+
+Labels = Tuple[str, ...]
+
+# Helper Functions
+# ----------------
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    escaped = (
+        value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for value in values
+    )
+    pairs = (f'{name}="{value}"' for name, value in zip(names, escaped, strict=True))
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+class _Sharded:
+    """
+    The per thread shards of one metric: dicts from label values to a value, which only
+    their own thread writes.
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        self._shards = []  # type: List[Tuple[weakref.ref, Dict]]
+        self._retired = {}  # type: Dict  # Totals of the threads that have finished
+        self._lock = threading.Lock()
+
+    def _shard(self) -> Dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                if len(self._shards) >= MAX_SHARDS:
+                    self._retire_finished()
+                self._shards.append((weakref.ref(threading.current_thread()), shard))
+            return shard
+
+    def _retire_finished(self):
+        # Under self._lock. A finished thread no longer writes to its shard
+        alive = []
+        for thread, shard in self._shards:
+            owner = thread()
+            if owner is not None and owner.is_alive():
+                alive.append((thread, shard))
+            else:
+                for labels, value in shard.items():
+                    self._merge(self._retired, labels, value)
+        self._shards = alive
+
+    def collect(self) -> Dict[Labels, object]:
+        """The values added up across threads, per label values"""
+        with self._lock:
+            self._retire_finished()
+            totals = {}  # type: Dict
+            for labels, value in self._retired.items():
+                self._merge(totals, labels, value)
+            for _, shard in self._shards:
+                # Copying a dict doesn't release the GIL, so it never sees half a write
+                for labels, value in dict(shard).items():
+                    self._merge(totals, labels, value)
+        return totals
+
+    def _merge(self, totals: Dict, labels: Labels, value):
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for labels, value in sorted(self.collect().items()):
+            lines += self._samples(labels, value)
+        return lines
+
+    def _samples(self, labels: Labels, value) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}"
+        ]
+
+
+class Counter(_Sharded):
+    """A count that only goes up, e.g. Counter("allocations_total", "", ["result"])"""
+
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self.collect().get(labels, 0)  # type: ignore[return-value]
+
+    def _merge(self, totals: Dict, labels: Labels, value):
+        totals[labels] = totals.get(labels, 0) + value
+
+
+class Histogram(_Sharded):
+    """
+    Observations (e.g. latencies in seconds) counted in `buckets`.
+
+    Notes:
+    ------
+
+    A shard keeps, per label values, the count of each bucket (not cumulative, the last
+    one is +Inf) followed by the sum. The cumulative `le` buckets are made on scrape.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels: str):
+        shard = self._shard()
+        counts = shard.get(labels)
+        if counts is None:
+            counts = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1  # Buckets are "less or equal"
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        """Observes how long the block takes, exception or not"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def count(self, *labels: str) -> int:
+        counts = self.collect().get(labels)
+        return 0 if counts is None else sum(counts[:-1])  # type: ignore[index]
+
+    def _merge(self, totals: Dict, labels: Labels, value):
+        merged = totals.get(labels)
+        if merged is None:
+            totals[labels] = list(value)
+        else:
+            totals[labels] = [a + b for a, b in zip(merged, value, strict=True)]
+
+    def _samples(self, labels: Labels, value) -> List[str]:
+        names = self.labels + ("le",)
+        samples, cumulative = [], 0
+        for bound, count in zip(
+            self.buckets + (float("inf"),), value[:-1], strict=True
+        ):
+            cumulative += count
+            le = _format_labels(names, labels + (_format_value(bound),))
+            samples.append(f"{self.name}_bucket{le} {cumulative}")
+        suffix = _format_labels(self.labels, labels)
+        samples.append(f"{self.name}_sum{suffix} {_format_value(value[-1])}")
+        samples.append(f"{self.name}_count{suffix} {cumulative}")
+        return samples
+
+
+class Gauge:
+    """A value read when scraped, from `function`"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], float]):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+            f"{self.name} {_format_value(self.function())}",
+        ]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}  # type: Dict[str, object]
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Adds a metric (replacing one with the same name) and returns it"""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []  # type: List[str]
+        for metric in metrics:
+            lines += metric.render()  # type: ignore[attr-defined]
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# The application's metrics
+# -------------------------
+
+service_latency = registry.register(
+    Histogram(
+        "service_duration_seconds",
+        "Time taken by a service call, retries included",
+        ["operation"],
+    )
+)
+allocations = registry.register(
+    Counter(
+        "allocations_total",
+        "Order lines by outcome: allocated, out_of_stock or invalid_sku",
+        ["result"],
+    )
+)
+uow_commits = registry.register(Counter("uow_commits_total", "Units of work committed"))
+uow_rollbacks = registry.register(
+    Counter("uow_rollbacks_total", "Units of work that ended without a commit")
+)
+uow_retries = registry.register(
+    Counter(
+        "uow_retries_total",
+        "Service calls re-run after a concurrent update",
+        ["operation"],
+    )
+)
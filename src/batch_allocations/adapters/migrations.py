@@ -0,0 +1,77 @@
+"""
+Migration path for databases created with `metadata.create_all`.
+
+create_all only creates tables that are missing, so indexes added to the tables in
+orm.py later never reach an existing database. upgrade() creates whatever is missing,
+tables and indexes, and can be run any number of times.
+
+Usage:
+    python -m batch_allocations.adapters.migrations
+"""
+
+# Boilerplate Modules
+# -------------------
+
+from typing import List, Tuple
+
+from sqlalchemy import Index, Table, func, inspect, select
+from sqlalchemy.engine import Engine
+
+# Domain Model Modules
+# --------------------
+from ..adapters.database import get_engine
+from ..adapters.orm import metadata
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+def missing_indexes(engine: Engine) -> List[Tuple[Table, Index]]:
+    """Indexes declared in orm.metadata that the database does not have yet"""
+    inspector = inspect(engine)
+    missing = []
+    for table in metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        missing += [(table, idx) for idx in table.indexes if idx.name not in existing]
+    return missing
+
+
+def check_unique(engine: Engine, table: Table, index: Index):
+    """Raises ValueError if existing rows would violate a unique index"""
+    columns = list(index.columns)
+    duplicates = select(*columns).group_by(*columns).having(func.count() > 1).limit(5)
+    with engine.connect() as conn:
+        rows = conn.execute(duplicates).all()
+    if rows:
+        raise ValueError(
+            f"Cannot create {index.name}: duplicate values in {table.name} "
+            f"(first ones: {[tuple(row) for row in rows]})"
+        )
+
+
+def upgrade(engine: Engine) -> List[str]:
+    """
+    Brings the database schema up to date with orm.metadata. Returns the names of the
+    indexes it created.
+
+    Notes:
+    ------
+
+    On large Postgres tables CREATE INDEX blocks writes to the table while it runs. Run
+    this from a maintenance window, or create the indexes by hand with CREATE INDEX
+    CONCURRENTLY first (this function skips indexes that already exist).
+    """
+    metadata.create_all(engine)  # New tables come with their indexes
+
+    created = []
+    for table, index in missing_indexes(engine):
+        if index.unique:
+            check_unique(engine, table, index)
+        index.create(engine, checkfirst=True)
+        created.append(str(index.name))
+    return created
+
+
+if __name__ == "__main__":
+    for name in upgrade(get_engine()):
+        print(f"created index {name}")
@@ -5,8 +5,31 @@ Repository: The ORM should depend on the model
 # Boilerplate Modules
 # -------------------
 
-from sqlalchemy import Column, Date, ForeignKey, Integer, MetaData, String, Table
-from sqlalchemy.orm import registry, relationship, foreign
+from collections import deque
+
+from sqlalchemy import (
+    Column,
+    Date,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    Text,
+    event,
+    func,
+    select,
+)
+from sqlalchemy.orm import (
+    AppenderQuery,
+    class_mapper,
+    column_property,
+    foreign,
+    registry,
+    relationship,
+)
 
 # Domain Model Modules
 # --------------------
@@ -21,6 +44,9 @@ metadata = (
 
 mapper_registry = registry(metadata=metadata)  # Creates the registry instance
 
+# Unique constraints are declared as unique indexes so adapters/migrations.py can add
+# them to tables that already exist (SQLite cannot ALTER TABLE ... ADD CONSTRAINT).
+
 order_lines = Table(
     "order_lines",  # Table name in the database
     metadata,  # Links this table to the metadata catalog
@@ -29,6 +55,7 @@ order_lines = Table(
     Column("sku", String(255)),
     Column("qty", Integer, nullable=False),
     Column("orderid", String(255)),
+    Index("ix_order_lines_orderid_sku", "orderid", "sku"),
 )
 
 products = Table(
@@ -47,6 +74,8 @@ batch_stock = Table(
     Column("sku", String(255)),
     Column("_purchased_quantity", Integer, nullable=False),
     Column("eta", Date, nullable=True),
+    Index("ix_batch_stock_sku", "sku"),  # Product.batches and SqlAlchemyRepository._get
+    Index("uq_batch_stock_reference", "reference", unique=True),  # get_by_batchref
 )
 
 # Association table to track which order lines are allocated to which batches in our batch stock
@@ -56,6 +85,27 @@ allocations = Table(
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("orderline_id", Integer, ForeignKey("order_lines.id")),
     Column("batch_id", Integer, ForeignKey("batch_stock.id")),
+    # Loading a batch's allocations (and the aggregate SUM) goes through batch_id
+    Index(
+        "uq_allocations_batch_id_orderline_id", "batch_id", "orderline_id", unique=True
+    ),
+    Index("ix_allocations_orderline_id", "orderline_id"),
+)
+
+# Transactional outbox: domain events written in the same transaction as the aggregate
+# change, and handed to the message bus later by service_layer/outbox.py
+outbox = Table(
+    "outbox",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("event_type", String(255), nullable=False),
+    Column("payload", Text, nullable=False),  # JSON
+    Column("created_at", DateTime, nullable=False),
+    Column("claimed_at", DateTime, nullable=True),  # Set while a dispatcher works on it
+    Column("attempts", Integer, nullable=False, server_default="0"),
+    Column("last_error", Text, nullable=True),
+    Column("processed_at", DateTime, nullable=True),
+    Index("ix_outbox_processed_at_id", "processed_at", "id"),  # Pending rows, in order
 )
 
 # Schema Diagram
@@ -73,31 +123,125 @@ allocations = Table(
 #
 
 
-def start_mappers():
+# Sum of the quantities allocated to a batch, computed by the database in the same
+# SELECT that loads the batch. Used instead of loading every allocated order line
+# (aggregate mode).
+allocated_quantity = (
+    select(func.coalesce(func.sum(order_lines.c.qty), 0))
+    .select_from(
+        allocations.join(order_lines, allocations.c.orderline_id == order_lines.c.id)
+    )
+    .where(allocations.c.batch_id == batch_stock.c.id)
+    .correlate_except(allocations, order_lines)
+    .scalar_subquery()
+)
+
+
+class AllocationsQuery(AppenderQuery):
+    """
+    Stands in for Batch._allocations in aggregate mode. It behaves like the set the
+    domain model expects (add, remove, `in`), but only asks the database about the line
+    in question instead of loading every line allocated to the batch.
+    """
+
+    def add(self, line: OrderLine):
+        self.append(line)
+
+    def remove(self, line: OrderLine):
+        # The domain passes an equal OrderLine, not necessarily the loaded instance
+        allocated = self._find(line)
+        if allocated is not None:
+            super().remove(allocated)
+
+    def __contains__(self, line: OrderLine) -> bool:
+        return self._find(line) is not None
+
+    def _find(self, line: OrderLine):
+        if self.session is None:  # Batch not in a session yet: only pending lines exist
+            return next((pending for pending in self if pending == line), None)
+        return self.filter_by(orderid=line.orderid, sku=line.sku, qty=line.qty).first()
+
+
+def _reset_allocated_quantity(batch, *args):
+    """
+    SQLAlchemy does not call Batch.__init__, and the running total is not a column.
+    Whenever the allocations are (re)loaded from the database the total is marked as
+    unknown so Batch rebuilds it.
+    """
+    # "expire" can fire for an instance that was already garbage collected
+    if batch is not None:
+        batch._allocated_quantity = None
+
+
+def _init_product(product, *args):
+    """Product.__init__ is skipped on load too: give it its events and a fresh index"""
+    product.events = deque()
+    product._batch_index = None
+
+
+def _reset_batch_index(product, *args):
+    if product is not None:
+        product._batch_index = None
+
+
+def start_mappers(aggregate_allocations: bool = False):
     """
     Creates a mapping between the Python class and the database table
 
     model.OrderLine = the domain class (business logic)
     order_lines = the database table (persistence layer)
     mapper() = connects them so SQLAlchemy knows how to convert between them
+
+    With `aggregate_allocations=True` a batch's allocated quantity is a SQL SUM loaded
+    along with the batch, and its order lines are only queried when the domain actually
+    needs them (checking whether a line is already allocated, deallocating). Use it when
+    batches carry long allocation histories.
+
+    Calling it again is a no-op, as long as `aggregate_allocations` is the same
+    (clear_mappers() to switch).
     """
+    if mapper_registry.mappers:
+        mapped = class_mapper(Batch).relationships["_allocations"].lazy == "dynamic"
+        if mapped != aggregate_allocations:
+            raise RuntimeError(
+                f"Mappers already started with aggregate_allocations={mapped}"
+            )
+        return
     lines_mapper = mapper_registry.map_imperatively(OrderLine, order_lines)
 
-    batches_mapper = mapper_registry.map_imperatively(
-        Batch,
-        batch_stock,
-        properties={
+    if aggregate_allocations:
+        batch_properties = {
+            "_allocations": relationship(
+                lines_mapper,
+                secondary=allocations,
+                lazy="dynamic",
+                query_class=AllocationsQuery,
+            ),
+            "_allocated_quantity": column_property(allocated_quantity),
+        }
+    else:
+        batch_properties = {
             "_allocations": relationship(
                 lines_mapper,
                 secondary=allocations,  # The join table
                 collection_class=set,  # Store as a set (matches domain model)
             )
-        },
+        }
+
+    batches_mapper = mapper_registry.map_imperatively(
+        Batch,
+        batch_stock,
+        properties=batch_properties,
     )
 
     mapper_registry.map_imperatively(
         Product,
         products,
+        # Optimistic concurrency: the domain bumps version_number and every UPDATE of
+        # the product row checks the version it was loaded with (compare-and-swap).
+        # SQLAlchemy raises StaleDataError when another transaction got there first.
+        version_id_col=products.c.version_number,
+        version_id_generator=False,
         properties={
             "batches": relationship(
                 batches_mapper,
@@ -105,3 +249,12 @@ def start_mappers():
             )
         },
     )
+
+    # Keep Batch's running allocated quantity and Product's ETA index in step with what
+    # the session loads. In aggregate mode the quantity is a column SQLAlchemy reloads.
+    if not aggregate_allocations:
+        for identifier in ("load", "refresh", "expire"):
+            event.listen(Batch, identifier, _reset_allocated_quantity)
+    event.listen(Product, "load", _init_product)
+    for identifier in ("refresh", "expire"):
+        event.listen(Product, identifier, _reset_batch_index)
@@ -0,0 +1,119 @@
+"""
+Persistence for the transactional outbox (the `outbox` table in orm.py).
+
+Events are stored as their class name plus a JSON payload of their dataclass fields.
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import json
+from dataclasses import asdict
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, NamedTuple, Sequence
+
+from sqlalchemy import delete, insert, or_, select, update
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+# Domain Model Modules
+# --------------------
+from ..adapters.orm import outbox
+from ..domain.events import Event
+
+# Helper Functions
+# ----------------
+
+
+def utcnow() -> datetime:
+    # Naive UTC, which is what the DateTime columns store on every backend
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+class OutboxRow(NamedTuple):
+    id: int
+    event_type: str
+    payload: str
+    attempts: int
+
+
+def add_events(session: Session, events: Iterable[Event]):
+    """Writes events to the outbox as part of the session's current transaction"""
+    now = utcnow()
+    rows = [
+        dict(
+            event_type=type(event).__name__,
+            payload=json.dumps(asdict(event), default=str),  # type: ignore[call-overload]
+            created_at=now,
+        )
+        for event in events
+    ]
+    if rows:
+        session.execute(insert(outbox), rows)
+
+
+def claim(
+    conn: Connection, limit: int, lease: timedelta, max_attempts: int
+) -> List[OutboxRow]:
+    """
+    Claims up to `limit` pending rows, oldest first. A row stays claimed for `lease`; if
+    the dispatcher dies before marking it processed, another dispatcher picks it up
+    after that. Rows that failed `max_attempts` times are left alone (see last_error).
+
+    On Postgres concurrent dispatchers skip each other's rows (FOR UPDATE SKIP LOCKED).
+    SQLite ignores the locking clause; it only allows one writer anyway.
+    """
+    now = utcnow()
+    pending = (
+        select(outbox.c.id, outbox.c.event_type, outbox.c.payload, outbox.c.attempts)
+        .where(
+            outbox.c.processed_at.is_(None),
+            outbox.c.attempts < max_attempts,
+            or_(outbox.c.claimed_at.is_(None), outbox.c.claimed_at < now - lease),
+        )
+        .order_by(outbox.c.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    rows = [OutboxRow(*row) for row in conn.execute(pending)]
+    if rows:
+        conn.execute(
+            update(outbox)
+            .where(outbox.c.id.in_([row.id for row in rows]))
+            .values(claimed_at=now, attempts=outbox.c.attempts + 1)
+        )
+    return rows
+
+
+def mark_processed(conn: Connection, ids: Sequence[int]):
+    if ids:
+        conn.execute(
+            update(outbox).where(outbox.c.id.in_(ids)).values(processed_at=utcnow())
+        )
+
+
+def mark_failed(conn: Connection, row_id: int, error: str):
+    """Releases the claim so the row is retried (until it runs out of attempts)"""
+    conn.execute(
+        update(outbox)
+        .where(outbox.c.id == row_id)
+        .values(claimed_at=None, last_error=error)
+    )
+
+
+def purge_processed(conn: Connection, before: datetime, limit: int) -> int:
+    """
+    Deletes up to `limit` rows processed before `before`, oldest first. Returns the rows
+    deleted. Rows that ran out of attempts are never processed, so they are kept.
+    """
+    expired = (
+        select(outbox.c.id)
+        .where(outbox.c.processed_at < before)
+        .order_by(outbox.c.processed_at)
+        .limit(limit)
+    )
+    return conn.execute(delete(outbox).where(outbox.c.id.in_(expired))).rowcount
@@ -5,10 +5,17 @@ Repository: The ORM should depend on the model
 # Boilerplate Modules
 # -------------------
 
-from typing import Protocol, List
+from typing import Callable, List, Literal, Optional, Protocol
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import class_mapper, joinedload, selectinload
 
 # Domain Model Modules
 # --------------------
+from ..adapters.cache import ProductCache
+from ..adapters.orm import products
+from ..adapters.sku_index import SkuIndex
 from ..domain.model import Batch, Product
 
 # Functions and Class Definitions/Declarations
@@ -52,6 +59,47 @@ class ProductRepositoryProtocol(Protocol):
     def _get(self, sku) -> Product: ...
 
 
+class AsyncProductRepositoryProtocol(Protocol):
+    """ProductRepositoryProtocol for asyncio: get() awaits the database, add() is not"""
+
+    seen: set[Product]
+
+    def add(self, product: Product) -> None:
+        self._add(product)
+        self.seen.add(product)
+
+    async def get(self, sku) -> Product:
+        product = await self._get(sku)
+        if product:
+            self.seen.add(product)
+        return product
+
+    def _add(self, product: Product): ...
+
+    async def _get(self, sku) -> Product: ...
+
+
+LoadingStrategy = Literal["selectin", "joined", "lazy"]
+
+
+def _aggregated() -> bool:
+    # In aggregate mode (see orm.start_mappers) allocations are never loaded up front
+    return class_mapper(Batch).relationships["_allocations"].lazy == "dynamic"
+
+
+def _load_options(loading: LoadingStrategy):
+    batches = class_mapper(Product).relationships["batches"].class_attribute
+    allocations = class_mapper(Batch).relationships["_allocations"]
+    aggregated = _aggregated()
+    if loading == "selectin":
+        load = selectinload(batches)
+        return [load if aggregated else load.selectinload(allocations.class_attribute)]
+    if loading == "joined":
+        load = joinedload(batches)
+        return [load if aggregated else load.joinedload(allocations.class_attribute)]
+    return []
+
+
 class SqlAlchemyRepository(ProductRepositoryProtocol):
     """
     Notes:
@@ -60,17 +108,147 @@ class SqlAlchemyRepository(ProductRepositoryProtocol):
     This is an 'Adapter': it implements the interface/abstraction (or Port).
 
     When using production code Flask instantiates the SqlAlchemyRepository with a 'real' database.
+
+    `loading` decides how get() fetches a product's batches and their allocations:
+        - "selectin": three queries (products, batches, allocations), whatever the
+          number of batches
+        - "joined": a single query joining the three tables
+        - "lazy": SQLAlchemy's default, one query per relationship on first access
+          (1 + 1 + N)
+
+    With a `cache` (see adapters/cache.py) a product that has not changed since it was
+    cached costs one `SELECT version_number` instead of a full load. The unit of work
+    fills the cache.
+
+    With a `sku_index` (see adapters/sku_index.py) get() returns None for a SKU known
+    not to exist without querying.
     """
 
-    def __init__(self, session):
+    def __init__(
+        self,
+        session,
+        loading: LoadingStrategy = "selectin",
+        cache: Optional[ProductCache] = None,
+        sku_index: Optional[SkuIndex] = None,
+    ):
+        if loading not in ("selectin", "joined", "lazy"):
+            raise ValueError(f"Unknown loading strategy {loading!r}")
+        if cache is not None and _aggregated():
+            # A detached batch cannot query its allocations
+            raise ValueError("ProductCache does not support aggregate allocations mode")
         self.session = session
+        self.loading = loading
+        self.cache = cache
+        self.sku_index = sku_index
         self.seen = set()  # type Set[Product]
 
     def _add(self, product):
         self.session.add(product)
+        if self.sku_index is not None:
+            # Possibly before it is committed: the index may only err towards a query
+            self.sku_index.add(product.sku)
 
     def _get(self, sku):
-        return self.session.query(Product).filter_by(sku=sku).first()
+        if self.sku_index is None:
+            return self._load(sku)
+        if not self.sku_index.might_exist(sku):
+            return None
+        product = self._load(sku)
+        self.sku_index.record(sku, product is not None)
+        return product
+
+    def _load(self, sku):
+        if self.cache is not None:
+            cached = self.cache.get(sku, lambda: self._current_version(sku))
+            if cached is not None:
+                return self.session.merge(cached, load=False)
+        query = self.session.query(Product).filter_by(sku=sku)
+        return query.options(*_load_options(self.loading)).first()
+
+    def _current_version(self, sku) -> Optional[int]:
+        query = select(products.c.version_number).where(products.c.sku == sku)
+        return self.session.execute(query).scalar_one_or_none()
 
     def get_by_batchref(self, batchref):
         return self.session.query(Batch).filter_by(reference=batchref).first()
+
+
+class ShardedRepository(ProductRepositoryProtocol):
+    """
+    Notes:
+    ------
+
+    Routes each SKU to the repository of its shard, `repository_for(sku)`, which the
+    unit of work (unit_of_work.ShardedUnitOfWork) opens on first use. `creating(sku)` is
+    called before a product is added, and `missing(sku)` when its shard doesn't have the
+    SKU (it may have been moved since the map was read). See adapters/shards.py.
+    """
+
+    def __init__(
+        self,
+        repository_for: Callable[[str], ProductRepositoryProtocol],
+        creating: Callable[[str], None],
+        missing: Callable[[str], None],
+    ):
+        self.repository_for = repository_for
+        self.creating = creating
+        self.missing = missing
+        self.seen = set()  # type Set[Product]
+
+    def _add(self, product):
+        self.creating(product.sku)
+        self.repository_for(product.sku).add(product)
+
+    def _get(self, sku):
+        product = self.repository_for(sku).get(sku)
+        if product is None:
+            self.missing(sku)
+        return product
+
+
+class AsyncSqlAlchemyRepository(AsyncProductRepositoryProtocol):
+    """
+    Notes:
+    ------
+
+    SqlAlchemyRepository on an AsyncSession. Nothing may be loaded lazily once the
+    product is handed to the domain (there is no await in Product.allocate), so the
+    batches and their allocations always come with the product: "selectin" or "joined",
+    never "lazy", and not in aggregate allocations mode.
+
+    A shared `sku_index` works the same as in SqlAlchemyRepository.
+    """
+
+    def __init__(
+        self,
+        session: AsyncSession,
+        loading: LoadingStrategy = "selectin",
+        sku_index: Optional[SkuIndex] = None,
+    ):
+        if loading not in ("selectin", "joined"):
+            raise ValueError(
+                f"Loading strategy {loading!r} needs a synchronous session"
+            )
+        if _aggregated():
+            raise ValueError(
+                "Async repository does not support aggregate allocations mode"
+            )
+        self.session = session
+        self.loading = loading
+        self.sku_index = sku_index
+        self.seen = set()  # type Set[Product]
+
+    def _add(self, product):
+        self.session.add(product)
+        if self.sku_index is not None:
+            self.sku_index.add(product.sku)
+
+    async def _get(self, sku):
+        if self.sku_index is not None and not self.sku_index.might_exist(sku):
+            return None
+        query = select(Product).filter_by(sku=sku).options(*_load_options(self.loading))
+        result = await self.session.execute(query)
+        product = result.unique().scalars().first()
+        if self.sku_index is not None:
+            self.sku_index.record(sku, product is not None)
+        return product
@@ -0,0 +1,388 @@
+"""
+Sharding: each SKU's product, batches and allocations live in one of several databases.
+
+A ShardMap names the shards (name -> database URI) and places SKUs on them with a
+consistent hash ring (adapters/hashring.py), unless an override pins a SKU to a shard.
+The map is a JSON file that every process loads (SHARD_MAP):
+
+    {
+      "shards": {"a": "postgresql://...", "b": "postgresql://..."},
+      "overrides": {"RED-LAMP": "b"}
+    }
+
+ShardedUnitOfWork (service_layer/unit_of_work.py) runs each unit of work on the shard of
+the SKU it gets. The Product aggregate never spans SKUs, so nothing spans shards.
+
+Moving SKUs, with `python -m batch_allocations.entrypoints.shards`:
+
+    - move_sku() copies a SKU's rows to another shard, points the map at it and deletes
+      the originals. Bumping the product's version first makes units of work that loaded
+      it before the move fail with ConcurrentUpdateError; their retry reloads the map.
+    - add_shard() adds a shard, pinning the SKUs the ring would now send there to where
+      they are, and rebalance() then moves them over one at a time, dropping the pins.
+    - purge_strays() deletes the copies an interrupted move left behind.
+
+A unit of work creating a product holds the map's lock file shared until it exits
+(ShardMap.creating()), and add_shard() holds it exclusively while it scans the shards
+and saves the new ring. Otherwise a process still on the old map could create a SKU
+after the scan, on a shard the new ring no longer sends it to, and it would be created
+twice.
+
+Notes:
+------
+
+Batch references are only unique per shard, and each shard has its own outbox. The map's
+lock is flock(), so a map file needs a POSIX system; without sharding nothing uses it.
+"""
+
+# Boilerplate Modules
+# -------------------
+
+from __future__ import annotations
+
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Mapping, Optional, Set, Tuple
+
+from sqlalchemy import Table, delete, insert, select, update
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import sessionmaker
+
+# Domain Model Modules
+# --------------------
+from ..adapters.database import get_engine
+from ..adapters.hashring import DEFAULT_REPLICAS, HashRing
+from ..adapters.migrations import upgrade
+from ..adapters.orm import allocations, batch_stock, order_lines, products
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+class CrossShardError(Exception):
+    """A unit of work got products on two shards, which no transaction covers"""
+
+
+class ShardMap:
+    """
+    Attributes:
+    ----------
+
+    shards : Dict[str, str]
+        Shard name to database URI.
+    overrides : Dict[str, str]
+        SKUs pinned to a shard other than (or until rebalanced to) the ring's.
+    path : Optional[str]
+        The file it was loaded from: refresh() reloads it when it changes, save() writes
+        it.
+    """
+
+    def __init__(
+        self,
+        shards: Mapping[str, str],
+        overrides: Optional[Mapping[str, str]] = None,
+        replicas: int = DEFAULT_REPLICAS,
+        path: Optional[str] = None,
+    ):
+        self.shards = dict(shards)
+        self.overrides = dict(overrides or {})
+        self.replicas = replicas
+        self.path = path
+        unknown = set(self.overrides.values()) - set(self.shards)
+        if unknown:
+            raise ValueError(f"Overrides to unknown shards: {sorted(unknown)}")
+        self.ring = HashRing(sorted(self.shards), replicas)
+        self._session_factories = {}  # type: Dict[str, sessionmaker]
+        self._stamp = self._file_stamp()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str) -> "ShardMap":
+        with open(path) as f:
+            data = json.load(f)
+        return cls(
+            data["shards"],
+            data.get("overrides"),
+            data.get("replicas", DEFAULT_REPLICAS),
+            path=path,
+        )
+
+    def save(self, path: Optional[str] = None):
+        """Writes the map (to its own file by default), atomically"""
+        path = path or self.path
+        if path is None:
+            raise ValueError("Shard map has no file")
+        data = dict(
+            shards=self.shards, overrides=self.overrides, replicas=self.replicas
+        )
+        with open(path + ".tmp", "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(path + ".tmp", path)
+        self.path = path
+        self._stamp = self._file_stamp()
+
+    def _file_stamp(self):
+        if self.path is None:
+            return None
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def refresh(self):
+        """Reloads the file if another process changed it (one stat() per call)"""
+        if self.path is None or self._file_stamp() == self._stamp:
+            return
+        with self._lock:
+            latest = ShardMap.load(self.path)
+            self.shards, self.overrides = latest.shards, latest.overrides
+            self.ring = latest.ring
+            self._session_factories = {}
+            self._stamp = latest._stamp
+
+    @contextmanager
+    def _locked(self, exclusive: bool) -> Iterator[None]:
+        # flock() on a file next to the map; a map without a file is only this process's
+        if self.path is None:
+            yield
+            return
+        import fcntl  # POSIX only: here, so importing the module works anywhere
+
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+        finally:
+            os.close(fd)  # Releases the lock
+
+    def creating(self):
+        """Held (shared) by units of work creating a product, until they exit"""
+        return self._locked(exclusive=False)
+
+    def changing(self):
+        """Held (exclusively) while the shards are scanned for a new ring"""
+        return self._locked(exclusive=True)
+
+    def shard_for(self, sku: str) -> str:
+        return self.overrides.get(sku) or self.ring.node_for(sku)
+
+    def engine(self, shard: str) -> Engine:
+        # One pool per shard for the whole process
+        return get_engine(self.shards[shard])
+
+    def session_factory(self, shard: str) -> sessionmaker:
+        factory = self._session_factories.get(shard)
+        if factory is None:
+            factory = self._session_factories[shard] = sessionmaker(
+                bind=self.engine(shard)
+            )
+        return factory
+
+
+# Tooling
+# -------
+
+
+def upgrade_shards(shard_map: ShardMap) -> Dict[str, List[str]]:
+    """migrations.upgrade() on every shard; the indexes created, per shard"""
+    return {name: upgrade(shard_map.engine(name)) for name in shard_map.shards}
+
+
+def skus_on(shard_map: ShardMap, shard: str) -> Iterator[str]:
+    with shard_map.engine(shard).connect() as conn:
+        yield from conn.execute(
+            select(products.c.sku).order_by(products.c.sku)
+        ).scalars()
+
+
+def _insert(conn: Connection, table: Table, values: Dict) -> int:
+    """Inserts a row; returns its new id"""
+    key = conn.execute(insert(table).values(**values)).inserted_primary_key
+    assert key is not None
+    return key[0]
+
+
+def _copy_rows(source: Connection, target: Connection, sku: str):
+    """Inserts the SKU's product, batches, order lines and allocations into target"""
+    version = source.execute(
+        select(products.c.version_number).where(products.c.sku == sku)
+    ).scalar_one()
+    target.execute(insert(products).values(sku=sku, version_number=version))
+    batch_ids = {}  # type: Dict[int, int]
+    for batch in source.execute(select(batch_stock).where(batch_stock.c.sku == sku)):
+        values = batch._asdict()
+        source_id = values.pop("id")
+        batch_ids[source_id] = _insert(target, batch_stock, values)
+    if not batch_ids:
+        return
+    allocated = source.execute(
+        select(order_lines, allocations.c.batch_id)
+        .join(allocations, allocations.c.orderline_id == order_lines.c.id)
+        .where(allocations.c.batch_id.in_(list(batch_ids)))
+    )
+    for line in allocated:
+        values = line._asdict()
+        values.pop("id")
+        batch_id = values.pop("batch_id")
+        orderline_id = _insert(target, order_lines, values)
+        target.execute(
+            insert(allocations).values(
+                orderline_id=orderline_id, batch_id=batch_ids[batch_id]
+            )
+        )
+
+
+def _delete_rows(conn: Connection, sku: str):
+    batch_ids = select(batch_stock.c.id).where(batch_stock.c.sku == sku)
+    line_ids = select(allocations.c.orderline_id).where(
+        allocations.c.batch_id.in_(batch_ids)
+    )
+    allocated = [row.orderline_id for row in conn.execute(line_ids)]
+    conn.execute(delete(allocations).where(allocations.c.batch_id.in_(batch_ids)))
+    if allocated:
+        conn.execute(delete(order_lines).where(order_lines.c.id.in_(allocated)))
+    conn.execute(delete(batch_stock).where(batch_stock.c.sku == sku))
+    conn.execute(delete(products).where(products.c.sku == sku))
+
+
+def move_sku(shard_map: ShardMap, sku: str, target: str) -> bool:
+    """
+    Moves the SKU's rows to the target shard and saves the map (if it has a file).
+    Returns False if the SKU was already there. Raises KeyError if the SKU doesn't
+    exist.
+
+    Notes:
+    ------
+
+    The source transaction first bumps the product's version, which locks the row (the
+    database on SQLite) until the move is over and fails any unit of work that loaded
+    the product before it. Once the target has committed the map is saved, then the
+    originals are deleted. If the process dies in between, one of the two copies is left
+    where the map doesn't look: strays() finds it and purge_strays() deletes it.
+    """
+    if target not in shard_map.shards:
+        raise ValueError(f"Unknown shard {target}")
+    source = shard_map.shard_for(sku)
+    if source == target:
+        return False
+    with shard_map.engine(source).connect() as src:
+        with src.begin():
+            fenced = src.execute(
+                update(products)
+                .where(products.c.sku == sku)
+                .values(version_number=products.c.version_number + 1)
+            )
+            if not fenced.rowcount:
+                raise KeyError(f"No product {sku} on shard {source}")
+            with shard_map.engine(target).begin() as dst:
+                _delete_rows(dst, sku)  # A stray copy from an interrupted move
+                _copy_rows(src, dst, sku)
+            _point(shard_map, sku, target)
+            _delete_rows(src, sku)
+    return True
+
+
+def _point(shard_map: ShardMap, sku: str, shard: str):
+    if shard_map.ring.node_for(sku) == shard:
+        shard_map.overrides.pop(sku, None)
+    else:
+        shard_map.overrides[sku] = shard
+    if shard_map.path is not None:
+        shard_map.save()
+
+
+def add_shard(shard_map: ShardMap, name: str, uri: str) -> List[str]:
+    """
+    Adds a shard (creating its schema) without moving anything yet: the SKUs the new
+    ring sends elsewhere are pinned where they are. Returns them; rebalance() moves
+    them.
+
+    Waits for the units of work creating products to exit, and makes new ones wait until
+    the map is saved (ShardMap.changing()), so every SKU is either found by the scan or
+    created where the new map places it.
+    """
+    with shard_map.changing():
+        shard_map.refresh()
+        if name in shard_map.shards:
+            raise ValueError(f"Shard {name} already exists")
+        upgrade(get_engine(uri))  # Before any process can send a SKU there
+        new_ring = HashRing(sorted(shard_map.shards) + [name], shard_map.replicas)
+        pinned = []
+        for shard in shard_map.shards:
+            for sku in skus_on(shard_map, shard):
+                if sku not in shard_map.overrides and new_ring.node_for(sku) != shard:
+                    shard_map.overrides[sku] = shard
+                    pinned.append(sku)
+        shard_map.shards[name] = uri
+        shard_map.ring = new_ring
+        if shard_map.path is not None:
+            shard_map.save()
+    return pinned
+
+
+def rebalance(shard_map: ShardMap, limit: Optional[int] = None) -> List[str]:
+    """Moves pinned SKUs to the ring's shard for them (at most `limit`); returns them"""
+    moved = []  # type: List[str]
+    for sku, shard in sorted(shard_map.overrides.items()):
+        if limit is not None and len(moved) >= limit:
+            break
+        if shard_map.ring.node_for(sku) != shard:
+            move_sku(shard_map, sku, shard_map.ring.node_for(sku))
+            moved.append(sku)
+    return moved
+
+
+def strays(shard_map: ShardMap) -> Dict[str, List[str]]:
+    """Per shard, the SKUs it holds that the map places on another shard"""
+    return {
+        shard: [
+            sku
+            for sku in skus_on(shard_map, shard)
+            if shard_map.shard_for(sku) != shard
+        ]
+        for shard in shard_map.shards
+    }
+
+
+def _contents(conn: Connection, sku: str) -> Optional[Tuple[Set, Set]]:
+    """The SKU's batch references and (batch reference, orderid, qty) allocations"""
+    exists = conn.execute(select(products.c.sku).where(products.c.sku == sku)).first()
+    if exists is None:
+        return None
+    batches = set(
+        conn.execute(
+            select(batch_stock.c.reference).where(batch_stock.c.sku == sku)
+        ).scalars()
+    )
+    allocated = set(
+        conn.execute(
+            select(batch_stock.c.reference, order_lines.c.orderid, order_lines.c.qty)
+            .join(allocations, allocations.c.batch_id == batch_stock.c.id)
+            .join(order_lines, order_lines.c.id == allocations.c.orderline_id)
+            .where(batch_stock.c.sku == sku)
+        ).tuples()
+    )
+    return batches, allocated
+
+
+def purge_strays(shard_map: ShardMap) -> Dict[str, List[str]]:
+    """
+    Deletes the strays left by an interrupted move_sku(); returns them, per shard.
+
+    A stray is only deleted if it is a copy: the shard the map places the SKU on holds
+    it too, with every batch and allocation of the stray. Anything else (a SKU created
+    twice, say) may hold allocations nowhere else, and is left for strays() to report.
+    """
+    purged: Dict[str, List[str]] = {}
+    for shard, skus in strays(shard_map).items():
+        purged[shard] = []
+        with shard_map.engine(shard).begin() as conn:
+            for sku in skus:
+                home = shard_map.shard_for(sku)
+                with shard_map.engine(home).connect() as live:
+                    kept = _contents(live, sku)
+                stray = _contents(conn, sku)
+                if kept and stray and stray[0] <= kept[0] and stray[1] <= kept[1]:
+                    _delete_rows(conn, sku)
+                    purged[shard].append(sku)
+    return purged
@@ -0,0 +1,107 @@
+"""
+An in-memory index of the SKUs in the products table, so requests for SKUs that don't
+exist (typos, bots) are turned away without a query.
+
+Products are never deleted, so a SKU in the index exists. A SKU that isn't may still
+have been created since the index was warmed, by another process sharing the database
+(the ingest CLI, another API worker): the repository then looks it up. Only with a
+`negative_ttl` is a SKU the database doesn't have either remembered as unknown, and
+rejected for that many seconds even if another process creates it meanwhile. SKUs added
+through this process (units of work, /add_batch, ingest_batches) are indexed straight
+away, so within one process an existing SKU is never rejected.
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import threading
+import time
+from typing import Callable, Dict, Set
+
+from sqlalchemy import select
+
+# Domain Model Modules
+# --------------------
+from ..adapters.orm import products
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+class SkuIndex:
+    """
+    Attributes:
+    ----------
+
+    negative_ttl : float
+        Seconds an unknown SKU is rejected without asking the database again. This is
+        how long another process's new product can be reported as an invalid SKU here;
+        0 (the default) asks the database every time.
+    max_unknown : int
+        Unknown SKUs remembered at most, so a flood of random SKUs can't grow the index
+        without bound. Past that the oldest are forgotten (and cost a query again).
+    rejected, lookups : int
+        Requests turned away by the index, and unknown SKUs looked up in the database.
+    """
+
+    def __init__(
+        self,
+        negative_ttl: float = 0.0,
+        max_unknown: int = 100_000,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.negative_ttl = negative_ttl
+        self.max_unknown = max_unknown
+        self.clock = clock
+        self.rejected = 0
+        self.lookups = 0
+        self._known: Set[str] = set()
+        self._unknown: Dict[str, float] = {}  # SKU -> when to ask again
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._known)
+
+    def warm(self, conn) -> int:
+        """Indexes every SKU in the products table (`conn`: a Connection or Session)"""
+        skus = set(conn.execute(select(products.c.sku)).scalars())
+        with self._lock:
+            self._known |= skus
+            for sku in skus:
+                self._unknown.pop(sku, None)
+        return len(skus)
+
+    def add(self, sku: str):
+        with self._lock:
+            self._known.add(sku)
+            self._unknown.pop(sku, None)
+
+    def forget(self, sku: str):
+        """Asks the database about `sku` next time, e.g. before writing its product"""
+        with self._lock:
+            self._unknown.pop(sku, None)
+
+    def might_exist(self, sku: str) -> bool:
+        """False only for a SKU the database recently didn't have"""
+        if sku in self._known:
+            return True
+        with self._lock:
+            expires = self._unknown.get(sku)
+            if expires is not None and self.clock() < expires:
+                self.rejected += 1
+                return False
+            self.lookups += 1
+            return True
+
+    def record(self, sku: str, exists: bool):
+        """What the database said about a SKU that was looked up"""
+        if exists:
+            self.add(sku)
+            return
+        if not self.negative_ttl:
+            return
+        with self._lock:
+            self._unknown.pop(sku, None)
+            self._unknown[sku] = self.clock() + self.negative_ttl
+            if len(self._unknown) > self.max_unknown:
+                del self._unknown[next(iter(self._unknown))]  # Oldest
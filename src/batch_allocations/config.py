@@ -27,6 +27,21 @@ def get_postgres_uri():
     return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 
 
+def get_pool_options():
+    """
+    Connection pool settings for the shared engine (adapters/database.py). Size the pool
+    against the number of threads per worker: DB_POOL_SIZE + DB_MAX_OVERFLOW is the most
+    connections one process opens, and a thread waits up to DB_POOL_TIMEOUT seconds.
+    """
+    return dict(
+        pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", -1)),  # Seconds, -1: never
+        pool_pre_ping=os.environ.get("DB_POOL_PRE_PING", "0") == "1",
+    )
+
+
 def get_api_url():
     """Get API URL"""
     host = os.environ.get("API_HOST", "localhost")
@@ -34,6 +49,105 @@ def get_api_url():
     return f"http://{host}:{port}"
 
 
+def get_messagebus_options():
+    """
+    Options for messagebus.start_async_dispatch(), or None to handle events
+    synchronously (the default, and what the tests use)
+    """
+    if os.environ.get("MESSAGEBUS_MODE", "sync") != "async":
+        return None
+    return dict(
+        workers=int(os.environ.get("MESSAGEBUS_WORKERS", 4)),
+        queue_size=int(os.environ.get("MESSAGEBUS_QUEUE_SIZE", 1000)),
+        handler_timeout=float(os.environ.get("MESSAGEBUS_HANDLER_TIMEOUT", 10)),
+        handler_threads=int(os.environ.get("MESSAGEBUS_HANDLER_THREADS", 0)) or None,
+    )
+
+
+def get_debounce_window():
+    """Seconds between two notifications of the same event, e.g. OutOfStock for a SKU"""
+    return float(os.environ.get("MESSAGEBUS_DEBOUNCE_SECONDS", 60))
+
+
+def get_product_cache_options():
+    """Options for adapters.cache.ProductCache, or None (the default) to always load"""
+    max_entries = int(os.environ.get("PRODUCT_CACHE_ENTRIES", 0))
+    if not max_entries:
+        return None
+    return dict(
+        max_entries=max_entries,
+        max_rows=int(os.environ.get("PRODUCT_CACHE_ROWS", 100_000)),
+    )
+
+
+def get_sku_index_options():
+    """
+    Options for adapters.sku_index.SkuIndex, or None (the default) to look every SKU
+    up. SKU_NEGATIVE_TTL is how long an unknown SKU is rejected without a query:
+    products created by other processes, like the ingest CLI, are reported as invalid
+    SKUs for up to that long
+    """
+    negative_ttl = float(os.environ.get("SKU_NEGATIVE_TTL", 0))
+    if not negative_ttl:
+        return None
+    return dict(negative_ttl=negative_ttl)
+
+
+def get_allocation_coalescing_options():
+    """
+    Options for service_layer.coalescer.AllocationCoalescer, or None (the default) to
+    allocate each request on its own. ALLOCATE_COALESCE_MS is the latency added to
+    gather requests for the same SKU
+    """
+    window_ms = float(os.environ.get("ALLOCATE_COALESCE_MS", 0))
+    if not window_ms:
+        return None
+    return dict(
+        window=window_ms / 1000,
+        max_batch=int(os.environ.get("ALLOCATE_COALESCE_MAX", 100)),
+    )
+
+
+def get_outbox_options():
+    """
+    Options for service_layer.outbox.OutboxDispatcher, or None to dispatch events right
+    after the commit (the default). With OUTBOX_MODE=thread the API runs the dispatcher
+    itself; with OUTBOX_MODE=external the events are only written, and `python -m
+    batch_allocations.service_layer.outbox` drains them.
+    """
+    mode = os.environ.get("OUTBOX_MODE", "off")
+    if mode == "off":
+        return None
+    return dict(
+        mode=mode,
+        batch_size=int(os.environ.get("OUTBOX_BATCH_SIZE", 100)),
+        poll_interval=float(os.environ.get("OUTBOX_POLL_INTERVAL", 1)),
+        # Processed rows are deleted after this many seconds (a week by default)
+        retention=float(os.environ.get("OUTBOX_RETENTION", 7 * 24 * 3600)),
+    )
+
+
+def get_memory_store_options():
+    """
+    Options for adapters.memory_store.ProductStore, used when the app is given a store
+    directory (MEMORY_STORE_DIR). MEMORY_STORE_FSYNC=0 trades the last commits before a
+    crash of the machine for throughput
+    """
+    return dict(
+        fsync=os.environ.get("MEMORY_STORE_FSYNC", "1") != "0",
+        snapshot_every=int(os.environ.get("MEMORY_STORE_SNAPSHOT_EVERY", 100_000)),
+        lock_timeout=float(os.environ.get("MEMORY_STORE_LOCK_TIMEOUT", 1)),
+    )
+
+
+def get_shard_map_path():
+    """
+    The shard map file (adapters/shards.py), or None for a single database. With it the
+    app's units of work are ShardedUnitOfWork
+    """
+    return os.environ.get("SHARD_MAP")
+
+
 def get_sqlite_uri():
     """Get SQLite connection string for tests"""
     return "sqlite:///test.db"
@@ -14,9 +14,11 @@ from dataclasses import dataclass
 
 
 class Event:
-    pass
+    pass  # Subclasses are frozen dataclasses: the message bus deduplicates by value
 
 
-@dataclass
+@dataclass(
+    frozen=True
+)  # Facts don't change. Also makes events hashable, for deduplication
 class OutOfStock(Event):
     sku: str
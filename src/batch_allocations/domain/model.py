@@ -7,9 +7,11 @@ Domain Model Layer
 
 from __future__ import annotations
 
+from bisect import bisect_left
+from collections import deque
 from dataclasses import dataclass
 from datetime import date
-from typing import List, Optional, Set
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple
 
 # Domain Model Modules
 # --------------------
@@ -32,24 +34,36 @@ class OrderLine:
 class Batch:
     """Entity Object"""
 
+    _index: Optional[BatchIndex] = None  # The index holding it, told of deallocations
+
     def __init__(self, ref: str, sku: str, qty: int, eta: Optional[date]):
         self.reference = ref
         self.sku = sku
         self.eta = eta
         self._purchased_quantity = qty
-        self._allocations = set()  # type: Set[OrderLine]
+        self._allocations: Set[OrderLine] = set()
+        self._allocated_quantity: Optional[int] = 0
 
     def allocate(self, line: OrderLine):
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self._allocations:
             self._allocations.add(line)
+            self._allocated_quantity = self.allocated_quantity + line.qty
 
     def deallocate(self, line: OrderLine):
         if line in self._allocations:
+            self._allocated_quantity = self.allocated_quantity - line.qty
             self._allocations.remove(line)
+            if self._index is not None:
+                self._index.refresh(self)  # It has stock again
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        # Running total kept up to date by allocate() and deallocate(). SQLAlchemy
+        # does not call __init__ when it loads a Batch, so the orm resets it to None
+        # and it is rebuilt here once.
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(line.qty for line in self._allocations)
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
@@ -78,6 +92,107 @@ class Batch:
 #     pass
 
 
+class BatchIndex:
+    """
+    The batches of a Product in the order allocation prefers them: warehouse stock (no
+    ETA) first, then earliest ETA, with ties kept in the order the batches were added.
+    This is the same order `sorted(batches)` gives through Batch.__gt__, but kept up to
+    date as batches are added instead of being rebuilt for every order line.
+
+    A max segment tree over those positions holds each batch's available quantity, so
+    the first batch a line fits in is found in O(log n), skipping sold out batches and
+    batches too small for the line alike.
+
+    Notes:
+    ------
+
+    The tree is told about allocations through refresh(). A batch allocated behind its
+    back is corrected the first time first_fit() lands on it. Deallocating a line
+    refreshes the index holding the batch (Batch._index), in O(log n). Adding a batch
+    anywhere but after the last one rebuilds the tree, in O(n).
+    """
+
+    def __init__(self, batches: Iterable[Batch] = ()):
+        self._seq: Dict[Batch, int] = {}
+        for batch in batches:
+            self._seq.setdefault(batch, len(self._seq))
+        self._batches = sorted(self._seq, key=self._key)
+        self._keys = [self._key(batch) for batch in self._batches]
+        self._rebuild()
+
+    def __len__(self) -> int:
+        return len(self._batches)
+
+    def _key(self, batch: Batch) -> Tuple[bool, date, int]:
+        return (batch.eta is not None, batch.eta or date.min, self._seq[batch])
+
+    def _rebuild(self):
+        self._size = 1
+        while self._size < len(self._batches):
+            self._size *= 2
+        self._tree = [0] * (2 * self._size)  # Node n covers nodes 2n and 2n + 1
+        for i, batch in enumerate(self._batches):
+            self._tree[self._size + i] = batch.available_quantity
+        for node in range(self._size - 1, 0, -1):
+            self._tree[node] = max(self._tree[2 * node], self._tree[2 * node + 1])
+        self._position = {batch: i for i, batch in enumerate(self._batches)}
+        for batch in self._batches:
+            batch._index = self
+
+    def _set(self, i: int, available: int):
+        node = self._size + i
+        self._tree[node] = available
+        while node > 1:
+            node //= 2
+            self._tree[node] = max(self._tree[2 * node], self._tree[2 * node + 1])
+
+    def _leftmost(self, qty: int, start: int) -> Optional[int]:
+        """The first position from `start` on with at least `qty` available, if any"""
+        if start >= len(self._batches):
+            return None
+        node = self._size + start
+        while self._tree[node] < qty:
+            while node % 2 == 1:  # A right child: the next subtree is its parent's
+                node //= 2
+            if node == 0:
+                return None
+            node += 1
+        while node < self._size:
+            node = 2 * node if self._tree[2 * node] >= qty else 2 * node + 1
+        i = node - self._size
+        return i if i < len(self._batches) else None
+
+    def add(self, batch: Batch):
+        self._seq[batch] = len(self._seq)
+        key = self._key(batch)
+        i = bisect_left(self._keys, key)
+        self._keys.insert(i, key)
+        self._batches.insert(i, batch)
+        if i == len(self._batches) - 1 and i < self._size:
+            self._position[batch] = i
+            self._set(i, batch.available_quantity)
+            batch._index = self
+        else:
+            self._rebuild()
+
+    def refresh(self, batch: Batch):
+        """Records the batch's available quantity after an allocation or deallocation"""
+        self._set(self._position[batch], batch.available_quantity)
+
+    def first_fit(self, line: OrderLine) -> Optional[Batch]:
+        i = self._leftmost(line.qty, 0)
+        while i is not None:
+            batch = self._batches[i]
+            if batch.can_allocate(line):
+                return batch
+            if batch.available_quantity < line.qty:
+                self._set(i, batch.available_quantity)  # Allocated behind our back
+                i = self._leftmost(line.qty, i)
+            else:
+                i = self._leftmost(line.qty, i + 1)  # Another SKU's batch
+        return None
+
+
 # To be able to mantain invariants while escaling to concurrent operations
 # the Aggregate pattern is implemented.
 class Product:
@@ -85,19 +200,50 @@ class Product:
         self.sku = sku
         self.batches = batches  # This is a reference to a colection of batches
         self.version_number = version_number
-        self.events: list[Event] = []
+        self.events: Deque[Event] = deque()  # Drained in bulk by the unit of work
+        self._batch_index = None  # type: Optional[BatchIndex]
+
+    def add_batch(self, batch: Batch):
+        index = self._batches_by_eta()
+        self.batches.append(batch)
+        index.add(batch)
+        self.version_number += 1
+
+    def _batches_by_eta(self) -> BatchIndex:
+        # Built lazily: the orm resets it to None whenever SQLAlchemy (re)loads the
+        # product. Batches appended straight to self.batches (instead of add_batch)
+        # trigger a rebuild.
+        if self._batch_index is None or len(self._batch_index) != len(self.batches):
+            self._batch_index = BatchIndex(self.batches)
+        return self._batch_index
 
     # The function allocate now is a method of the new Aggregate class `Product`
     def allocate(self, line: OrderLine) -> Optional[str]:
-        try:
-            batch = next(b for b in sorted(self.batches) if b.can_allocate(line))
-            batch.allocate(line)
-            self.version_number += 1
-            return batch.reference
-        except StopIteration:
+        batchref = self._allocate(line)
+        if batchref is None:
             self.events.append(OutOfStock(line.sku))
             # raise OutOfStock(f"Out of stock for sku {line.sku}")
+        return batchref
+
+    def allocate_many(self, lines: Iterable[OrderLine]) -> List[Optional[str]]:
+        """
+        Allocates the lines in arrival order. Lines that cannot be allocated get None,
+        and a single OutOfStock event is recorded for the whole lot.
+        """
+        batchrefs = [self._allocate(line) for line in lines]
+        if None in batchrefs:
+            self.events.append(OutOfStock(self.sku))
+        return batchrefs
+
+    def _allocate(self, line: OrderLine) -> Optional[str]:
+        index = self._batches_by_eta()
+        batch = index.first_fit(line)
+        if batch is None:
             return None
+        batch.allocate(line)
+        index.refresh(batch)
+        self.version_number += 1
+        return batch.reference
 
 
 # def allocate(line: OrderLine, batches: List[Batch]) -> str:
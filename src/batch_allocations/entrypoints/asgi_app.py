@@ -0,0 +1,273 @@
+"""
+The API on asyncio (ASGI), alongside flask_app.py
+
+Same routes and responses as the Flask app for allocating and adding batches, but a
+request waiting on the database is a suspended coroutine instead of a blocked thread, so
+one process keeps thousands of allocations in flight. The domain model, the message bus
+and the outbox are the ones the Flask app uses; only the unit of work
+(AsyncSqlAlchemyUnitOfWork) and the services (service_layer/async_services.py) are
+async.
+
+It is a plain ASGI application, any ASGI server runs it (the `async` extra installs the
+database drivers and uvicorn):
+
+    uvicorn --factory batch_allocations.entrypoints.asgi_app:create_app --port 5006
+    python -m batch_allocations.entrypoints.asgi_app  # Same, and creates the schema
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import asyncio
+import atexit
+import json
+import os
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+# Domain Model Modules
+# --------------------
+from ..adapters.database import dispose_async_engines, get_async_engine, get_engine
+from ..adapters.migrations import upgrade
+from ..adapters.orm import start_mappers
+from ..adapters.sku_index import SkuIndex
+from ..config import (
+    get_debounce_window,
+    get_messagebus_options,
+    get_outbox_options,
+    get_sku_index_options,
+)
+from ..service_layer import async_services
+from ..service_layer.messagebus import (
+    configure_coalescing,
+    start_async_dispatch,
+    stop_async_dispatch,
+)
+from ..service_layer.outbox import OutboxDispatcher
+from ..service_layer.services import InvalidSku
+from ..service_layer.unit_of_work import (
+    AsyncSqlAlchemyUnitOfWork,
+    ConcurrentUpdateError,
+)
+
+# Constants
+# ---------
+
+MAX_BODY_BYTES = 1024 * 1024
+
+Response = Tuple[int, Dict[str, Any]]
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+class BadRequestError(Exception):
+    pass
+
+
+class AsgiApp:
+    """
+    The ASGI callable. Built by create_app().
+
+    Attributes:
+    ----------
+
+    db_uri : Optional[str]
+        The database, as a sync URI (adapters/database.async_uri picks the driver).
+    use_outbox : bool
+        Write events to the outbox table instead of dispatching them (OUTBOX_MODE).
+    sku_index : Optional[SkuIndex]
+        Warmed by the first request.
+
+    Notes:
+    ------
+
+    The ProductCache and the AllocationCoalescer (PRODUCT_CACHE_ENTRIES,
+    ALLOCATE_COALESCE_MS) are thread based and only used by the Flask app.
+    """
+
+    def __init__(
+        self,
+        db_uri: Optional[str] = None,
+        use_outbox: bool = False,
+        sku_index: Optional[SkuIndex] = None,
+    ):
+        self.db_uri = db_uri
+        self.use_outbox = use_outbox
+        self.sku_index = sku_index
+        self.routes: Dict[Tuple[str, str], Callable[[Dict], Awaitable[Response]]] = {
+            ("GET", "/"): self.home,
+            ("POST", "/allocate"): self.allocate,
+            ("POST", "/add_batch"): self.add_batch,
+        }
+        self._session_factory = None  # type: Optional[async_sessionmaker]
+        self._lock = asyncio.Lock()
+
+    async def session_factory(self) -> async_sessionmaker:
+        if self._session_factory is None:
+            async with self._lock:
+                if self._session_factory is None:
+                    engine = get_async_engine(self.db_uri)
+                    if self.sku_index is not None:
+                        async with engine.connect() as conn:
+                            await conn.run_sync(self.sku_index.warm)
+                    self._session_factory = async_sessionmaker(
+                        bind=engine, expire_on_commit=False
+                    )
+        return self._session_factory
+
+    async def new_uow(self) -> AsyncSqlAlchemyUnitOfWork:
+        return AsyncSqlAlchemyUnitOfWork(
+            session_factory=await self.session_factory(),
+            use_outbox=self.use_outbox,
+            sku_index=self.sku_index,
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            status, body = await self.handle(scope, receive)
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": status,
+                    "headers": [(b"content-type", b"application/json")],
+                }
+            )
+            await send(
+                {"type": "http.response.body", "body": json.dumps(body).encode()}
+            )
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await dispose_async_engines()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def handle(self, scope, receive) -> Response:
+        route = self.routes.get((scope["method"], scope["path"]))
+        if route is None:
+            if any(path == scope["path"] for _, path in self.routes):
+                return 405, {"message": "Method not allowed"}
+            return 404, {"message": "Not found"}
+        try:
+            return await route(
+                await read_json(receive) if scope["method"] == "POST" else {}
+            )
+        except BadRequestError as e:
+            return 400, {"message": str(e)}
+        except ConcurrentUpdateError:
+            # The service already retried; tell the client to try again later
+            return 409, {"message": "Too many concurrent updates, try again"}
+
+    async def home(self, body: Dict) -> Response:
+        """Root endpoint"""
+        return 200, {
+            "service": "Batch Allocation API",
+            "version": "1.0.0",
+            "status": "running",
+        }
+
+    async def allocate(self, body: Dict) -> Response:
+        """Allocate an order line to a batch (see flask_app.allocate_endpoint)"""
+        orderid, sku, qty = required(body, "orderid", "sku", "qty")
+        try:
+            batchref = await async_services.allocate(
+                orderid, sku, qty, await self.new_uow()
+            )
+        except InvalidSku as e:
+            return 400, {"message": str(e)}
+        return 201, {"message": "Order Allocated", "batchref": batchref}
+
+    async def add_batch(self, body: Dict) -> Response:
+        ref, sku, qty = required(body, "ref", "sku", "qty")
+        eta = body.get("eta")
+        if eta:
+            eta = datetime.fromisoformat(eta).date()
+        if self.sku_index is not None:  # The product may be new to this process only
+            self.sku_index.forget(sku)
+        await async_services.add_batch(ref, sku, qty, eta, await self.new_uow())
+        return 201, {"message": "Batch commited"}
+
+
+async def read_json(receive) -> Dict:
+    """The request body, which must be a JSON object"""
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            raise BadRequestError("Request body too large")
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            break
+    try:
+        body = json.loads(b"".join(chunks))
+    except ValueError as e:
+        raise BadRequestError("Request body is not JSON") from e
+    if not isinstance(body, dict):
+        raise BadRequestError("Request body is not a JSON object")
+    return body
+
+
+def required(body: Dict, *fields: str) -> Tuple:
+    missing = [field for field in fields if field not in body]
+    if missing:
+        raise BadRequestError(f"Missing {', '.join(missing)}")
+    return tuple(body[field] for field in fields)
+
+
+def create_app(config: Optional[Mapping[str, Any]] = None) -> AsgiApp:
+    """
+    Builds the ASGI app, configured like flask_app.create_app():
+
+        DB_URI: the database (default: config.get_postgres_uri())
+        CREATE_SCHEMA: create missing tables and indexes (default: off;
+            DB_CREATE_SCHEMA=1 enables it)
+    """
+    options = dict(
+        DB_URI=None,
+        CREATE_SCHEMA=os.environ.get("DB_CREATE_SCHEMA", "0") == "1",
+    )  # type: Dict[str, Any]
+    options.update(config or {})
+
+    start_mappers()  # No-op if already done
+    configure_coalescing(get_debounce_window())
+
+    messagebus_options = get_messagebus_options()
+    if messagebus_options is not None:
+        start_async_dispatch(**messagebus_options)
+        atexit.register(stop_async_dispatch)
+
+    outbox_options = get_outbox_options()
+    sku_index_options = get_sku_index_options()
+    app = AsgiApp(
+        options["DB_URI"],
+        use_outbox=outbox_options is not None,
+        sku_index=None if sku_index_options is None else SkuIndex(**sku_index_options),
+    )
+    if outbox_options is not None and outbox_options.pop("mode") == "thread":
+        # The dispatcher is synchronous: it polls the shared sync engine, in its thread
+        outbox_dispatcher = OutboxDispatcher(
+            get_engine(options["DB_URI"]), **outbox_options
+        ).start()
+        atexit.register(outbox_dispatcher.stop)
+
+    if options["CREATE_SCHEMA"]:
+        upgrade(get_engine(options["DB_URI"]))
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn  # type: ignore[import-not-found]
+
+    uvicorn.run(create_app({"CREATE_SCHEMA": True}), host="0.0.0.0", port=5006)
@@ -1,42 +1,284 @@
 """
 This module is the API
+
+create_app() builds it. Nothing touches the database until the first request (or the
+opt-in schema creation), so importing this module, and starting a worker, is cheap:
+
+    flask --app batch_allocations.entrypoints.flask_app run  # Finds create_app()
+    flask --app batch_allocations.entrypoints.flask_app init-db  # Creates the schema
+    python -m batch_allocations.entrypoints.flask_app  # Dev server, creates the schema
 """
 
 # Boilerplate Modules
 # -------------------
 
-from flask import Flask, request, jsonify, send_from_directory
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-
+import atexit
+import json
+import logging
 import os
+import threading
 from datetime import datetime
+from typing import TYPE_CHECKING, Any, List, Mapping, Optional
+
+from flask import (
+    Blueprint,
+    Flask,
+    Response,
+    current_app,
+    g,
+    request,
+    send_from_directory,
+    stream_with_context,
+)
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
 
 # Domain Model Modules
 # --------------------
+from ..adapters import metrics
+from ..adapters.cache import ProductCache
+from ..adapters.database import get_engine, get_pool_metrics
+from ..adapters.instrumentation import QueryStats
+from ..adapters.memory_store import ProductStore
+from ..adapters.migrations import upgrade
+from ..adapters.orm import start_mappers
+from ..adapters.sku_index import SkuIndex
+from ..config import (
+    get_allocation_coalescing_options,
+    get_debounce_window,
+    get_memory_store_options,
+    get_messagebus_options,
+    get_outbox_options,
+    get_product_cache_options,
+    get_shard_map_path,
+    get_sku_index_options,
+)
+from ..service_layer.coalescer import AllocationCoalescer
+from ..service_layer.messagebus import (
+    configure_coalescing,
+    start_async_dispatch,
+    stop_async_dispatch,
+)
+from ..service_layer.outbox import OutboxDispatcher
+from ..service_layer.services import InvalidSku, add_batch, allocate, allocate_stream
+from ..service_layer.unit_of_work import (
+    ConcurrentUpdateError,
+    InMemoryUnitOfWork,
+    ShardedUnitOfWork,
+    SqlAlchemyUnitOfWork,
+    UnitOfWorkProtocol,
+)
+
+# Sharding is optional: adapters.shards is only imported once a shard map is used
+if TYPE_CHECKING:
+    from ..adapters.shards import ShardMap
 
-from ..config import get_postgres_uri
-from ..domain.model import OrderLine
-from ..domain.events import OutOfStock
-from ..adapters.orm import start_mappers, metadata
-from ..adapters.repository import SqlAlchemyRepository
-from ..service_layer.services import allocate, add_batch, InvalidSku
-from ..service_layer.unit_of_work import DEFAULT_SESSION_FACTORY, SqlAlchemyUnitOfWork
-from ..domain.model import Batch
+# Constants
+# ---------
+
+logger = logging.getLogger(__name__)
 
 # Functions and Class Definitions/Declarations
 # --------------------------------------------
 
-# Initialize database
-engine = create_engine(get_postgres_uri())
-metadata.create_all(engine)
-start_mappers()
-get_session = sessionmaker(bind=engine)
 
-app = Flask(__name__)
+class AppState:
+    """
+    What the routes share, one per app (current_app.extensions["batch_allocations"]).
+
+    The engine and session factory are created by the first unit of work, and the SKU
+    index is warmed then too. With a `store` the units of work use it instead of the
+    database, and with a `shard_map` they go to the shard of their SKU.
+    """
+
+    def __init__(
+        self,
+        db_uri: Optional[str],  # None: config.get_postgres_uri()
+        use_outbox: bool = False,
+        product_cache: Optional[ProductCache] = None,
+        sku_index: Optional[SkuIndex] = None,
+        store: Optional[ProductStore] = None,
+        shard_map: Optional["ShardMap"] = None,
+    ):
+        self.db_uri = db_uri
+        self.store = store
+        self.shard_map = shard_map
+        self.use_outbox = use_outbox
+        self.product_cache = product_cache
+        self.sku_index = sku_index
+        self.coalescer = None  # type: Optional[AllocationCoalescer]
+        self._session_factory = None  # type: Optional[sessionmaker]
+        self._lock = threading.Lock()
+
+    @property
+    def engine(self) -> Engine:
+        return get_engine(self.db_uri)
+
+    def session_factory(self) -> sessionmaker:
+        if self._session_factory is None:
+            with self._lock:
+                if self._session_factory is None:
+                    if self.sku_index is not None:
+                        with self.engine.connect() as conn:
+                            self.sku_index.warm(conn)
+                    self._session_factory = sessionmaker(bind=self.engine)
+        return self._session_factory
+
+    def upgrade_schema(self) -> List[str]:
+        """migrations.upgrade() on the database, or on every shard"""
+        if self.shard_map is None:
+            return upgrade(self.engine)
+        from ..adapters.shards import upgrade_shards
+
+        created = upgrade_shards(self.shard_map)
+        return [name for names in created.values() for name in names]
+
+    def new_uow(self) -> UnitOfWorkProtocol:
+        if self.store is not None:
+            return InMemoryUnitOfWork(self.store)
+        if self.shard_map is not None:
+            return ShardedUnitOfWork(self.shard_map, use_outbox=self.use_outbox)
+        return SqlAlchemyUnitOfWork(
+            session_factory=self.session_factory(),
+            use_outbox=self.use_outbox,
+            cache=self.product_cache,
+            sku_index=self.sku_index,
+        )
+
+
+def create_app(config: Optional[Mapping[str, Any]] = None) -> Flask:
+    """
+    Builds the API. `config` overrides the Flask config, which defaults to the
+    environment (see config.py):
+
+        DB_URI: the database (default: config.get_postgres_uri())
+        CREATE_SCHEMA: create missing tables and indexes (default: off;
+            DB_CREATE_SCHEMA=1 enables it)
+        MEMORY_STORE_DIR: keep the products in memory, logged to this directory,
+            instead of in the database (adapters/memory_store.py, default:
+            MEMORY_STORE_DIR)
+        SHARD_MAP: spread the SKUs over the databases of this shard map file instead of
+            DB_URI (adapters/shards.py, default: SHARD_MAP)
+    """
+    app = Flask(__name__)
+    app.config.update(
+        DB_URI=None,
+        CREATE_SCHEMA=os.environ.get("DB_CREATE_SCHEMA", "0") == "1",
+        MEMORY_STORE_DIR=os.environ.get("MEMORY_STORE_DIR"),
+        SHARD_MAP=get_shard_map_path(),
+    )
+    app.config.update(config or {})
+
+    start_mappers()  # No-op if already done
+    configure_coalescing(get_debounce_window())
+
+    # Handle events off the request path if configured (MESSAGEBUS_MODE=async)
+    messagebus_options = get_messagebus_options()
+    if messagebus_options is not None:
+        start_async_dispatch(**messagebus_options)
+        atexit.register(stop_async_dispatch)  # Drain queued events on shutdown
+
+    # Write events to the outbox table instead of dispatching them
+    # (OUTBOX_MODE=thread|external)
+    outbox_options = get_outbox_options()
+    product_cache_options = get_product_cache_options()
+    sku_index_options = get_sku_index_options()
+    state = AppState(
+        app.config["DB_URI"],
+        use_outbox=outbox_options is not None,
+        # Shared by every request's unit of work (PRODUCT_CACHE_ENTRIES)
+        product_cache=(
+            None
+            if product_cache_options is None
+            else ProductCache(**product_cache_options)
+        ),
+        # Turns away unknown SKUs without a query (SKU_NEGATIVE_TTL)
+        sku_index=None if sku_index_options is None else SkuIndex(**sku_index_options),
+    )
+    if app.config["MEMORY_STORE_DIR"]:
+        # Recovers the products from the directory's snapshot and log now
+        state.store = ProductStore(
+            app.config["MEMORY_STORE_DIR"], **get_memory_store_options()
+        )
+        atexit.register(state.store.close)
+    if app.config["SHARD_MAP"]:
+        from ..adapters.shards import ShardMap
+
+        state.shard_map = ShardMap.load(app.config["SHARD_MAP"])
+    if outbox_options is not None and outbox_options.pop("mode") == "thread":
+        outbox_dispatcher = OutboxDispatcher(state.engine, **outbox_options).start()
+        atexit.register(outbox_dispatcher.stop)
+
+    # Allocate concurrent requests for the same SKU together (ALLOCATE_COALESCE_MS)
+    coalescing_options = get_allocation_coalescing_options()
+    if coalescing_options is not None:
+        state.coalescer = AllocationCoalescer(state.new_uow, **coalescing_options)
+
+    app.extensions["batch_allocations"] = state
+    app.register_blueprint(api)
+
+    @app.cli.command("init-db")
+    def init_db():
+        """Creates missing tables and indexes"""
+        for name in state.upgrade_schema():
+            print(f"created index {name}")
+
+    if app.config["CREATE_SCHEMA"]:
+        # create_all plus any index added since the tables were created
+        state.upgrade_schema()
+
+    return app
 
 
-@app.route("/")
+def app_state() -> AppState:
+    return current_app.extensions["batch_allocations"]
+
+
+api = Blueprint("api", __name__)
+
+
+@api.before_app_request
+def start_query_stats():
+    # Every unit of work of the request adds its figures to this one
+    g.query_stats = QueryStats().__enter__()
+
+
+@api.after_app_request
+def report_query_stats(response):
+    """
+    Statements, rows and timings of the request's units of work
+    (adapters/instrumentation.py) as response headers, and as a structured DEBUG log
+    line. A streamed response only reports what happened before it started streaming.
+    """
+    stats = g.get("query_stats")
+    if stats is None:
+        return response
+    response.headers["X-Query-Count"] = str(stats.statements)
+    response.headers["X-Rows-Loaded"] = str(stats.rows)
+    response.headers["Server-Timing"] = stats.server_timing()
+    logger.debug(
+        "%s %s query stats",
+        request.method,
+        request.path,
+        extra=dict(query_stats=stats.as_dict()),
+    )
+    return response
+
+
+@api.teardown_app_request
+def stop_query_stats(exc):
+    stats = g.pop("query_stats", None)
+    if stats is not None:
+        stats.__exit__(None, None, None)
+
+
+@api.app_errorhandler(ConcurrentUpdateError)
+def concurrent_update(e):
+    """The service already retried; tell the client to try again later"""
+    return {"message": "Too many concurrent updates, try again"}, 409
+
+
+@api.route("/")
 def home():
     """Root endpoint"""
     return {
@@ -46,13 +288,28 @@ def home():
     }, 200
 
 
-@app.route("/ui")
+@api.route("/metrics")
+def metrics_endpoint():
+    """Prometheus text format: service latencies, allocation outcomes, UoW counts..."""
+    return Response(
+        metrics.registry.render(), mimetype="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@api.route("/stats/pool")
+def pool_stats():
+    """Connection pool counters and state, to size DB_POOL_SIZE/DB_MAX_OVERFLOW"""
+    state = app_state()
+    return get_pool_metrics(state.db_uri).snapshot(state.engine), 200
+
+
+@api.route("/ui")
 def ui():
     """Serve HTML interface"""
     return send_from_directory("static", "index.html")
 
 
-@app.route("/allocate", methods=["POST"])
+@api.route("/allocate", methods=["POST"])
 def allocate_endpoint():
     """
     Allocate an order line to a batch.
@@ -69,23 +326,62 @@ def allocate_endpoint():
     sku = request.json["sku"]
     qty = request.json["qty"]
 
-    uow = SqlAlchemyUnitOfWork(session_factory=get_session)
-
+    state = app_state()
     try:
-        batchref = allocate(orderid, sku, qty, uow)
+        if state.coalescer is None:
+            batchref = allocate(orderid, sku, qty, state.new_uow())
+        else:
+            batchref = state.coalescer.allocate(orderid, sku, qty)
     except InvalidSku as e:
         return {"message": str(e)}, 400
     return {"message": "Order Allocated", "batchref": batchref}, 201
 
 
-@app.route("/add_batch", methods=["POST"])
+def read_ndjson(stream):
+    """Yields one dict per line of the request body (None for a line that isn't JSON)"""
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None  # Reported by allocate_stream as an invalid line
+
+
+@api.route("/allocate/bulk", methods=["POST"])
+def allocate_bulk_endpoint():
+    """
+    Allocates a stream of order lines, one JSON object per line (NDJSON):
+
+        {"orderid": "order-123", "sku": "BLUE-CHAIR", "qty": 10}
+
+    The response is NDJSON too, one result per line in the same order, sent as the lines
+    are allocated `chunk_size` (query parameter, 500 by default) at a time. Neither side
+    needs to hold the whole stream. See services.allocate_stream() for the result
+    fields.
+    """
+    chunk_size = min(max(request.args.get("chunk_size", 500, type=int), 1), 5000)
+
+    uow = app_state().new_uow()
+
+    def results():
+        for result in allocate_stream(read_ndjson(request.stream), uow, chunk_size):
+            yield json.dumps(result) + "\n"
+
+    return Response(stream_with_context(results()), mimetype="application/x-ndjson")
+
+
+@api.route("/add_batch", methods=["POST"])
 def add_batch_endpoint():
 
     eta = request.json.get("eta")
     if eta:
         eta = datetime.fromisoformat(eta).date()
 
-    uow = SqlAlchemyUnitOfWork(session_factory=get_session)
+    state = app_state()
+    if state.sku_index is not None:  # The product may be new to this process only
+        state.sku_index.forget(request.json["sku"])
+    uow = state.new_uow()
 
     add_batch(
         request.json["ref"],
@@ -100,4 +396,6 @@ def add_batch_endpoint():
 
 if __name__ == "__main__":
     is_test = os.environ.get("ENV") == "test"
-    app.run(debug=not is_test, host="0.0.0.0", port=5005)
+    create_app({"CREATE_SCHEMA": True}).run(
+        debug=not is_test, host="0.0.0.0", port=5005
+    )
@@ -0,0 +1,92 @@
+"""
+Command line entry point to load batches from a CSV or NDJSON file:
+
+    python -m batch_allocations.entrypoints.ingest shipments.csv
+
+Both formats carry the /add_batch fields: ref, sku, qty and an optional ISO eta. CSV
+files need a header row. "-" reads standard input (give --format).
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import argparse
+import csv
+import json
+import sys
+from typing import IO, Dict, Iterator
+
+# Domain Model Modules
+# --------------------
+from ..adapters.database import dispose_engines, get_engine
+from ..service_layer.ingest import IngestReport, InvalidBatchRowError, ingest_batches
+
+# Helper Functions
+# ----------------
+
+
+def read_csv(file: IO[str]) -> Iterator[Dict]:
+    yield from csv.DictReader(file)
+
+
+def read_ndjson(file: IO[str]) -> Iterator[Dict]:
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+READERS = {"csv": read_csv, "ndjson": read_ndjson}
+
+
+def guess_format(path: str) -> str:
+    return "ndjson" if path.endswith((".ndjson", ".jsonl")) else "csv"
+
+
+def print_progress(report: IngestReport):
+    print(
+        f"{report.rows} rows, {report.rows_per_second:,.0f} rows/s",
+        file=sys.stderr,
+    )
+
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Load batches from a CSV/NDJSON file")
+    parser.add_argument("path", help='file to load, or "-" for standard input')
+    parser.add_argument("--format", choices=sorted(READERS))
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--db-uri", help="defaults to the app's database")
+    parser.add_argument("--quiet", action="store_true", help="no progress lines")
+    args = parser.parse_args(argv)
+
+    engine = get_engine(args.db_uri)
+    read = READERS[args.format or guess_format(args.path)]
+    file = sys.stdin if args.path == "-" else open(args.path, newline="")
+    try:
+        report = ingest_batches(
+            read(file),
+            engine,
+            chunk_size=args.chunk_size,
+            progress=None if args.quiet else print_progress,
+        )
+    except (InvalidBatchRowError, json.JSONDecodeError) as e:
+        print(f"Invalid input: {e}", file=sys.stderr)
+        return 1
+    finally:
+        if file is not sys.stdin:
+            file.close()
+        dispose_engines()
+
+    print(
+        f"Loaded {report.inserted} batches ({report.skipped} already there) from"
+        f" {report.rows} rows in {report.seconds:.2f}s,"
+        f" {report.rows_per_second:,.0f} rows/s"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
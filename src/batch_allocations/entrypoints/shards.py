@@ -0,0 +1,139 @@
+"""
+Command line entry point to manage the shards of a shard map (adapters/shards.py):
+
+    python -m batch_allocations.entrypoints.shards init --shard a=... --shard b=...
+    python -m batch_allocations.entrypoints.shards status
+    python -m batch_allocations.entrypoints.shards move RED-LAMP b
+    python -m batch_allocations.entrypoints.shards add-shard c postgresql://...
+    python -m batch_allocations.entrypoints.shards rebalance --limit 1000
+    python -m batch_allocations.entrypoints.shards purge-strays
+
+The map file is --map, or SHARD_MAP. Processes using the map pick up its changes on
+their next unit of work.
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import argparse
+import os
+import sys
+
+# Domain Model Modules
+# --------------------
+from ..adapters.database import dispose_engines
+from ..adapters.shards import (
+    ShardMap,
+    add_shard,
+    move_sku,
+    purge_strays,
+    rebalance,
+    skus_on,
+    strays,
+    upgrade_shards,
+)
+from ..config import get_shard_map_path
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+def init(args) -> int:
+    if os.path.exists(args.map):
+        print(f"{args.map} already exists", file=sys.stderr)
+        return 1
+    shards = dict(shard.split("=", 1) for shard in args.shard)
+    shard_map = ShardMap(shards)
+    upgrade_shards(shard_map)
+    shard_map.save(args.map)
+    print(f"Created {args.map} with shards {', '.join(sorted(shards))}")
+    return 0
+
+
+def status(args) -> int:
+    shard_map = ShardMap.load(args.map)
+    misplaced = strays(shard_map)
+    for shard, uri in sorted(shard_map.shards.items()):
+        skus = sum(1 for _ in skus_on(shard_map, shard))
+        pinned = sum(1 for s in shard_map.overrides.values() if s == shard)
+        print(
+            f"{shard}: {skus} SKUs, {pinned} pinned, {len(misplaced[shard])} strays"
+            f"  ({uri})"
+        )
+    return 0
+
+
+def move(args) -> int:
+    shard_map = ShardMap.load(args.map)
+    try:
+        moved = move_sku(shard_map, args.sku, args.shard)
+    except (KeyError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    print(f"Moved {args.sku} to {args.shard}" if moved else "Nothing to move")
+    return 0
+
+
+def add(args) -> int:
+    shard_map = ShardMap.load(args.map)
+    pinned = add_shard(shard_map, args.name, args.uri)
+    print(f"Added {args.name}; {len(pinned)} SKUs to move there with rebalance")
+    return 0
+
+
+def rebalance_command(args) -> int:
+    shard_map = ShardMap.load(args.map)
+    moved = rebalance(shard_map, args.limit)
+    print(f"Moved {len(moved)} SKUs, {len(shard_map.overrides)} still pinned")
+    return 0
+
+
+def purge(args) -> int:
+    shard_map = ShardMap.load(args.map)
+    purged = purge_strays(shard_map)
+    kept = strays(shard_map)
+    print(
+        f"Deleted {sum(len(skus) for skus in purged.values())} stray SKUs, kept"
+        f" {sum(len(skus) for skus in kept.values())} holding allocations of their own"
+    )
+    return 1 if any(kept.values()) else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Manage the shards of a shard map")
+    parser.add_argument(
+        "--map", default=get_shard_map_path(), help="defaults to SHARD_MAP"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("init", help="create the map and the shards' schema")
+    command.add_argument(
+        "--shard", action="append", required=True, help="NAME=URI, repeated"
+    )
+    command.set_defaults(run=init)
+    command = commands.add_parser("status", help="SKUs per shard")
+    command.set_defaults(run=status)
+    command = commands.add_parser("move", help="move a SKU to another shard")
+    command.add_argument("sku")
+    command.add_argument("shard")
+    command.set_defaults(run=move)
+    command = commands.add_parser("add-shard", help="add a shard, moving nothing yet")
+    command.add_argument("name")
+    command.add_argument("uri")
+    command.set_defaults(run=add)
+    command = commands.add_parser("rebalance", help="move pinned SKUs to their shard")
+    command.add_argument("--limit", type=int, help="at most this many SKUs")
+    command.set_defaults(run=rebalance_command)
+    command = commands.add_parser("purge-strays", help="delete interrupted moves' rows")
+    command.set_defaults(run=purge)
+    args = parser.parse_args(argv)
+
+    if not args.map:
+        parser.error("no shard map: give --map or set SHARD_MAP")
+    try:
+        return args.run(args)
+    finally:
+        dispose_engines()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""
+The services of services.py for asyncio callers (entrypoints/asgi_app.py), on an
+AsyncUnitOfWorkProtocol.
+
+Only the waiting on the database is awaited: the allocation itself is the same
+synchronous domain code (Product.allocate, Product.add_batch), and the events go through
+the same message bus.
+"""
+
+# Boilerplate Modules
+# -------------------
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from datetime import date
+from functools import wraps
+from itertools import count
+from typing import Awaitable, Callable, Optional, TypeVar
+
+# Domain Model Modules
+# --------------------
+from ..adapters import metrics
+from ..adapters.instrumentation import timed
+from ..domain import model
+from ..domain.model import OrderLine
+from ..service_layer.services import (
+    ALLOCATED,
+    INVALID_SKU,
+    OUT_OF_STOCK,
+    InvalidSku,
+    latency,
+    retry_delay,
+)
+from ..service_layer.unit_of_work import AsyncUnitOfWorkProtocol, ConcurrentUpdateError
+
+logger = logging.getLogger(__name__)
+
+# Constants
+# ---------
+
+T = TypeVar("T")
+
+# Helper Functions
+# ----------------
+
+
+def retry_on_conflict(
+    service: Callable[..., Awaitable[T]],
+) -> Callable[..., Awaitable[T]]:
+    """services.retry_on_conflict, backing off with asyncio.sleep instead of blocking"""
+
+    @wraps(service)
+    async def wrapper(*args, **kwargs) -> T:
+        for attempt in count(1):
+            try:
+                return await service(*args, **kwargs)
+            except ConcurrentUpdateError:
+                delay = retry_delay(service, attempt)
+                if delay is None:
+                    raise
+                logger.debug(
+                    "%s: concurrent update, retry %d", service.__name__, attempt
+                )
+                await asyncio.sleep(delay)
+        raise AssertionError("unreachable")
+
+    return wrapper
+
+
+def observed(
+    service: Callable[..., Awaitable[T]],
+) -> Callable[..., Awaitable[T]]:
+    """services.observed for coroutines"""
+
+    @wraps(service)
+    async def wrapper(*args, **kwargs) -> T:
+        with latency(service):
+            return await service(*args, **kwargs)
+
+    return wrapper
+
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+@observed
+@retry_on_conflict
+async def allocate(
+    orderid: str,
+    sku: str,
+    qty: int,
+    uow: AsyncUnitOfWorkProtocol,
+) -> Optional[str]:
+    line = OrderLine(orderid, sku, qty)
+    async with uow:
+        product = await uow.products.get(sku=line.sku)
+        if product is None:
+            metrics.allocations.inc(INVALID_SKU)
+            raise InvalidSku(f"Invalid sku {line.sku}")
+        with timed("allocate_seconds"):
+            batchref = product.allocate(line)
+        await uow.commit()
+    metrics.allocations.inc(ALLOCATED if batchref else OUT_OF_STOCK)
+    return batchref
+
+
+@observed
+@retry_on_conflict
+async def add_batch(
+    ref: str,
+    sku: str,
+    qty: int,
+    eta: Optional[date],
+    uow: AsyncUnitOfWorkProtocol,
+):
+    async with uow:
+        product = await uow.products.get(sku=sku)
+        if product is None:
+            product = model.Product(sku, batches=[])
+            uow.products.add(product)
+        product.add_batch(model.Batch(ref, sku, qty, eta))
+        await uow.commit()
@@ -0,0 +1,125 @@
+"""
+Micro-batching of allocate requests for the same SKU.
+
+Concurrent requests for one hot SKU each load the same Product and race to bump its
+version; most lose and retry. An AllocationCoalescer makes the first request for a SKU
+wait a few milliseconds for the others, then allocates all of them in one unit of work
+(services.allocate_sku: one load, one commit, in arrival order) and hands every caller
+its own batchref.
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Domain Model Modules
+# --------------------
+from ..service_layer import services
+from ..service_layer.unit_of_work import UnitOfWorkProtocol
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+class _Group:
+    """Requests for one SKU waiting to be allocated together"""
+
+    def __init__(self):
+        self.lines: List[Tuple[str, int]] = []  # (orderid, qty)
+        self.futures: List[Future] = []
+        self.full = threading.Event()
+
+
+class AllocationCoalescer:
+    """
+    Drop-in for services.allocate() that coalesces concurrent calls per SKU.
+
+    Attributes:
+    ----------
+
+    uow_factory : Callable[[], UnitOfWorkProtocol]
+        A new unit of work per group.
+    window : float
+        Seconds the first request of a group waits for more. This is the latency a lone
+        request pays.
+    max_batch : int
+        A group that reaches this many requests is allocated right away.
+    batches, coalesced : int
+        Units of work run, and requests that shared one with an earlier request.
+
+    Notes:
+    ------
+
+    There is no background thread: the first request of a group (its leader) runs the
+    unit of work, and the others block until it is done. InvalidSku, or
+    ConcurrentUpdateError once services.retry_on_conflict gives up, is raised to every
+    caller of the group.
+    """
+
+    def __init__(
+        self,
+        uow_factory: Callable[[], UnitOfWorkProtocol],
+        window: float = 0.005,
+        max_batch: int = 100,
+    ):
+        self.uow_factory = uow_factory
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.coalesced = 0
+        self._groups: Dict[str, _Group] = {}
+        self._lock = threading.Lock()
+
+    def allocate(self, orderid: str, sku: str, qty: int) -> Optional[str]:
+        # Each request's latency, the wait included, is still allocate()'s: dashboards
+        # keep working with coalescing on. The group's unit of work is allocate_sku()'s
+        with services.latency(services.allocate):
+            return self._allocate(orderid, sku, qty)
+
+    def _allocate(self, orderid: str, sku: str, qty: int) -> Optional[str]:
+        future: Future = Future()
+        with self._lock:
+            group = self._groups.get(sku)
+            leader = group is None
+            if group is None:
+                group = self._groups[sku] = _Group()
+            else:
+                self.coalesced += 1
+            group.lines.append((orderid, qty))
+            group.futures.append(future)
+            if len(group.lines) >= self.max_batch:
+                del self._groups[sku]  # Closed: the next request starts a new group
+                group.full.set()
+
+        if leader:
+            try:
+                group.full.wait(self.window)
+                self._close(sku, group)
+                self._run(sku, group)
+            except BaseException as e:  # KeyboardInterrupt, SystemExit in the leader
+                self._close(sku, group)
+                for other in group.futures:  # Or the followers wait forever
+                    if not other.done():
+                        other.set_exception(e)
+                raise
+        return future.result()
+
+    def _close(self, sku: str, group: _Group):
+        with self._lock:
+            if self._groups.get(sku) is group:
+                del self._groups[sku]
+
+    def _run(self, sku: str, group: _Group):
+        with self._lock:
+            self.batches += 1
+        try:
+            batchrefs = services.allocate_sku(sku, group.lines, self.uow_factory())
+        except Exception as e:
+            for future in group.futures:
+                future.set_exception(e)
+            return
+        for future, batchref in zip(group.futures, batchrefs, strict=True):
+            future.set_result(batchref)
@@ -0,0 +1,99 @@
+"""
+Bulk loading of batches (purchase orders, shipments) from files of many thousand rows.
+
+services.add_batch() costs a unit of work, a product load and a commit per batch. Here
+the rows are streamed in chunks, and each chunk is written with a few multi-row
+statements (COPY on Postgres) and committed on its own. Memory is bounded by the chunk
+size, whatever the size of the input, and a load that fails halfway can simply be run
+again: batches already written are skipped.
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import time
+from dataclasses import dataclass
+from datetime import date
+from typing import Callable, Dict, Iterable, Optional
+
+from sqlalchemy.engine import Engine
+
+# Domain Model Modules
+# --------------------
+from ..adapters.bulk import write_batches
+from ..adapters.sku_index import SkuIndex
+from ..service_layer.services import chunked
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+@dataclass
+class IngestReport:
+    rows: int = 0  # Read from the input
+    inserted: int = 0  # The rest were batches that already existed
+    seconds: float = 0.0
+
+    @property
+    def skipped(self) -> int:
+        return self.rows - self.inserted
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+class InvalidBatchRowError(ValueError):
+    pass
+
+
+def to_batch_row(record: Dict, line: int) -> Dict:
+    """A batch_stock row from a record with the /add_batch fields: ref, sku, qty, eta"""
+    try:
+        eta = record.get("eta") or None
+        qty = int(record["qty"])
+        row = dict(
+            reference=str(record["ref"]),
+            sku=str(record["sku"]),
+            _purchased_quantity=qty,
+            eta=None if eta is None else date.fromisoformat(eta),
+        )
+    except (KeyError, TypeError, ValueError) as e:
+        raise InvalidBatchRowError(f"line {line}: {e!r} in {record!r}") from e
+    if not row["reference"] or not row["sku"]:
+        raise InvalidBatchRowError(f"line {line}: empty ref or sku in {record!r}")
+    if qty < 1:
+        raise InvalidBatchRowError(f"line {line}: qty below 1 in {record!r}")
+    return row
+
+
+def ingest_batches(
+    records: Iterable[Dict],
+    engine: Engine,
+    chunk_size: int = 5000,
+    progress: Optional[Callable[[IngestReport], None]] = None,
+    sku_index: Optional[SkuIndex] = None,
+) -> IngestReport:
+    """
+    Writes the batches in `records` (ref, sku, qty, eta) in chunks of `chunk_size`, one
+    transaction each, calling `progress` after every chunk. An invalid record stops the
+    load with InvalidBatchRowError; the chunks before it stay committed.
+
+    The SKUs of each committed chunk are added to `sku_index`, the one of the units of
+    work running in this process, if any.
+    """
+    report = IngestReport()
+    started = time.perf_counter()
+    rows = (to_batch_row(record, line) for line, record in enumerate(records, 1))
+    for chunk in chunked(rows, chunk_size):
+        with engine.begin() as conn:
+            report.inserted += write_batches(conn, chunk)
+        if sku_index is not None:
+            for sku in {row["sku"] for row in chunk}:
+                sku_index.add(sku)
+        report.rows += len(chunk)
+        report.seconds = time.perf_counter() - started
+        if progress is not None:
+            progress(report)
+    report.seconds = time.perf_counter() - started
+    return report
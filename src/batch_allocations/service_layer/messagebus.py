@@ -1,19 +1,37 @@
 """
 The messagebus will map events to handlers.
+
+By default events are handled synchronously, right after the unit of work commits.
+Calling start_async_dispatch() hands them to a pool of worker threads instead, so slow
+handlers (like sending an email) no longer add their latency to the request that raised
+the event.
+
+Units of work publish() their events through a Coalescer first: identical events raised
+in the same unit of work are handled once, and notification events (OutOfStock) are
+debounced so a sellout sends one email per SKU per window instead of one per failed
+allocation.
 """
 
 # Boilerplate Modules
 # -------------------
 
-from typing import List, Dict, Callable, Type
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as HandlerTimeout
+from typing import Callable, Collection, Dict, Iterable, List, Optional, Type
 
 # Domain Model Modules
 # --------------------
-
+from ..adapters import metrics
 from ..domain.events import Event, OutOfStock
 
 # from ..adapters import email
 
+logger = logging.getLogger(__name__)
+
 # Helper Functions
 # ----------------
 
@@ -32,6 +50,272 @@ def handle(event: Event):
         handler(event)
 
 
+def publish(events: Iterable[Event]):
+    """Entry point for units of work: coalesces their events and dispatches them"""
+    for event in coalescer.coalesce(events):
+        dispatch(event)
+
+
+def dispatch(event: Event):
+    """Entry point for units of work: hands the event to the async dispatcher, if any"""
+    if _dispatcher is None:
+        handle(event)
+    else:
+        _dispatcher.submit(event)
+
+
+class AsyncDispatcher:
+    """
+    Handles events on worker threads fed by a bounded queue.
+
+    Attributes:
+    ----------
+
+    workers : int
+        Events handled concurrently.
+    queue_size : int
+        Events that can wait for a worker. When the queue is full submit() blocks for up
+        to `put_timeout` seconds (backpressure) and then handles the event in the
+        caller's thread, so events are never dropped.
+    handler_timeout : float
+        Seconds a worker waits for one handler before logging it and moving on to the
+        next. Python cannot kill the thread, so the handler keeps running in the
+        background.
+    handler_threads : int
+        Threads the handlers run on (default: twice `workers`).
+    hung : int
+        Handlers that timed out and are still running.
+
+    Notes:
+    ------
+
+    A handler that raises is logged and counted; the other handlers for the event and
+    the following events still run.
+
+    A handler that timed out keeps its thread until it returns. Once `handler_threads`
+    handlers hang, the handlers of every later event wait for a thread and time out
+    without running, so size `handler_threads` above the hangs you expect and watch
+    `hung`.
+    """
+
+    def __init__(
+        self,
+        workers: int = 4,
+        queue_size: int = 1000,
+        handler_timeout: float = 10.0,
+        put_timeout: float = 1.0,
+        handler_threads: Optional[int] = None,
+    ):
+        self.handler_timeout = handler_timeout
+        self.put_timeout = put_timeout
+        self.handler_threads = handler_threads or 2 * workers
+        self.errors = 0
+        self.timeouts = 0
+        self.handled_inline = 0
+        self.hung = 0
+        self._lock = threading.Lock()  # For the counters, updated by every worker
+        self._queue = queue.Queue(maxsize=queue_size)  # type: queue.Queue
+        self._handlers = ThreadPoolExecutor(
+            max_workers=self.handler_threads, thread_name_prefix="messagebus-handler"
+        )
+        self._workers = [
+            threading.Thread(target=self._work, name=f"messagebus-{n}", daemon=True)
+            for n in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, event: Event):
+        try:
+            self._queue.put(event, timeout=self.put_timeout)
+        except queue.Full:
+            logger.warning("messagebus queue full, handling %r inline", event)
+            with self._lock:
+                self.handled_inline += 1
+            self._handle(event)
+
+    def _work(self):
+        while True:
+            event = self._queue.get()
+            try:
+                if event is None:  # Sentinel from shutdown()
+                    return
+                self._handle(event)
+            finally:
+                self._queue.task_done()
+
+    def _handle(self, event: Event):
+        for handler in HANDLERS[type(event)]:
+            try:
+                future = self._handlers.submit(handler, event)
+            except RuntimeError:  # Stopped by shutdown() after its timeout
+                logger.warning("messagebus stopped, dropping %r", event)
+                return
+            try:
+                future.result(timeout=self.handler_timeout)
+            except HandlerTimeout:
+                with self._lock:
+                    self.timeouts += 1
+                    self.hung += 1
+                future.add_done_callback(self._returned)
+                logger.error("%s timed out handling %r", handler.__name__, event)
+            except Exception:
+                with self._lock:
+                    self.errors += 1
+                logger.exception("%s failed handling %r", handler.__name__, event)
+
+    def _returned(self, future):
+        """A handler that timed out has returned after all"""
+        with self._lock:
+            self.hung -= 1
+
+    def shutdown(self, drain: bool = True, timeout: Optional[float] = None):
+        """
+        Stops the workers. With `drain` the events already queued are handled first
+        (waiting at most `timeout` seconds); without it they are discarded.
+
+        Returns within `timeout` even if the workers are stuck and the queue is full:
+        the workers are daemon threads, left to die with the process, and the events
+        they had yet to handle are dropped.
+        """
+        if not drain:
+            try:
+                while True:
+                    self._queue.get_nowait()
+                    self._queue.task_done()
+            except queue.Empty:
+                pass
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining() -> Optional[float]:
+            return None if deadline is None else max(0, deadline - time.monotonic())
+
+        for _ in self._workers:
+            try:
+                self._queue.put(None, timeout=remaining())
+            except queue.Full:
+                logger.warning("messagebus workers did not drain the queue in time")
+                break
+        for worker in self._workers:
+            worker.join(remaining())
+        self._handlers.shutdown(wait=False)
+
+
+_dispatcher = None  # type: Optional[AsyncDispatcher]
+
+
+def queue_depth() -> int:
+    """Events waiting for the async dispatcher's workers (0 when dispatching inline)"""
+    dispatcher = _dispatcher
+    return 0 if dispatcher is None else dispatcher.queue_depth
+
+
+metrics.registry.register(
+    metrics.Gauge(
+        "messagebus_queue_depth", "Events waiting for a message bus worker", queue_depth
+    )
+)
+
+
+class Coalescer:
+    """
+    Drops redundant events before they reach the handlers.
+
+    Attributes:
+    ----------
+
+    window : float
+        Seconds during which a debounced event is suppressed after it was let through
+        (the first one is always handled). 0 turns debouncing off.
+    debounced : Collection[Type[Event]]
+        Event types that are debounced. Events are keyed by value, so OutOfStock is
+        debounced per SKU.
+    deduplicated, debounced_count : int
+        Events suppressed as duplicates within a batch, and by the debounce window.
+    """
+
+    def __init__(
+        self,
+        window: float = 60.0,
+        debounced: Collection[Type[Event]] = (OutOfStock,),
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.window = window
+        self.debounced = tuple(debounced)
+        self.clock = clock
+        self.deduplicated = 0
+        self.debounced_count = 0
+        self._last_seen: Dict[Event, float] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def suppressed(self) -> int:
+        return self.deduplicated + self.debounced_count
+
+    def coalesce(self, events: Iterable[Event]) -> List[Event]:
+        """The events worth handling, in order: each once, minus the debounced ones"""
+        events = list(events)
+        unique = list(
+            dict.fromkeys(events)
+        )  # Events are frozen dataclasses, so hashable
+        with self._lock:
+            self.deduplicated += len(events) - len(unique)
+            return [event for event in unique if self._let_through(event)]
+
+    def forget(self, event: Event):
+        """Lets the next `event` through, e.g. because handling this one failed"""
+        with self._lock:
+            self._last_seen.pop(event, None)
+
+    def _let_through(self, event: Event) -> bool:
+        if not self.window or not isinstance(event, self.debounced):
+            return True
+        now = self.clock()
+        last = self._last_seen.get(event)
+        if last is not None and now - last < self.window:
+            self.debounced_count += 1
+            return False
+        self._last_seen[event] = now
+        if len(self._last_seen) > 10_000:  # Forget SKUs whose window has passed
+            self._last_seen = {
+                key: seen
+                for key, seen in self._last_seen.items()
+                if now - seen < self.window
+            }
+        return True
+
+
+coalescer = Coalescer()
+
+
+def configure_coalescing(window: float = 60.0, **options) -> Coalescer:
+    """Replaces the module Coalescer (and its counters), e.g. with the config window"""
+    global coalescer
+    coalescer = Coalescer(window, **options)
+    return coalescer
+
+
+def start_async_dispatch(**options) -> AsyncDispatcher:
+    """Switches dispatch() to a new AsyncDispatcher(**options), e.g. on app startup"""
+    global _dispatcher
+    if _dispatcher is not None:
+        raise RuntimeError("Async dispatch is already running")
+    _dispatcher = AsyncDispatcher(**options)
+    return _dispatcher
+
+
+def stop_async_dispatch(drain: bool = True, timeout: Optional[float] = None):
+    """Drains and stops the dispatcher; dispatch() goes back to handling them inline"""
+    global _dispatcher
+    dispatcher, _dispatcher = _dispatcher, None
+    if dispatcher is not None:
+        dispatcher.shutdown(drain=drain, timeout=timeout)
+
+
 def send_out_of_stock_notification(event: OutOfStock):
     send_mail(
         "stock@made.com",
@@ -39,6 +323,6 @@ def send_out_of_stock_notification(event: OutOfStock):
     )
 
 
-HANDLERS = {
+HANDLERS: Dict[Type[Event], List[Callable]] = {
     OutOfStock: [send_out_of_stock_notification],
-}  # type: Dict[Type[Event], List[Callable]]
+}
@@ -0,0 +1,182 @@
+"""
+Drains the transactional outbox (SqlAlchemyUnitOfWork use_outbox) into the message bus.
+
+Delivery is at-least-once: a row is marked processed only after its handlers ran, so a
+crash in between means the event is handled again once its claim expires. Handlers
+should be idempotent.
+
+Run it next to the API with:
+
+    python -m batch_allocations.service_layer.outbox
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import json
+import logging
+import threading
+import time
+from datetime import timedelta
+from typing import Dict, Optional, Type
+
+from sqlalchemy.engine import Engine
+
+# Domain Model Modules
+# --------------------
+from ..adapters import outbox
+from ..adapters.database import get_engine
+from ..config import get_outbox_options
+from ..domain.events import Event
+from . import messagebus
+
+logger = logging.getLogger(__name__)
+
+# Constants
+# ---------
+
+PURGE_INTERVAL = 60.0  # Seconds between two purges of processed rows in run()
+PURGE_CHUNK = 1000  # Rows deleted per transaction, so a purge never holds long locks
+
+# Helper Functions
+# ----------------
+
+
+def event_types() -> Dict[str, Type[Event]]:
+    """Event classes by the name stored in outbox.event_type"""
+    return {event_type.__name__: event_type for event_type in messagebus.HANDLERS}
+
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+class OutboxDispatcher:
+    """
+    Claims pending outbox rows in batches, runs their handlers and marks them processed.
+
+    Attributes:
+    ----------
+
+    batch_size : int
+        Rows claimed (and marked processed) per round trip.
+    poll_interval : float
+        Seconds to wait when the outbox is empty.
+    lease : float
+        Seconds a claim lasts. Rows claimed by a dispatcher that died are retried then.
+    max_attempts : int
+        Failed rows are retried until then, and left with their last_error afterwards.
+    retention : float or None
+        Seconds processed rows are kept before run() deletes them. None keeps them.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        batch_size: int = 100,
+        poll_interval: float = 1.0,
+        lease: float = 60.0,
+        max_attempts: int = 5,
+        retention: Optional[float] = 7 * 24 * 3600.0,
+    ):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = timedelta(seconds=lease)
+        self.max_attempts = max_attempts
+        self.retention = None if retention is None else timedelta(seconds=retention)
+        self.processed = 0
+        self.failed = 0
+        self.purged = 0
+        self._purged_at = None  # type: Optional[float]
+        self._stop = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def drain_once(self) -> int:
+        """Handles one batch. Returns the rows claimed (0 when the outbox is empty)"""
+        with self.engine.begin() as conn:
+            rows = outbox.claim(conn, self.batch_size, self.lease, self.max_attempts)
+        if not rows:
+            return 0
+
+        types = event_types()
+        done = []
+        for row in rows:
+            event = None  # type: Optional[Event]
+            try:
+                event = types[row.event_type](**json.loads(row.payload))
+                for handled in messagebus.coalescer.coalesce([event]):  # Debounce
+                    messagebus.handle(handled)
+            except Exception as e:
+                if event is not None:  # The retry must not be debounced
+                    messagebus.coalescer.forget(event)
+                logger.exception("Outbox row %s (%s) failed", row.id, row.event_type)
+                self.failed += 1
+                with self.engine.begin() as conn:
+                    outbox.mark_failed(conn, row.id, repr(e))
+            else:
+                done.append(row.id)
+
+        with self.engine.begin() as conn:
+            outbox.mark_processed(conn, done)
+        self.processed += len(done)
+        return len(rows)
+
+    def drain(self) -> int:
+        """Handles batches until the outbox is empty. Returns the rows claimed"""
+        total = 0
+        while claimed := self.drain_once():
+            total += claimed
+        return total
+
+    def purge(self) -> int:
+        """Deletes the rows processed over `retention` ago. Returns the rows deleted"""
+        if self.retention is None:
+            return 0
+        before = outbox.utcnow() - self.retention
+        total = 0
+        while True:
+            with self.engine.begin() as conn:
+                deleted = outbox.purge_processed(conn, before, PURGE_CHUNK)
+            total += deleted
+            if deleted < PURGE_CHUNK:
+                break
+        self.purged += total
+        return total
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                claimed = self.drain_once()
+                now = time.monotonic()
+                if self._purged_at is None or now - self._purged_at >= PURGE_INTERVAL:
+                    self._purged_at = now
+                    self.purge()
+            except Exception:
+                logger.exception("Outbox drain failed")  # e.g. the database went away
+                claimed = 0
+            if claimed < self.batch_size:  # Caught up, don't hammer the table
+                self._stop.wait(self.poll_interval)
+
+    def start(self) -> "OutboxDispatcher":
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="outbox", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    options = get_outbox_options() or {}
+    options.pop("mode", None)
+    dispatcher = OutboxDispatcher(get_engine(), **options)
+    try:
+        dispatcher.run()
+    except KeyboardInterrupt:
+        pass
@@ -13,20 +13,122 @@ is incomplete.
 
 from __future__ import annotations
 
-from typing import Optional
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
 
 from datetime import date
+from functools import wraps
+from itertools import count, islice
+import logging
+import random
+import time
 
 # Domain Model Modules
 # --------------------
 
+from ..adapters import metrics
+from ..adapters.instrumentation import timed
 from ..adapters.repository import RepositoryProtocol
 from ..domain.model import OrderLine, Batch
 from ..domain import (
     model,
 )  # Imported model to avoid model.allocate to colide with services.allocate defined in this module.
 
-from ..service_layer.unit_of_work import UnitOfWorkProtocol
+from ..service_layer.unit_of_work import ConcurrentUpdateError, UnitOfWorkProtocol
+
+# Constants
+# ---------
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = (
+    5  # Tries per service call when another unit of work changes the same product
+)
+BACKOFF_SECONDS = 0.01  # Base delay, doubled on every retry and jittered
+
+# Outcome of each line in allocate_stream()
+ALLOCATED = "allocated"
+OUT_OF_STOCK = "out_of_stock"
+INVALID_SKU = "invalid_sku"
+INVALID_LINE = "invalid"
+CONFLICT = "conflict"  # Still contended after MAX_ATTEMPTS: worth sending again
+
+T = TypeVar("T")
+
+# Helper Functions
+# ----------------
+
+
+def retry_delay(service: Callable, attempt: int) -> Optional[float]:
+    """
+    Seconds to wait before running `service` again after its `attempt`th
+    ConcurrentUpdateError (exponential backoff with jitter, counted in
+    metrics.uow_retries), or None once MAX_ATTEMPTS are used up. Shared with
+    async_services.retry_on_conflict.
+    """
+    if attempt >= MAX_ATTEMPTS:
+        return None
+    metrics.uow_retries.inc(service.__name__)
+    return BACKOFF_SECONDS * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+
+
+def latency(service: Callable) -> ContextManager[None]:
+    """Times a call of `service` into metrics.service_latency (see observed())"""
+    return metrics.service_latency.time(service.__name__)
+
+
+def retry_on_conflict(service: Callable[..., T]) -> Callable[..., T]:
+    """
+    Re-runs a service (its whole unit of work) when the commit loses an optimistic
+    concurrency race, with exponential backoff and jitter. Gives up after MAX_ATTEMPTS
+    and lets ConcurrentUpdateError propagate.
+    """
+
+    @wraps(service)
+    def wrapper(*args, **kwargs) -> T:
+        for attempt in count(1):
+            try:
+                return service(*args, **kwargs)
+            except ConcurrentUpdateError:
+                delay = retry_delay(service, attempt)
+                if delay is None:
+                    raise
+                logger.debug(
+                    "%s: concurrent update, retry %d", service.__name__, attempt
+                )
+                time.sleep(delay)
+        raise AssertionError("unreachable")
+
+    return wrapper
+
+
+def observed(service: Callable[..., T]) -> Callable[..., T]:
+    """Records how long each call takes, retries included, in metrics.service_latency"""
+
+    @wraps(service)
+    def wrapper(*args, **kwargs) -> T:
+        with latency(service):
+            return service(*args, **kwargs)
+
+    return wrapper
+
+
+def chunked(items: Iterable[T], size: int) -> Iterator[List[T]]:
+    """Lists of `size` items (the last one shorter), reading no further ahead"""
+    it = iter(items)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
 
 # Functions and Class Definitions/Declarations
 # --------------------------------------------
@@ -38,12 +140,14 @@ class InvalidSku(Exception):
 
 def is_valid_sku(sku, batches):
     """Check if SKU exists in any batch"""
-    return sku in {b.sku for b in batches}
+    return any(b.sku == sku for b in batches)  # Stops at the first match
 
 
 # In both allocate() and add_batch() of adding to .batches with the Aggregate we add to .products
 
 
+@observed
+@retry_on_conflict
 def allocate(
     orderid: str,
     sku: str,
@@ -54,12 +158,132 @@ def allocate(
     with uow:
         product = uow.products.get(sku=line.sku)
         if product is None:
+            metrics.allocations.inc(INVALID_SKU)
             raise InvalidSku(f"Invalid sku {line.sku}")
-        batchref = product.allocate(line)
+        with timed("allocate_seconds"):
+            batchref = product.allocate(line)
         uow.commit()
+    metrics.allocations.inc(ALLOCATED if batchref else OUT_OF_STOCK)
     return batchref
 
 
+def allocate_batch(
+    lines: Iterable[Tuple[str, str, int]],  # (orderid, sku, qty) in arrival order
+    uow: UnitOfWorkProtocol,
+) -> List[Optional[str]]:
+    """
+    Bulk version of allocate(). Lines are grouped by SKU so each Product is loaded once,
+    allocated in memory in arrival order and committed once.
+
+    Returns one batchref per line, in the order the lines were given. Lines that could
+    not be allocated (out of stock, an unknown SKU, or a SKU other units of work kept
+    changing past MAX_ATTEMPTS) get None.
+    """
+    order_lines = [OrderLine(orderid, sku, qty) for orderid, sku, qty in lines]
+    return [batchref for batchref, _ in _allocate_lines(order_lines, uow)]
+
+
+@observed
+def allocate_sku(
+    sku: str,
+    lines: Iterable[Tuple[str, int]],  # (orderid, qty) in arrival order
+    uow: UnitOfWorkProtocol,
+) -> List[Optional[str]]:
+    """
+    allocate() for several orders of one SKU: one load, one commit, and one batchref (or
+    None when out of stock) per line, in order. Raises InvalidSku like allocate().
+    """
+    return _allocate_sku_lines(
+        sku, [OrderLine(orderid, sku, qty) for orderid, qty in lines], uow
+    )
+
+
+def allocate_stream(
+    records: Iterable[Any],  # Dicts with orderid, sku and qty
+    uow: UnitOfWorkProtocol,
+    chunk_size: int = 500,
+) -> Iterator[Dict]:
+    """
+    allocate_batch() for input of any length: records are read and allocated
+    `chunk_size` at a time, and one result per record is yielded, in order, as soon as
+    its chunk is committed.
+
+    A result has the record's line number (from 1), its orderid, sku and qty, and a
+    status: ALLOCATED (with the batchref), OUT_OF_STOCK, INVALID_SKU, CONFLICT, or
+    INVALID_LINE (with an error) for a record that isn't an order line with a positive
+    qty. Nothing stops the stream.
+    """
+    for chunk in chunked(enumerate(records, 1), chunk_size):
+        results = []  # type: List[Dict]
+        lines = []  # type: List[OrderLine]
+        for number, record in chunk:
+            try:
+                line = OrderLine(
+                    str(record["orderid"]), str(record["sku"]), int(record["qty"])
+                )
+                if line.qty <= 0:
+                    raise ValueError(f"qty must be positive, not {line.qty}")
+            except (KeyError, TypeError, ValueError) as e:
+                results.append(dict(line=number, status=INVALID_LINE, error=repr(e)))
+                continue
+            results.append(
+                dict(line=number, orderid=line.orderid, sku=line.sku, qty=line.qty)
+            )
+            lines.append(line)
+
+        outcomes = iter(_allocate_lines(lines, uow))
+        for result in results:
+            if result.get("status") != INVALID_LINE:
+                result["batchref"], result["status"] = next(outcomes)
+            yield result
+
+
+def _allocate_lines(
+    order_lines: List[OrderLine], uow: UnitOfWorkProtocol
+) -> List[Tuple[Optional[str], str]]:
+    """(batchref, status) per line, one unit of work per SKU"""
+    positions_by_sku = {}  # type: Dict[str, List[int]]
+    for position, line in enumerate(order_lines):
+        positions_by_sku.setdefault(line.sku, []).append(position)
+
+    unknown = (None, INVALID_SKU)  # type: Tuple[Optional[str], str]
+    outcomes = [unknown] * len(order_lines)
+    for sku, positions in positions_by_sku.items():
+        try:
+            allocated = _allocate_sku_lines(
+                sku, [order_lines[p] for p in positions], uow
+            )
+        except InvalidSku:
+            continue
+        except ConcurrentUpdateError:  # Only this SKU's lines: the others go ahead
+            metrics.allocations.inc(CONFLICT, amount=len(positions))
+            for position in positions:
+                outcomes[position] = (None, CONFLICT)
+            continue
+        for position, batchref in zip(positions, allocated, strict=True):
+            outcomes[position] = (batchref, ALLOCATED if batchref else OUT_OF_STOCK)
+    return outcomes
+
+
+@retry_on_conflict
+def _allocate_sku_lines(
+    sku: str, lines: List[OrderLine], uow: UnitOfWorkProtocol
+) -> List[Optional[str]]:
+    with uow:
+        product = uow.products.get(sku=sku)
+        if product is None:
+            metrics.allocations.inc(INVALID_SKU, amount=len(lines))
+            raise InvalidSku(f"Invalid sku {sku}")
+        with timed("allocate_seconds"):
+            batchrefs = product.allocate_many(lines)
+        uow.commit()
+    for batchref in batchrefs:
+        metrics.allocations.inc(ALLOCATED if batchref else OUT_OF_STOCK)
+    return batchrefs
+
+
+@observed
+@retry_on_conflict
 def add_batch(
     ref: str,
     sku: str,
@@ -72,5 +296,5 @@ def add_batch(
         if product is None:
             product = model.Product(sku, batches=[])
             uow.products.add(product)
-        product.batches.append(model.Batch(ref, sku, qty, eta))
+        product.add_batch(model.Batch(ref, sku, qty, eta))
         uow.commit()
@@ -8,63 +8,116 @@ data layer. It reliex on Python's context managers.
 
 from __future__ import annotations
 
-from typing import Protocol, Optional, Type, Any
+import asyncio
+from contextlib import ExitStack
+from functools import lru_cache
+from typing import TYPE_CHECKING, Iterable, List, Optional, Protocol, Type
 from types import TracebackType
 
-from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.attributes import instance_state
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.exc import StaleDataError
 
 # Domain Model Modules
 # --------------------
 
+from ..adapters import metrics, outbox
+from ..adapters.database import get_async_engine, get_engine
+from ..adapters.cache import ProductCache
+from ..adapters.instrumentation import QueryStats, timed
+from ..adapters.memory_store import InMemoryRepository, ProductStore
+from ..domain.events import Event
+from ..domain.model import Product
+from ..adapters.sku_index import SkuIndex
 from ..adapters.repository import (
+    AsyncProductRepositoryProtocol,
+    AsyncSqlAlchemyRepository,
+    LoadingStrategy,
     RepositoryProtocol,
     ProductRepositoryProtocol,
+    ShardedRepository,
     SqlAlchemyRepository,
 )
 
-from ..service_layer.messagebus import handle
+from ..service_layer.messagebus import publish
 
-from ..config import get_postgres_uri
+# Sharding is optional: adapters.shards is only imported once a shard map is used
+if TYPE_CHECKING:
+    from ..adapters.shards import ShardMap
 
 # Constants
 # ---------
 
 
 def get_session_factory(uri=None, isolation_level=None):
-    """Create session factory with appropriate isolation level"""
-    if uri is None:
-        uri = get_postgres_uri()
-
-    # Only set isolation_level for PostgreSQL
-    if uri.startswith("postgresql") and isolation_level:
-        engine = create_engine(uri, isolation_level=isolation_level)
-    else:
-        # For SQLite, use default or SERIALIZABLE
-        if uri.startswith("sqlite"):
-            engine = create_engine(uri, isolation_level="SERIALIZABLE")
-        else:
-            engine = create_engine(uri)
-
+    """Create session factory with appropriate isolation level, on the shared pool"""
+    engine = get_engine(uri)
+    if isolation_level and engine.dialect.name == "postgresql":
+        return sessionmaker(
+            bind=engine.execution_options(isolation_level=isolation_level)
+        )
     return sessionmaker(bind=engine)
 
 
-# DEFAULT_SESSION_FACTORY = sessionmaker(
-#     bind=create_engine(
-#         get_postgres_uri(),
-#         isolation_level="REPEATABLE READ",
-#     )
-# )
+def default_session_factory() -> Session:
+    """
+    A session on the shared engine (adapters/database.py), REPEATABLE READ on Postgres.
+    Nothing is created until the first unit of work starts, so importing this module
+    doesn't touch the database.
+    """
+    return _default_sessionmaker()()
+
+
+@lru_cache(maxsize=None)
+def _default_sessionmaker() -> sessionmaker:
+    return sessionmaker(bind=get_engine())
+
+
+def default_async_session_factory() -> AsyncSession:
+    """default_session_factory on the shared async engine"""
+    return _default_async_sessionmaker()()
+
+
+@lru_cache(maxsize=None)
+def _default_async_sessionmaker() -> async_sessionmaker:
+    return async_sessionmaker(bind=get_async_engine(), expire_on_commit=False)
+
+
+# Helper Functions
+# ----------------
+
+
+def drain_events(products: Iterable[Product]) -> List[Event]:
+    """The events the products raised, in order, leaving their queues empty"""
+    events = []  # type: List[Event]
+    for product in products:
+        # Turns out that SQLAlchemy does not call Product's __init__ method. To avoid
+        # this pitfall, getting the events queue, or an empty list if it doesn't exist
+        product_events = getattr(product, "events", [])
+        events.extend(product_events)
+        product_events.clear()
+    return events
 
-DEFAULT_SESSION_FACTORY = get_session_factory(
-    isolation_level="REPEATABLE READ"  # Only applied to PostgreSQL
-)
 
 # Functions and Class Definitions/Declarations
 # --------------------------------------------
 
 
+class ConcurrentUpdateError(Exception):
+    """Another unit of work changed the same product first. Safe to retry"""
+
+
+def is_serialization_failure(error: DBAPIError) -> bool:
+    """Errors the database raises when two transactions conflict and one must retry"""
+    pgcode = getattr(error.orig, "pgcode", None)
+    if pgcode in ("40001", "40P01"):  # serialization_failure, deadlock_detected
+        return True
+    return "database is locked" in str(error.orig)  # SQLite
+
+
 class UnitOfWorkProtocol(Protocol):
     # batches: RepositoryProtocol
     products: ProductRepositoryProtocol  # With the Product Aggregate the RepositoryProtocol was updated to ProductRepositoryProtocol
@@ -80,17 +133,15 @@ class UnitOfWorkProtocol(Protocol):
         self.rollback()
 
     def commit(self):
-        self._commit()
-        self.publish_events()
+        with timed("commit_seconds"):
+            self._commit()
+        with timed("dispatch_seconds"):
+            self.publish_events()
 
     def publish_events(self):
-        for product in self.products.seen:
-            # Turns out that SQLAlchemy does not call Product's __init__ method. To avoid this pitfall,
-            # getting the events list, or an empty list if it doesn't exist
-            events = getattr(product, "events", [])
-            while events:
-                event = product.events.pop(0)
-                handle(event)
+        publish(
+            drain_events(self.products.seen)
+        )  # Coalesced across the whole unit of work
 
     def _commit(self): ...
 
@@ -98,27 +149,354 @@ class UnitOfWorkProtocol(Protocol):
 
 
 class SqlAlchemyUnitOfWork(UnitOfWorkProtocol):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    def __init__(
+        self,
+        session_factory=default_session_factory,
+        loading: LoadingStrategy = "selectin",  # See SqlAlchemyRepository
+        use_outbox: bool = False,
+        cache: Optional[ProductCache] = None,
+        sku_index: Optional[SkuIndex] = None,
+    ):
+        """
+        With `use_outbox` the events raised by the products are written to the outbox
+        table in the same transaction as the products themselves, instead of being
+        dispatched after the commit. An OutboxDispatcher (service_layer/outbox.py) hands
+        them to the message bus. An event is then never lost because the process died
+        between commit and dispatch.
+
+        A `cache` (adapters/cache.py), usually shared by all units of work in the
+        process, receives the products this unit of work committed once it exits. A
+        shared `sku_index` (adapters/sku_index.py) lets the repository answer "no such
+        product" without a query.
+
+        While it is open the unit of work records its statements and timings in
+        `self.stats` (adapters/instrumentation.py), and adds them to the caller's
+        QueryStats on exit.
+        """
         self.session_factory = session_factory
+        self.loading = loading
+        self.use_outbox = use_outbox
+        self.cache = cache
+        self.sku_index = sku_index
 
     def __enter__(self):
         """
         Excecutes when entering the with block.
         """
         self.session = self.session_factory()  # type: Session
-        self.products = SqlAlchemyRepository(self.session)
+        self.products = SqlAlchemyRepository(
+            self.session,
+            loading=self.loading,
+            cache=self.cache,
+            sku_index=self.sku_index,
+        )
+        self._committed = []  # type: List[Product]
+        self._has_committed = False
+        if self.cache is not None:
+            # Committed products stay loaded, ready to be cached (see __exit__)
+            self.session.expire_on_commit = False
+        self.stats = QueryStats().__enter__()
         return self
 
     def __exit__(self, exn_type, exn_value, traceback):
         """
         Excecutes when exit the with block.
         """
-        super().__exit__(exn_type, exn_value, traceback)  # Handle protocol
-        self.rollback()  # Default action. A UOW should commit only when it is explicitly told to.
-        self.session.close()
+        try:
+            super().__exit__(exn_type, exn_value, traceback)  # Handle protocol
+            # Default action. A UOW should commit only when it is explicitly told to.
+            self.rollback()
+            if not self._has_committed:
+                metrics.uow_rollbacks.inc()
+            self.session.close()
+            if self.cache is not None:
+                self._fill_cache(self.cache)
+        finally:
+            self.stats.__exit__(exn_type, exn_value, traceback)
 
     def _commit(self):
-        self.session.commit()
+        if self.use_outbox:
+            self._write_outbox()
+        try:
+            self.session.commit()
+        except (
+            StaleDataError
+        ) as e:  # products.version_number moved (see orm.start_mappers)
+            self._rollback_failed_commit()
+            raise ConcurrentUpdateError(str(e)) from e
+        except DBAPIError as e:
+            self._rollback_failed_commit()
+            if is_serialization_failure(e):
+                raise ConcurrentUpdateError(str(e)) from e
+            raise
+        self._committed = list(self.products.seen)
+        self._has_committed = True
+        metrics.uow_commits.inc()
+
+    def _rollback_failed_commit(self):
+        self.session.rollback()
+        if self.cache is not None:
+            for product in self.products.seen:  # Most likely out of date
+                self.cache.discard(product.sku)
+
+    def _fill_cache(self, cache: ProductCache):
+        for product in self._committed:
+            # Changed again after the commit and rolled back: its state is gone
+            if not instance_state(product).expired_attributes:
+                cache.put(product)
+
+    def _write_outbox(self):
+        # Emptying the lists leaves nothing for publish_events() to dispatch. If the
+        # commit fails the rows roll back with everything else
+        events = drain_events(self.products.seen)
+        outbox.add_events(self.session, dict.fromkeys(events))  # Once each
 
     def rollback(self):
         self.session.rollback()
+
+
+class ShardedUnitOfWork(UnitOfWorkProtocol):
+    """
+    SqlAlchemyUnitOfWork on the shard of the SKUs it gets (adapters/shards.py): the
+    first get() or add() opens one on that shard, and the rest of the unit of work goes
+    through it, so commit, rollback, ConcurrentUpdateError, the outbox and the metrics
+    are all the same.
+
+    A product on another shard raises CrossShardError: no transaction would cover both.
+    The services only ever get one SKU per unit of work.
+
+    The shard map is refreshed from its file on entry, so a SKU moved by another process
+    is found where it went (the move makes units of work that had loaded it retry). A
+    SKU its shard doesn't have refreshes the map again: if it was moved since, get()
+    raises ConcurrentUpdateError and the retry finds it on the new shard.
+
+    Adding a product holds the map's lock shared until exit (ShardMap.creating()) and
+    checks the map the same way, so a SKU add_shard() sent elsewhere since this unit of
+    work started on its shard is created on the new shard by the retry.
+    """
+
+    def __init__(
+        self,
+        shard_map: ShardMap,
+        loading: LoadingStrategy = "selectin",
+        use_outbox: bool = False,
+    ):
+        self.shard_map = shard_map
+        self.loading = loading
+        self.use_outbox = use_outbox
+
+    def __enter__(self):
+        self.shard_map.refresh()
+        self.shard = None  # type: Optional[str]
+        self._uow = None  # type: Optional[SqlAlchemyUnitOfWork]
+        self._locks = ExitStack()
+        self._map_locked = False
+        self.products = ShardedRepository(
+            self._repository_for, self._creating, self._missing
+        )
+        return self
+
+    def _creating(self, sku: str):
+        if not self._map_locked:
+            self._locks.enter_context(self.shard_map.creating())
+            self._map_locked = True
+        self._missing(sku)
+
+    def _missing(self, sku: str):
+        self.shard_map.refresh()
+        if self._uow is not None and self.shard_map.shard_for(sku) != self.shard:
+            raise ConcurrentUpdateError(
+                f"{sku} was placed on shard {self.shard_map.shard_for(sku)} since this"
+                f" unit of work started on {self.shard}"
+            )
+
+    def _repository_for(self, sku: str) -> ProductRepositoryProtocol:
+        shard = self.shard_map.shard_for(sku)
+        if self._uow is None:
+            self._uow = SqlAlchemyUnitOfWork(
+                self.shard_map.session_factory(shard),
+                loading=self.loading,
+                use_outbox=self.use_outbox,
+            ).__enter__()
+            self.shard = shard
+        elif shard != self.shard:
+            from ..adapters.shards import CrossShardError
+
+            raise CrossShardError(
+                f"{sku} is on shard {shard}, this unit of work is on {self.shard}"
+            )
+        return self._uow.products
+
+    def __exit__(self, exn_type, exn_value, traceback):
+        with self._locks:
+            if self._uow is not None:
+                self._uow.__exit__(exn_type, exn_value, traceback)
+
+    def _commit(self):
+        if self._uow is not None:
+            self._uow._commit()
+
+    def rollback(self):
+        if self._uow is not None:
+            self._uow.rollback()
+
+
+class InMemoryUnitOfWork(UnitOfWorkProtocol):
+    """
+    A unit of work on a ProductStore (adapters/memory_store.py): the products live in
+    memory and commit appends their changes to the store's write-ahead log, so services
+    run on it unchanged without a database round trip.
+
+    The products it gets are locked until it commits or exits, so another unit of work
+    waits for them, up to the store's lock_timeout, and then raises
+    ConcurrentUpdateError. Commit releases them before the log is on disk (but returns
+    after), so commits of the same product share fsyncs too. A product changed after the
+    commit must be got again.
+
+    Notes:
+    ------
+
+    Events are published after the commit as usual; there is no outbox.
+    """
+
+    def __init__(self, store: ProductStore, wait_for_log: bool = True):
+        """
+        Without `wait_for_log` commit returns as soon as the changes are appended to the
+        log, and `logged` is what to pass to store.wait() before telling anyone they are
+        committed. A caller committing many units of work in a row then waits for one
+        fsync in the end.
+        """
+        self.store = store
+        self.wait_for_log = wait_for_log
+        self.logged = 0
+
+    def __enter__(self):
+        self.products = InMemoryRepository(self.store, conflict=ConcurrentUpdateError)
+        self._events = []  # type: List[Event]
+        self._has_committed = False
+        return self
+
+    def __exit__(self, exn_type, exn_value, traceback):
+        try:
+            super().__exit__(exn_type, exn_value, traceback)  # Rolls back
+            if not self._has_committed:
+                metrics.uow_rollbacks.inc()
+        finally:
+            self.products.release()
+
+    def _commit(self):
+        try:
+            seq = self.store.log(self.products.changes())
+        except Exception:
+            self.products.undo()
+            raise
+        self.products.committed()
+        self._events = drain_events(self.products.seen)
+        # Early lock release: whoever takes these products next logs after this record,
+        # so their commit can't be durable before this one is
+        self.products.release()
+        self.logged = max(self.logged, seq)
+        if self.wait_for_log:
+            self.store.wait(seq)
+        self._has_committed = True
+        metrics.uow_commits.inc()
+
+    def publish_events(self):
+        # Drained in _commit(): the products may already belong to another unit of work
+        events, self._events = self._events, []
+        publish(events)
+
+    def rollback(self):
+        self.products.undo()
+
+
+class AsyncUnitOfWorkProtocol(Protocol):
+    """UnitOfWorkProtocol for asyncio: `async with uow:` and `await uow.commit()`"""
+
+    products: AsyncProductRepositoryProtocol
+
+    async def __aenter__(self) -> "AsyncUnitOfWorkProtocol": ...
+
+    async def __aexit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        await self.rollback()
+
+    async def commit(self):
+        with timed("commit_seconds"):
+            await self._commit()
+        with timed("dispatch_seconds"):
+            await self.publish_events()
+
+    async def publish_events(self):
+        events = drain_events(self.products.seen)
+        if events:
+            # The handlers are synchronous (e-mail...): keep them off the event loop
+            await asyncio.to_thread(publish, events)
+
+    async def _commit(self): ...
+
+    async def rollback(self): ...
+
+
+class AsyncSqlAlchemyUnitOfWork(AsyncUnitOfWorkProtocol):
+    """
+    SqlAlchemyUnitOfWork on an AsyncSession (adapters/database.get_async_engine). Same
+    optimistic concurrency (ConcurrentUpdateError), same events and outbox, but waiting
+    on the database doesn't hold a thread, so one process can have thousands of them in
+    flight.
+
+    Notes:
+    ------
+
+    There is no ProductCache here: the repository always loads the whole product.
+    """
+
+    def __init__(
+        self,
+        session_factory=default_async_session_factory,
+        loading: LoadingStrategy = "selectin",  # "selectin" or "joined"
+        use_outbox: bool = False,
+        sku_index: Optional[SkuIndex] = None,
+    ):
+        self.session_factory = session_factory
+        self.loading = loading
+        self.use_outbox = use_outbox
+        self.sku_index = sku_index
+
+    async def __aenter__(self):
+        self.session = self.session_factory()  # type: AsyncSession
+        self.products = AsyncSqlAlchemyRepository(
+            self.session, loading=self.loading, sku_index=self.sku_index
+        )
+        self._has_committed = False
+        return self
+
+    async def __aexit__(self, exn_type, exn_value, traceback):
+        await super().__aexit__(exn_type, exn_value, traceback)
+        if not self._has_committed:
+            metrics.uow_rollbacks.inc()
+        await self.session.close()
+
+    async def _commit(self):
+        if self.use_outbox:
+            events = dict.fromkeys(drain_events(self.products.seen))
+            await self.session.run_sync(outbox.add_events, events)
+        try:
+            await self.session.commit()
+        except StaleDataError as e:
+            await self.session.rollback()
+            raise ConcurrentUpdateError(str(e)) from e
+        except DBAPIError as e:
+            await self.session.rollback()
+            if is_serialization_failure(e):
+                raise ConcurrentUpdateError(str(e)) from e
+            raise
+        self._has_committed = True
+        metrics.uow_commits.inc()
+
+    async def rollback(self):
+        await self.session.rollback()
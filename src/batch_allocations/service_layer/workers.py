@@ -0,0 +1,283 @@
+"""
+Allocation workers: the SKUs partitioned across processes by consistent hashing.
+
+Allocating for one SKU is serial (one Product, one version_number), but different SKUs
+are independent. AllocationWorkers starts a pool of processes, each owning the SKUs the
+hash ring (adapters/hashring.py) gives it, with their products in its own ProductStore
+(adapters/memory_store.py). The front end (AllocationWorkers itself, in the calling
+process) sends each allocate/add_batch command to the owning worker, which runs the
+usual services on them one at a time: no locks between processes, and one GIL per
+worker.
+
+A worker takes the commands waiting in its queue (up to max_batch), runs them, waits for
+one fsync of the log for all of them and then answers, so replies mean durable.
+
+    with AllocationWorkers("var/workers", workers=4) as pool:
+        pool.add_batch("batch1", "RED-LAMP", 100, None)
+        pool.allocate("order1", "RED-LAMP", 10)  # -> "batch1"
+
+Notes:
+------
+
+The directory is partitioned for a number of workers, recorded in partition.json:
+reopening it with another number raises ValueError, as the SKUs' products would be in
+the wrong store.
+
+Events (OutOfStock...) are handled by the message bus of the worker that raised them.
+"""
+
+# Boilerplate Modules
+# -------------------
+
+from __future__ import annotations
+
+import json
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from datetime import date
+from typing import Any, Dict, List, Optional, Tuple
+
+# Domain Model Modules
+# --------------------
+from ..adapters.hashring import HashRing
+from ..adapters.memory_store import ProductStore
+from ..service_layer import services
+from ..service_layer.unit_of_work import InMemoryUnitOfWork
+
+# Constants
+# ---------
+
+MAX_BATCH = 256  # Commands a worker runs before it waits for the log and answers
+
+COMMANDS = {"allocate": services.allocate, "add_batch": services.add_batch}
+
+# Helper Functions
+# ----------------
+
+
+def _serve(
+    directory: str,
+    requests: multiprocessing.Queue,
+    responses: multiprocessing.Queue,
+    max_batch: int,
+    store_options: Dict[str, Any],
+):
+    """A worker process: runs the commands of its queue until it gets None"""
+    store = ProductStore(directory, **store_options)
+    try:
+        while True:
+            commands = [requests.get()]
+            while len(commands) < max_batch:
+                try:
+                    commands.append(requests.get_nowait())
+                except queue.Empty:
+                    break
+            replies, logged = [], 0
+            for command in commands:
+                if command is None:
+                    break
+                request_id, name, args = command
+                uow = InMemoryUnitOfWork(store, wait_for_log=False)
+                try:
+                    reply = (request_id, "ok", COMMANDS[name](*args, uow=uow))
+                except services.InvalidSku as e:
+                    reply = (request_id, "invalid_sku", str(e))
+                except Exception as e:
+                    reply = (request_id, "error", f"{type(e).__name__}: {e}")
+                logged = max(logged, uow.logged)
+                replies.append(reply)
+            store.wait(logged)
+            responses.put(replies)
+            if command is None:
+                return
+    finally:
+        store.close()
+
+
+# Functions and Class Definitions/Declarations
+# --------------------------------------------
+
+
+class WorkerError(Exception):
+    """A command failed in its worker, or the worker died"""
+
+
+class AllocationWorkers:
+    """
+    Attributes:
+    ----------
+
+    directory : str
+        One subdirectory per worker for its ProductStore, and partition.json.
+    workers : int
+        Processes (default: one per CPU).
+    max_batch : int
+        Commands a worker runs per fsync.
+    ring : HashRing
+        SKU to worker ("worker-<n>").
+    store_options : dict
+        For each worker's ProductStore (fsync, snapshot_every...).
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        workers: Optional[int] = None,
+        max_batch: int = MAX_BATCH,
+        **store_options,
+    ):
+        self.directory = directory
+        self.workers = workers or os.cpu_count() or 1
+        self.max_batch = max_batch
+        self.store_options = store_options
+        self.ring = HashRing(f"worker-{n}" for n in range(self.workers))
+        self._context = multiprocessing.get_context("spawn")  # No fork of our threads
+        self._processes: List[Any] = []
+        self._requests: List[multiprocessing.Queue] = []
+        self._responses: Optional[multiprocessing.Queue] = None
+        self._pending: Dict[int, Tuple[int, Future]] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._receiver: Optional[threading.Thread] = None
+
+    def __enter__(self) -> "AllocationWorkers":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def owner(self, sku: str) -> int:
+        """The worker that owns the SKU"""
+        return int(self.ring.node_for(sku).rsplit("-", 1)[1])
+
+    def start(self) -> "AllocationWorkers":
+        self._check_partition()
+        self._responses = self._context.Queue()
+        for n in range(self.workers):
+            requests = self._context.Queue()
+            process = self._context.Process(
+                target=_serve,
+                args=(
+                    os.path.join(self.directory, f"worker-{n}"),
+                    requests,
+                    self._responses,
+                    self.max_batch,
+                    self.store_options,
+                ),
+                name=f"allocation-worker-{n}",
+                daemon=True,
+            )
+            process.start()
+            self._requests.append(requests)
+            self._processes.append(process)
+        self._receiver = threading.Thread(
+            target=self._receive,
+            args=(self._responses,),
+            name="allocation-workers",
+            daemon=True,
+        )
+        self._receiver.start()
+        return self
+
+    def stop(self):
+        """Lets the workers finish the commands sent so far, and waits for them"""
+        for requests in self._requests:
+            requests.put(None)
+        for process in self._processes:
+            process.join()
+        if self._responses is not None:
+            self._responses.put(None)  # Stops the receiver once it has read the rest
+        if self._receiver is not None:
+            self._receiver.join()
+        self._fail_pending(lambda worker: True, "Workers stopped")
+        self._processes, self._requests = [], []
+        self._responses = self._receiver = None
+
+    def _check_partition(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, "partition.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                workers = json.load(f)["workers"]
+            if workers != self.workers:
+                raise ValueError(
+                    f"{self.directory} is partitioned for {workers} workers,"
+                    f" not {self.workers}"
+                )
+            return
+        with open(path, "w") as f:
+            json.dump(dict(workers=self.workers), f)
+
+    # Commands
+    # --------
+
+    def submit(self, name: str, sku: str, *args) -> Future:
+        """
+        Sends COMMANDS[name](*args) to the worker that owns the SKU (which must be among
+        the args). The future's result is the service's, or it raises InvalidSku or
+        WorkerError.
+        """
+        if self._receiver is None:
+            raise RuntimeError("Workers are not started")
+        worker = self.owner(sku)
+        future: Future = Future()
+        with self._lock:
+            self._next_id += 1
+            request_id = self._next_id
+            self._pending[request_id] = (worker, future)
+        self._requests[worker].put((request_id, name, args))
+        return future
+
+    def allocate(
+        self, orderid: str, sku: str, qty: int, timeout: Optional[float] = None
+    ) -> Optional[str]:
+        return self.submit("allocate", sku, orderid, sku, qty).result(timeout)
+
+    def add_batch(
+        self,
+        ref: str,
+        sku: str,
+        qty: int,
+        eta: Optional[date],
+        timeout: Optional[float] = None,
+    ):
+        return self.submit("add_batch", sku, ref, sku, qty, eta).result(timeout)
+
+    def _receive(self, responses: multiprocessing.Queue):
+        while True:
+            try:
+                replies = responses.get(timeout=1)
+            except queue.Empty:
+                dead = {
+                    n
+                    for n, process in enumerate(self._processes)
+                    if not process.is_alive()
+                }
+                if dead:
+                    self._fail_pending(dead.__contains__, "Worker died")
+                continue
+            if replies is None:
+                return
+            for request_id, status, value in replies:
+                with self._lock:
+                    _, future = self._pending.pop(request_id)
+                if status == "ok":
+                    future.set_result(value)
+                elif status == "invalid_sku":
+                    future.set_exception(services.InvalidSku(value))
+                else:
+                    future.set_exception(WorkerError(value))
+
+    def _fail_pending(self, failed, reason: str):
+        with self._lock:
+            request_ids = [
+                request_id
+                for request_id, (worker, _) in self._pending.items()
+                if failed(worker)
+            ]
+            futures = [self._pending.pop(request_id)[1] for request_id in request_ids]
+        for future in futures:
+            future.set_exception(WorkerError(reason))
@@ -26,6 +26,7 @@ import tempfile
 # --------------------
 from batch_allocations.adapters import orm
 from batch_allocations.config import get_api_url, get_postgres_uri
+from batch_allocations.service_layer import messagebus
 
 # Fixture Definitions
 # -------------------
@@ -36,6 +37,12 @@ def set_test_env():
     os.environ["ENV"] = "test"
 
 
+@pytest.fixture(autouse=True)
+def reset_coalescing():
+    """Debounce windows would otherwise carry over from one test to the next"""
+    messagebus.configure_coalescing()
+
+
 @pytest.fixture(scope="function")
 def in_memory_db():
     engine = create_engine("sqlite:///:memory:")
@@ -104,6 +111,28 @@ def session_factory(in_memory_db):
     clear_mappers()
 
 
+@pytest.fixture(scope="function")
+def aggregate_session_factory(in_memory_db):
+    """Same as session_factory, with batches mapped in aggregate allocations mode"""
+    orm.start_mappers(aggregate_allocations=True)
+    yield sessionmaker(bind=in_memory_db)
+    clear_mappers()
+
+
+@pytest.fixture(scope="function")
+def file_session_factory(tmp_path):
+    """
+    Session factory on a SQLite file. Unlike :memory:, every session gets its own
+    connection, so two units of work really are two transactions.
+    """
+    engine = create_engine(f"sqlite:///{tmp_path / 'allocations.db'}")
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    yield sessionmaker(bind=engine)
+    clear_mappers()
+    engine.dispose()
+
+
 def wait_for_postgres_to_come_up(engine):
     deadline = time.time() + 10
     while time.time() < deadline:
@@ -9,6 +9,7 @@ The service layer helped the design avoid creating an inverted test pyramid.
 
 import pytest
 
+import json
 import requests
 
 # Domain Model Modules
@@ -58,3 +59,27 @@ def test_unhappy_path_returns_400_and_error_message():
     r = requests.post(f"{url}/allocate", json=data)
     assert r.status_code == 400
     assert r.json()["message"] == f"Invalid sku {unknown_sku}"
+
+
+@pytest.mark.usefixtures("restart_api")
+def test_bulk_allocation_streams_one_result_per_line():
+    sku, batchref = random_sku(), random_batchref(1)
+    post_to_add_batch(batchref, sku, 10, None)
+    lines = [{"orderid": random_orderid(), "sku": sku, "qty": 4} for _ in range(3)]
+    lines.append({"orderid": random_orderid(), "sku": random_sku(), "qty": 1})
+
+    def body():  # Sent with chunked transfer encoding
+        for line in lines:
+            yield (json.dumps(line) + "\n").encode()
+
+    url = get_api_url()
+    r = requests.post(f"{url}/allocate/bulk?chunk_size=2", data=body(), stream=True)
+
+    assert r.status_code == 200
+    results = [json.loads(line) for line in r.iter_lines() if line]
+    assert [(r["status"], r["batchref"]) for r in results] == [
+        ("allocated", batchref),
+        ("allocated", batchref),
+        ("out_of_stock", None),
+        ("invalid_sku", None),
+    ]
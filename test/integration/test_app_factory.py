@@ -0,0 +1,154 @@
+"""
+Tests the Flask application factory: lazy start-up, opt-in schema creation, shared
+engine
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import os
+import subprocess
+import sys
+
+import pytest
+from sqlalchemy import inspect
+from sqlalchemy.orm import clear_mappers
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.adapters import orm
+from batch_allocations.adapters.database import dispose_engines, get_engine
+from batch_allocations.adapters.shards import ShardMap, skus_on
+from batch_allocations.entrypoints.flask_app import create_app
+from test.random_refs import random_batchref, random_orderid, random_sku
+
+# Fixture Definitions
+# -------------------
+
+
+@pytest.fixture
+def db_uri(tmp_path):
+    yield f"sqlite:///{tmp_path / 'app.db'}"
+    clear_mappers()
+    dispose_engines()
+
+
+# Test Functions
+# --------------
+
+
+def test_importing_and_creating_the_app_does_not_need_a_database():
+    # No ENV=test and no DB_PASSWORD: any attempt to build the Postgres URI would fail
+    env = {k: v for k, v in os.environ.items() if k not in ("ENV", "DB_PASSWORD")}
+    code = (
+        "from batch_allocations.entrypoints.flask_app import create_app;"
+        " create_app()"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], env=env, capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stderr
+
+
+def test_the_app_only_imports_the_shards_with_a_shard_map():
+    # adapters/shards.py locks its map with fcntl, which is POSIX only
+    code = (
+        "import sys; from batch_allocations.entrypoints.flask_app import create_app;"
+        " create_app(); assert 'batch_allocations.adapters.shards' not in sys.modules"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stderr
+
+
+def test_schema_is_only_created_when_asked(db_uri):
+    create_app({"DB_URI": db_uri})
+    assert inspect(get_engine(db_uri)).get_table_names() == []
+
+    create_app({"DB_URI": db_uri, "CREATE_SCHEMA": True})
+    assert "batch_stock" in inspect(get_engine(db_uri)).get_table_names()
+
+
+def test_app_allocates_through_the_shared_engine(db_uri):
+    client = create_app({"DB_URI": db_uri, "CREATE_SCHEMA": True}).test_client()
+    sku, batchref = random_sku(), random_batchref(1)
+
+    r = client.post("/add_batch", json=dict(ref=batchref, sku=sku, qty=10, eta=None))
+    assert r.status_code == 201
+    r = client.post("/allocate", json=dict(orderid=random_orderid(), sku=sku, qty=2))
+
+    assert r.status_code == 201
+    assert r.json["batchref"] == batchref
+    assert get_engine(db_uri) is get_engine(db_uri)
+
+
+def test_start_mappers_is_idempotent(db_uri):
+    orm.start_mappers()
+    orm.start_mappers()
+
+    with pytest.raises(RuntimeError, match="aggregate_allocations=False"):
+        orm.start_mappers(aggregate_allocations=True)
+
+
+def test_metrics_endpoint(db_uri):
+    client = create_app({"DB_URI": db_uri, "CREATE_SCHEMA": True}).test_client()
+    sku = random_sku()
+    client.post("/add_batch", json=dict(ref=random_batchref(1), sku=sku, qty=1))
+    client.post("/allocate", json=dict(orderid=random_orderid(), sku=sku, qty=1))
+    client.post(
+        "/allocate", json=dict(orderid=random_orderid(), sku=random_sku(), qty=1)
+    )
+
+    r = client.get("/metrics")
+
+    assert r.status_code == 200
+    assert r.mimetype == "text/plain"
+    body = r.get_data(as_text=True)
+    assert 'service_duration_seconds_count{operation="allocate"}' in body
+    assert 'allocations_total{result="invalid_sku"}' in body
+    samples = dict(line.rsplit(" ", 1) for line in body.splitlines() if line[0] != "#")
+    assert float(samples["uow_commits_total"]) >= 2
+    assert float(samples["uow_rollbacks_total"]) >= 1  # The invalid SKU
+
+
+def test_app_on_a_memory_store_does_not_touch_the_database(db_uri, tmp_path):
+    app = create_app({"DB_URI": db_uri, "MEMORY_STORE_DIR": str(tmp_path / "store")})
+    client = app.test_client()
+    sku, batchref = random_sku(), random_batchref(1)
+
+    client.post("/add_batch", json=dict(ref=batchref, sku=sku, qty=10, eta=None))
+    r = client.post("/allocate", json=dict(orderid=random_orderid(), sku=sku, qty=2))
+    app.extensions["batch_allocations"].store.close()
+
+    assert r.status_code == 201
+    assert r.json["batchref"] == batchref
+    assert not os.path.exists(db_uri.removeprefix("sqlite:///"))
+
+
+def test_app_on_a_shard_map_allocates_on_the_skus_shard(db_uri, tmp_path):
+    path = str(tmp_path / "shards.json")
+    ShardMap({name: f"sqlite:///{tmp_path / name}.db" for name in "ab"}).save(path)
+    app = create_app({"DB_URI": db_uri, "SHARD_MAP": path, "CREATE_SCHEMA": True})
+    client = app.test_client()
+    sku, batchref = random_sku(), random_batchref(1)
+
+    client.post("/add_batch", json=dict(ref=batchref, sku=sku, qty=10, eta=None))
+    r = client.post("/allocate", json=dict(orderid=random_orderid(), sku=sku, qty=2))
+
+    assert r.status_code == 201
+    assert r.json["batchref"] == batchref
+    shard_map = app.extensions["batch_allocations"].shard_map
+    assert list(skus_on(shard_map, shard_map.shard_for(sku))) == [sku]
+    assert not os.path.exists(db_uri.removeprefix("sqlite:///"))
+
+
+def test_sku_index_is_only_used_with_a_negative_ttl(db_uri, monkeypatch):
+    monkeypatch.delenv("SKU_NEGATIVE_TTL", raising=False)
+    assert (
+        create_app({"DB_URI": db_uri}).extensions["batch_allocations"].sku_index is None
+    )
+
+    monkeypatch.setenv("SKU_NEGATIVE_TTL", "5")
+    state = create_app({"DB_URI": db_uri}).extensions["batch_allocations"]
+    assert state.sku_index is not None and state.sku_index.negative_ttl == 5
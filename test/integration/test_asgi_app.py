@@ -0,0 +1,112 @@
+"""
+Tests the ASGI app by calling it the way an ASGI server does
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip("aiosqlite")
+
+from sqlalchemy.orm import clear_mappers
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.adapters.database import dispose_async_engines, dispose_engines
+from batch_allocations.entrypoints.asgi_app import create_app
+from test.random_refs import random_batchref, random_orderid, random_sku
+
+# Fixture Definitions
+# -------------------
+
+
+@pytest.fixture
+def app(tmp_path):
+    yield create_app(
+        {"DB_URI": f"sqlite:///{tmp_path / 'asgi.db'}", "CREATE_SCHEMA": True}
+    )
+    clear_mappers()
+    dispose_engines()
+
+
+# Helper Functions
+# ----------------
+
+
+async def request(app, method, path, body=None):
+    """(status, JSON response) for one HTTP request"""
+    received = [{"type": "http.request", "body": json.dumps(body).encode()}]
+    sent = []
+
+    async def receive():
+        return received.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await app({"type": "http", "method": method, "path": path}, receive, send)
+    start, response = sent
+    return start["status"], json.loads(response["body"])
+
+
+def run(app, *requests):
+    """Runs the requests concurrently, then closes the connections like a shutdown"""
+
+    async def scenario():
+        try:
+            return await asyncio.gather(*(request(app, *r) for r in requests))
+        finally:
+            await dispose_async_engines()
+
+    return asyncio.run(scenario())
+
+
+# Test Functions
+# --------------
+
+
+def test_add_batch_then_allocate(app):
+    sku, batchref = random_sku(), random_batchref(1)
+    [(status, body)] = run(
+        app, ("POST", "/add_batch", dict(ref=batchref, sku=sku, qty=10, eta=None))
+    )
+    assert status == 201
+
+    [(status, body)] = run(
+        app, ("POST", "/allocate", dict(orderid=random_orderid(), sku=sku, qty=3))
+    )
+    assert status == 201
+    assert body["batchref"] == batchref
+
+
+def test_concurrent_requests_all_allocate(app):
+    sku, batchref = random_sku(), random_batchref(1)
+    run(app, ("POST", "/add_batch", dict(ref=batchref, sku=sku, qty=50, eta=None)))
+
+    responses = run(
+        app,
+        *[
+            ("POST", "/allocate", dict(orderid=random_orderid(), sku=sku, qty=1))
+            for _ in range(5)
+        ],
+    )
+
+    assert [status for status, _ in responses] == [201] * 5
+
+
+def test_errors(app):
+    responses = run(
+        app,
+        ("POST", "/allocate", dict(orderid=random_orderid(), sku=random_sku(), qty=1)),
+        ("POST", "/allocate", dict(orderid=random_orderid())),
+        ("GET", "/allocate"),
+        ("GET", "/nowhere"),
+    )
+
+    assert [status for status, _ in responses] == [400, 400, 405, 404]
+    assert responses[0][1]["message"].startswith("Invalid sku")
+    assert responses[1][1]["message"] == "Missing sku, qty"
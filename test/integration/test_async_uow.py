@@ -0,0 +1,151 @@
+"""
+Tests the asyncio unit of work and services against SQLite (aiosqlite)
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiosqlite")
+
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import clear_mappers
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.adapters import orm
+from batch_allocations.adapters.database import (
+    dispose_async_engines,
+    dispose_engines,
+    get_async_engine,
+    get_engine,
+)
+from batch_allocations.domain.events import OutOfStock
+from batch_allocations.service_layer import async_services, messagebus
+from batch_allocations.service_layer.services import InvalidSku
+from batch_allocations.service_layer.unit_of_work import AsyncSqlAlchemyUnitOfWork
+from test.random_refs import random_batchref, random_orderid, random_sku
+
+# Fixture Definitions
+# -------------------
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    uri = f"sqlite:///{tmp_path / 'async.db'}"
+    orm.metadata.create_all(get_engine(uri))
+    orm.start_mappers()
+    yield async_sessionmaker(bind=get_async_engine(uri), expire_on_commit=False)
+    asyncio.run(dispose_async_engines())
+    dispose_engines()
+    clear_mappers()
+
+
+# Helper Functions
+# ----------------
+
+
+async def allocations(session_factory, sku):
+    async with session_factory() as session:
+        rows = await session.execute(
+            text(
+                "SELECT o.orderid, b.reference FROM allocations"
+                " JOIN order_lines AS o ON orderline_id = o.id"
+                " JOIN batch_stock AS b ON batch_id = b.id WHERE o.sku = :sku"
+            ),
+            dict(sku=sku),
+        )
+        return dict(rows.all())
+
+
+# Test Functions
+# --------------
+
+
+def test_async_services_add_a_batch_and_allocate(session_factory):
+    sku, batchref, orderid = random_sku(), random_batchref(1), random_orderid()
+
+    async def scenario():
+        uow = AsyncSqlAlchemyUnitOfWork(session_factory)
+        await async_services.add_batch(batchref, sku, 10, None, uow)
+        allocated = await async_services.allocate(orderid, sku, 3, uow)
+        return allocated, await allocations(session_factory, sku)
+
+    allocated, rows = asyncio.run(scenario())
+
+    assert allocated == batchref
+    assert rows == {orderid: batchref}
+
+
+def test_rolls_back_uncommitted_work_by_default(session_factory):
+    sku = random_sku()
+
+    async def scenario():
+        uow = AsyncSqlAlchemyUnitOfWork(session_factory)
+        async with uow:
+            await uow.session.execute(
+                text("INSERT INTO products (sku, version_number) VALUES (:sku, 1)"),
+                dict(sku=sku),
+            )
+        async with session_factory() as session:
+            return (await session.execute(select(orm.products.c.sku))).all()
+
+    assert asyncio.run(scenario()) == []
+
+
+def test_unknown_sku_is_invalid(session_factory):
+    uow = AsyncSqlAlchemyUnitOfWork(session_factory)
+
+    with pytest.raises(InvalidSku):
+        asyncio.run(async_services.allocate(random_orderid(), random_sku(), 1, uow))
+
+
+def test_concurrent_allocations_are_all_committed(session_factory):
+    # They all change the same product: the losers of each race retry, and every race
+    # has a winner
+    sku, batchref = random_sku(), random_batchref(1)
+    orderids = [random_orderid() for _ in range(5)]  # MAX_ATTEMPTS
+
+    async def scenario():
+        await async_services.add_batch(
+            batchref, sku, 100, None, AsyncSqlAlchemyUnitOfWork(session_factory)
+        )
+        await asyncio.gather(
+            *(
+                async_services.allocate(
+                    orderid, sku, 1, AsyncSqlAlchemyUnitOfWork(session_factory)
+                )
+                for orderid in orderids
+            )
+        )
+        return await allocations(session_factory, sku)
+
+    assert asyncio.run(scenario()) == {orderid: batchref for orderid in orderids}
+
+
+def test_events_go_through_the_shared_message_bus(session_factory, monkeypatch):
+    dispatched = []
+    monkeypatch.setattr(messagebus, "dispatch", dispatched.append)
+    sku = random_sku()
+
+    async def scenario():
+        uow = AsyncSqlAlchemyUnitOfWork(session_factory)
+        await async_services.add_batch(random_batchref(1), sku, 1, None, uow)
+        await async_services.allocate(random_orderid(), sku, 5, uow)
+
+    asyncio.run(scenario())
+
+    assert dispatched == [OutOfStock(sku)]
+
+
+def test_lazy_loading_is_refused(session_factory):
+    async def scenario():
+        async with AsyncSqlAlchemyUnitOfWork(session_factory, loading="lazy"):
+            pass
+
+    with pytest.raises(ValueError, match="synchronous session"):
+        asyncio.run(scenario())
@@ -0,0 +1,122 @@
+"""
+Tests units of work sharing a ProductCache
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.adapters.cache import ProductCache
+from batch_allocations.domain.model import OrderLine
+from batch_allocations.service_layer.unit_of_work import SqlAlchemyUnitOfWork
+from test.integration.test_repository import count_queries
+from test.integration.test_uow import get_allocated_batch_ref, insert_batch
+from test.random_refs import random_batchref, random_orderid, random_sku
+
+# Helper Functions and Classes
+# ----------------------------
+
+
+def allocate(session_factory, cache, sku, qty=1):
+    orderid = random_orderid()
+    with SqlAlchemyUnitOfWork(session_factory, cache=cache) as uow:
+        batchref = uow.products.get(sku=sku).allocate(OrderLine(orderid, sku, qty))
+        uow.commit()
+    return orderid, batchref
+
+
+# Test Functions
+# --------------
+
+
+def test_unchanged_product_costs_a_single_version_check(session_factory, in_memory_db):
+    sku, batchref = random_sku(), random_batchref(1)
+    session = session_factory()
+    insert_batch(session, batchref, sku, 100, None)
+    session.commit()
+    cache = ProductCache()
+    allocate(session_factory, cache, sku)  # Miss: full load, cached on exit
+
+    def read():
+        with SqlAlchemyUnitOfWork(session_factory, cache=cache) as uow:
+            assert uow.products.get(sku=sku).batches[0].available_quantity == 99
+
+    assert count_queries(in_memory_db, read) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_cached_products_keep_allocating_correctly(session_factory):
+    sku, batchref = random_sku(), random_batchref(1)
+    session = session_factory()
+    insert_batch(session, batchref, sku, 3, None)
+    session.commit()
+    cache = ProductCache()
+
+    results = [allocate(session_factory, cache, sku) for _ in range(4)]
+
+    assert [ref for _, ref in results] == [batchref] * 3 + [None]
+    assert cache.hits == 3
+    orderid, _ = results[0]
+    assert get_allocated_batch_ref(session_factory(), orderid, sku) == batchref
+
+
+def test_changes_from_elsewhere_are_noticed(session_factory):
+    sku, batchref = random_sku(), random_batchref(1)
+    session = session_factory()
+    insert_batch(session, batchref, sku, 10, None)
+    session.commit()
+    cache = ProductCache()
+    allocate(session_factory, cache, sku)
+
+    allocate(session_factory, None, sku, qty=5)  # Not through the cache
+
+    with SqlAlchemyUnitOfWork(session_factory, cache=cache) as uow:
+        assert uow.products.get(sku=sku).batches[0].available_quantity == 4
+    assert cache.stale == 1
+
+
+def test_rolled_back_changes_do_not_reach_the_cache(session_factory):
+    sku, batchref = random_sku(), random_batchref(1)
+    session = session_factory()
+    insert_batch(session, batchref, sku, 10, None)
+    session.commit()
+    cache = ProductCache()
+    allocate(session_factory, cache, sku)
+
+    with SqlAlchemyUnitOfWork(session_factory, cache=cache) as uow:
+        uow.products.get(sku=sku).allocate(OrderLine(random_orderid(), sku, 5))
+        # No commit
+
+    with SqlAlchemyUnitOfWork(session_factory, cache=cache) as uow:
+        assert uow.products.get(sku=sku).batches[0].available_quantity == 9
+    assert cache.hits == 2
+
+
+def test_cache_refuses_aggregate_allocations_mode(aggregate_session_factory):
+    with pytest.raises(ValueError, match="aggregate"):
+        with SqlAlchemyUnitOfWork(aggregate_session_factory, cache=ProductCache()):
+            pass
+
+
+def test_counters_add_up_under_concurrent_lookups():
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # Switch threads as often as possible
+    try:
+        cache = ProductCache()
+
+        def lookups(n):
+            for _ in range(1000):
+                cache.get(random_sku(), lambda: None)
+
+        with ThreadPoolExecutor(8) as pool:
+            list(pool.map(lookups, range(8)))
+    finally:
+        sys.setswitchinterval(interval)
+
+    assert cache.stats()["misses"] == 8000
@@ -0,0 +1,100 @@
+"""
+Tests the shared engine: pool settings from the environment and the pool metrics
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.adapters.database import (
+    dispose_engines,
+    get_engine,
+    get_pool_metrics,
+)
+from batch_allocations.entrypoints.flask_app import create_app
+
+# Fixture Definitions
+# -------------------
+
+
+@pytest.fixture
+def db_uri(tmp_path):
+    yield f"sqlite:///{tmp_path / 'pool.db'}"
+    dispose_engines()
+
+
+# Test Functions
+# --------------
+
+
+def test_pool_is_configured_from_the_environment(db_uri, monkeypatch):
+    monkeypatch.setenv("DB_POOL_SIZE", "3")
+    monkeypatch.setenv("DB_MAX_OVERFLOW", "1")
+
+    engine = get_engine(db_uri)
+
+    assert engine.pool.size() == 3
+    assert get_pool_metrics(db_uri).snapshot(engine)["size"] == 3
+
+
+def test_checkouts_and_checkins_are_counted(db_uri):
+    engine = get_engine(db_uri)
+    for _ in range(3):
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+
+    stats = get_pool_metrics(db_uri).snapshot(engine)
+    assert stats["connects"] == 1  # Reused
+    assert stats["checkouts"] == 3
+    assert stats["checkins"] == 3
+    assert stats["checked_out"] == 0
+
+
+def test_a_checkout_that_times_out_is_counted(db_uri, monkeypatch):
+    monkeypatch.setenv("DB_POOL_SIZE", "1")
+    monkeypatch.setenv("DB_MAX_OVERFLOW", "0")
+    monkeypatch.setenv("DB_POOL_TIMEOUT", "0.1")
+    engine = get_engine(db_uri)
+
+    with engine.connect():
+        with pytest.raises(PoolTimeout):
+            engine.connect()
+
+    stats = get_pool_metrics(db_uri).snapshot()
+    assert stats["timeouts"] == 1
+    assert stats["max_wait_seconds"] >= 0.1
+
+
+def test_invalidated_connections_are_counted(db_uri):
+    engine = get_engine(db_uri)
+    with engine.connect() as conn:
+        conn.invalidate()
+
+    assert get_pool_metrics(db_uri).snapshot()["invalidations"] == 1
+
+
+def test_metrics_survive_disposing_the_pool(db_uri):
+    engine = get_engine(db_uri)
+    with engine.connect():
+        pass
+    engine.dispose()
+    with engine.connect():
+        pass
+
+    assert get_pool_metrics(db_uri).snapshot()["checkouts"] == 2
+    assert get_pool_metrics(db_uri).snapshot()["timeouts"] == 0
+
+
+def test_pool_stats_endpoint(db_uri):
+    client = create_app({"DB_URI": db_uri, "CREATE_SCHEMA": True}).test_client()
+
+    r = client.get("/stats/pool")
+
+    assert r.status_code == 200
+    assert r.json["checked_out"] == 0
+    assert r.json["checkouts"] >= 1  # Creating the schema
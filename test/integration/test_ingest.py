@@ -0,0 +1,121 @@
+"""
+Tests bulk batch ingestion and its command line entry point
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import json
+
+import pytest
+from sqlalchemy import create_engine, text
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.adapters import orm
+from batch_allocations.entrypoints import ingest as ingest_cli
+from batch_allocations.service_layer.ingest import InvalidBatchRowError, ingest_batches
+from batch_allocations.service_layer.services import allocate
+from batch_allocations.service_layer.unit_of_work import SqlAlchemyUnitOfWork
+from test.random_refs import random_batchref, random_orderid, random_sku
+
+# Helper Functions and Classes
+# ----------------------------
+
+
+def batch_records(sku, count, eta=None):
+    return [
+        dict(ref=random_batchref(i), sku=sku, qty=10, eta=eta) for i in range(count)
+    ]
+
+
+def query(engine, sql):
+    with engine.connect() as conn:
+        return conn.execute(text(sql)).all()
+
+
+# Test Functions
+# --------------
+
+
+def test_ingests_in_chunks_and_creates_products(in_memory_db):
+    first, second = random_sku(), random_sku()
+    records = batch_records(first, 3) + batch_records(second, 2, eta="2030-01-31")
+    reports = []
+
+    report = ingest_batches(
+        records, in_memory_db, chunk_size=2, progress=lambda r: reports.append(r.rows)
+    )
+
+    assert (report.rows, report.inserted, report.skipped) == (5, 5, 0)
+    assert reports == [2, 4, 5]
+    assert query(in_memory_db, "SELECT count(*) FROM batch_stock") == [(5,)]
+    assert sorted(query(in_memory_db, "SELECT sku FROM products")) == sorted(
+        [(first,), (second,)]
+    )
+
+
+def test_ingested_batches_can_be_allocated(session_factory, in_memory_db):
+    sku = random_sku()
+    [record] = batch_records(sku, 1)
+    ingest_batches([record], in_memory_db)
+
+    uow = SqlAlchemyUnitOfWork(session_factory)
+    assert allocate(random_orderid(), sku, 3, uow) == record["ref"]
+
+
+def test_loading_again_skips_existing_batches_and_bumps_versions(in_memory_db):
+    sku = random_sku()
+    records = batch_records(sku, 4)
+    ingest_batches(records, in_memory_db)
+
+    report = ingest_batches(records, in_memory_db, chunk_size=3)
+
+    assert (report.inserted, report.skipped) == (0, 4)
+    assert query(in_memory_db, "SELECT count(*) FROM batch_stock") == [(4,)]
+    # Once per chunk, so cached or concurrently loaded products see the new batches
+    assert query(in_memory_db, "SELECT version_number FROM products") == [(3,)]
+
+
+def test_invalid_rows_stop_the_load_after_the_committed_chunks(in_memory_db):
+    sku = random_sku()
+    records = batch_records(sku, 2) + [dict(ref="bad", sku=sku, qty="ten")]
+
+    with pytest.raises(InvalidBatchRowError, match="line 3"):
+        ingest_batches(records, in_memory_db, chunk_size=2)
+
+    assert query(in_memory_db, "SELECT count(*) FROM batch_stock") == [(2,)]
+
+
+@pytest.mark.parametrize("qty", [0, -5])
+def test_quantities_below_one_are_rejected(in_memory_db, qty):
+    records = [dict(ref=random_batchref(1), sku=random_sku(), qty=qty)]
+
+    with pytest.raises(InvalidBatchRowError, match="qty below 1"):
+        ingest_batches(records, in_memory_db)
+
+    assert query(in_memory_db, "SELECT count(*) FROM batch_stock") == [(0,)]
+
+
+@pytest.mark.parametrize("fmt", ["csv", "ndjson"])
+def test_cli_loads_csv_and_ndjson_files(tmp_path, capsys, fmt):
+    db_uri = f"sqlite:///{tmp_path / 'ingest.db'}"
+    engine = create_engine(db_uri)
+    orm.metadata.create_all(engine)
+    records = batch_records(random_sku(), 3, eta="2030-01-31")
+    path = tmp_path / f"batches.{fmt}"
+    if fmt == "csv":
+        lines = ["ref,sku,qty,eta"] + [
+            f"{r['ref']},{r['sku']},{r['qty']},{r['eta']}" for r in records
+        ]
+    else:
+        lines = [json.dumps(r) for r in records]
+    path.write_text("\n".join(lines) + "\n")
+
+    assert ingest_cli.main([str(path), "--db-uri", db_uri, "--quiet"]) == 0
+
+    assert "Loaded 3 batches (0 already there) from 3 rows" in capsys.readouterr().out
+    assert query(engine, "SELECT count(*) FROM batch_stock WHERE eta IS NOT NULL") == [
+        (3,)
+    ]
+    engine.dispose()
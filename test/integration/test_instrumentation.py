@@ -0,0 +1,122 @@
+"""
+Tests the per unit of work statement counts and timings, and the query budget
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import pytest
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import clear_mappers
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.adapters.database import dispose_engines, get_engine
+from batch_allocations.adapters.instrumentation import (
+    QueryBudgetExceededError,
+    QueryStats,
+    query_budget,
+)
+from batch_allocations.entrypoints.flask_app import create_app
+from batch_allocations.service_layer import services
+from batch_allocations.service_layer.unit_of_work import SqlAlchemyUnitOfWork
+from test.random_refs import random_batchref, random_orderid, random_sku
+
+# Fixture Definitions
+# -------------------
+
+
+@pytest.fixture
+def db_uri(tmp_path):
+    yield f"sqlite:///{tmp_path / 'app.db'}"
+    clear_mappers()
+    dispose_engines()
+
+
+# Helper Functions
+# ----------------
+
+
+def add_stock(session_factory, sku, batches=3):
+    for n in range(batches):
+        services.add_batch(
+            random_batchref(n), sku, 100, None, SqlAlchemyUnitOfWork(session_factory)
+        )
+
+
+# Test Functions
+# --------------
+
+
+def test_unit_of_work_records_its_statements_and_timings(session_factory):
+    sku = random_sku()
+    add_stock(session_factory, sku)
+    uow = SqlAlchemyUnitOfWork(session_factory)
+
+    services.allocate(random_orderid(), sku, 1, uow)
+
+    assert uow.stats.statements > 0
+    assert uow.stats.rows == 4  # The product and its three batches (no allocations yet)
+    assert uow.stats.db_seconds > 0
+    assert uow.stats.allocate_seconds > 0
+    assert uow.stats.commit_seconds > 0
+    assert uow.stats.dispatch_seconds > 0
+
+
+def test_outer_stats_add_up_every_unit_of_work(session_factory):
+    sku = random_sku()
+    add_stock(session_factory, sku, batches=1)
+
+    with QueryStats() as outer:
+        uows = [SqlAlchemyUnitOfWork(session_factory) for _ in range(2)]
+        for uow in uows:
+            services.allocate(random_orderid(), sku, 1, uow)
+
+    assert outer.statements == sum(uow.stats.statements for uow in uows)
+    assert outer.rows == sum(uow.stats.rows for uow in uows)
+
+
+def test_query_budget(session_factory):
+    sku = random_sku()
+    add_stock(session_factory, sku)
+
+    # Product, batches and allocations (selectin), then the new order line, the
+    # allocation and the product version
+    with query_budget(statements=6) as stats:
+        services.allocate(
+            random_orderid(), sku, 1, SqlAlchemyUnitOfWork(session_factory)
+        )
+    assert stats.statements == 6
+
+    with pytest.raises(QueryBudgetExceededError, match="budget was 3"):
+        with query_budget(statements=3):
+            services.allocate(
+                random_orderid(), sku, 1, SqlAlchemyUnitOfWork(session_factory)
+            )
+
+
+def test_failed_statements_leave_nothing_on_the_connection(db_uri):
+    with get_engine(db_uri).connect() as conn:
+        info = dict(conn.info)
+        with QueryStats() as stats:
+            for _ in range(3):
+                with pytest.raises(OperationalError):
+                    conn.exec_driver_sql("SELECT * FROM no_such_table")
+            assert conn.info == info
+            conn.exec_driver_sql("SELECT 1")
+
+    assert stats.statements == 1
+
+
+def test_flask_responses_report_the_request_stats(db_uri):
+    client = create_app({"DB_URI": db_uri, "CREATE_SCHEMA": True}).test_client()
+    sku = random_sku()
+    client.post("/add_batch", json=dict(ref=random_batchref(1), sku=sku, qty=5))
+
+    r = client.post("/allocate", json=dict(orderid=random_orderid(), sku=sku, qty=1))
+
+    assert int(r.headers["X-Query-Count"]) > 0
+    assert int(r.headers["X-Rows-Loaded"]) == 2
+    assert r.headers["Server-Timing"].startswith("db;dur=")
+    assert "allocate;dur=" in r.headers["Server-Timing"]
+    assert client.get("/").headers["X-Query-Count"] == "0"
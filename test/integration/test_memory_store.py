@@ -0,0 +1,227 @@
+"""
+Tests the in-memory product store: units of work on it, the write-ahead log,
+snapshots, recovery
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import os
+import threading
+
+import pytest
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.adapters.memory_store import (
+    ProductStore,
+    segment_path,
+    to_json,
+)
+from batch_allocations.domain.model import Batch, OrderLine, Product
+from batch_allocations.service_layer import services
+from batch_allocations.service_layer.unit_of_work import (
+    ConcurrentUpdateError,
+    InMemoryUnitOfWork,
+)
+from test.random_refs import random_batchref, random_orderid, random_sku
+
+# Fixture Definitions
+# -------------------
+
+
+@pytest.fixture
+def store_dir(tmp_path):
+    return str(tmp_path / "store")
+
+
+@pytest.fixture
+def open_store(store_dir):
+    """Opens the store in store_dir (again), closing them all at the end"""
+    stores = []
+
+    def open_store(**options):
+        stores.append(ProductStore(store_dir, **options))
+        return stores[-1]
+
+    yield open_store
+    for store in stores:
+        store.close()
+
+
+# Helper Functions
+# ----------------
+
+
+def state(store, sku):
+    with InMemoryUnitOfWork(store) as uow:
+        product = uow.products.get(sku)
+        return None if product is None else to_json(product)
+
+
+# Test Functions
+# --------------
+
+
+def test_services_allocate_on_the_store(open_store):
+    store = open_store()
+    sku, ref = random_sku(), random_batchref(1)
+    services.add_batch(ref, sku, 100, None, InMemoryUnitOfWork(store))
+
+    batchref = services.allocate(random_orderid(), sku, 10, InMemoryUnitOfWork(store))
+
+    assert batchref == ref
+    assert state(store, sku)["version"] == 2
+    with pytest.raises(services.InvalidSku):
+        services.allocate(
+            random_orderid(), "NO-SUCH-SKU", 10, InMemoryUnitOfWork(store)
+        )
+
+
+def test_committed_changes_survive_a_restart(open_store):
+    store = open_store()
+    sku = random_sku()
+    uow = InMemoryUnitOfWork(store)
+    services.add_batch("batch1", sku, 100, None, uow)
+    services.add_batch("batch2", sku, 100, None, uow)
+    services.allocate("o1", sku, 10, uow)
+    services.allocate("o2", sku, 95, uow)
+    before = state(store, sku)
+    store.close()
+
+    assert state(open_store(), sku) == before
+
+
+def test_uncommitted_changes_are_rolled_back(open_store):
+    store = open_store()
+    sku, new_sku = random_sku(), f"{random_sku()}-NEW"
+    services.add_batch("batch1", sku, 100, None, InMemoryUnitOfWork(store))
+    before = state(store, sku)
+
+    with InMemoryUnitOfWork(store) as uow:
+        product = uow.products.get(sku)
+        product.allocate(OrderLine("o1", sku, 10))
+        product.add_batch(Batch("batch2", sku, 50, None))
+        uow.products.add(Product(new_sku, batches=[]))
+
+    assert state(store, sku) == before
+    assert state(store, new_sku) is None
+    with InMemoryUnitOfWork(store) as uow:
+        assert uow.products.get(sku).batches[0].allocated_quantity == 0
+
+
+def test_a_product_is_locked_until_the_unit_of_work_commits(open_store):
+    store = open_store(lock_timeout=0.05)
+    sku = random_sku()
+    services.add_batch("batch1", sku, 100, None, InMemoryUnitOfWork(store))
+
+    with InMemoryUnitOfWork(store) as uow:
+        uow.products.get(sku)
+        with pytest.raises(ConcurrentUpdateError):
+            with InMemoryUnitOfWork(store) as other:
+                other.products.get(sku)
+        uow.commit()
+        with InMemoryUnitOfWork(store) as other:
+            assert other.products.get(sku) is not None
+
+
+def test_a_product_changed_outside_a_unit_of_work_is_an_error(open_store):
+    store = open_store()
+    sku = random_sku()
+    services.add_batch("batch1", sku, 100, None, InMemoryUnitOfWork(store))
+    with InMemoryUnitOfWork(store) as uow:
+        product = uow.products.get(sku)
+
+    with pytest.raises(RuntimeError):
+        product.allocate(OrderLine("o1", sku, 10))
+
+
+def test_concurrent_allocations_never_oversell_and_share_fsyncs(open_store):
+    store = open_store()
+    sku = random_sku()
+    services.add_batch("batch1", sku, 1000, None, InMemoryUnitOfWork(store))
+
+    def allocate_lines(n):
+        for i in range(100):
+            services.allocate(f"o{n}-{i}", sku, 2, InMemoryUnitOfWork(store))
+
+    threads = [threading.Thread(target=allocate_lines, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert store.commits == 1 + 500  # The batch, then the lines that fit
+    assert store.wal.flushes < store.wal.records
+    with InMemoryUnitOfWork(store) as uow:
+        assert uow.products.get(sku).batches[0].allocated_quantity == 1000
+
+
+def test_snapshot_replaces_the_log_it_covers(open_store, store_dir):
+    store = open_store()
+    skus = [f"{random_sku()}-{n}" for n in range(3)]
+    for sku in skus:
+        services.add_batch("batch1", sku, 100, None, InMemoryUnitOfWork(store))
+        services.allocate("o1", sku, 10, InMemoryUnitOfWork(store))
+    first_segment = segment_path(store_dir, store.wal.segment)
+
+    store.snapshot()
+    services.allocate("o2", skus[0], 10, InMemoryUnitOfWork(store))  # After it
+    before = [state(store, sku) for sku in skus]
+    store.close()
+
+    assert not os.path.exists(first_segment)
+    assert [state(open_store(), sku) for sku in skus] == before
+
+
+def test_snapshots_are_taken_every_so_many_commits(open_store):
+    store = open_store(snapshot_every=5)
+    sku = random_sku()
+    services.add_batch("batch1", sku, 100, None, InMemoryUnitOfWork(store))
+    for i in range(10):
+        services.allocate(f"o{i}", sku, 1, InMemoryUnitOfWork(store))
+    before = state(store, sku)
+    store.close()
+
+    assert store.snapshots >= 1
+    assert state(open_store(), sku) == before
+
+
+def test_a_snapshot_taken_during_commits_recovers_them_all(open_store):
+    store = open_store()
+    skus = [f"{random_sku()}-{n}" for n in range(4)]
+    for sku in skus:
+        services.add_batch("batch1", sku, 10_000, None, InMemoryUnitOfWork(store))
+
+    def allocate_lines(sku):
+        for i in range(200):
+            services.allocate(f"o{i}", sku, 1, InMemoryUnitOfWork(store))
+
+    threads = [threading.Thread(target=allocate_lines, args=(sku,)) for sku in skus]
+    for thread in threads:
+        thread.start()
+    store.snapshot()
+    for thread in threads:
+        thread.join()
+    before = [state(store, sku) for sku in skus]
+    store.close()
+
+    assert [state(open_store(), sku) for sku in skus] == before
+
+
+def test_an_incomplete_last_record_is_ignored(open_store, store_dir):
+    store = open_store()
+    sku = random_sku()
+    services.add_batch("batch1", sku, 100, None, InMemoryUnitOfWork(store))
+    before = state(store, sku)
+    path = segment_path(store_dir, store.wal.segment)
+    store.close()
+    with open(path, "ab") as f:
+        f.write(b'{"sku":"' + sku.encode() + b'","version":2,"ops":[["allo')
+
+    store = open_store()
+
+    assert state(store, sku) == before
+    services.allocate("o1", sku, 10, InMemoryUnitOfWork(store))  # Logs to a new segment
+    store.close()
+    assert state(open_store(), sku)["version"] == 2
@@ -0,0 +1,102 @@
+"""
+Testing the schema migration path and that the hot queries use the indexes
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import pytest
+from sqlalchemy import create_engine, inspect, select, text
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.adapters import migrations
+from batch_allocations.adapters.orm import (
+    allocations,
+    batch_stock,
+    metadata,
+    order_lines,
+)
+
+# Helper Functions
+# ----------------
+
+
+def create_tables_without_indexes(engine):
+    """The schema as metadata.create_all built it before the indexes existed"""
+    with engine.begin() as conn:
+        metadata.create_all(conn)
+        for table in metadata.sorted_tables:
+            for index in table.indexes:
+                conn.execute(text(f"DROP INDEX {index.name}"))
+
+
+def index_names(engine, table):
+    return {index["name"] for index in inspect(engine).get_indexes(table.name)}
+
+
+def query_plan(engine, statement):
+    sql = statement.compile(engine, compile_kwargs={"literal_binds": True})
+    with engine.connect() as conn:
+        rows = conn.execute(text(f"EXPLAIN QUERY PLAN {sql}")).all()
+    return " | ".join(row[-1] for row in rows)
+
+
+# Test Functions
+# --------------
+
+
+def test_upgrade_adds_missing_indexes_to_existing_tables():
+    engine = create_engine("sqlite:///:memory:")
+    create_tables_without_indexes(engine)
+
+    created = migrations.upgrade(engine)
+
+    assert "uq_batch_stock_reference" in created
+    assert "ix_batch_stock_sku" in index_names(engine, batch_stock)
+    assert migrations.upgrade(engine) == []  # Running it again is a no-op
+
+
+def test_upgrade_refuses_to_add_unique_index_over_duplicates():
+    engine = create_engine("sqlite:///:memory:")
+    create_tables_without_indexes(engine)
+    with engine.begin() as conn:
+        for _ in range(2):
+            conn.execute(
+                text(
+                    "INSERT INTO batch_stock (reference, sku, _purchased_quantity)"
+                    " VALUES ('batch1', 'SHABBY-COUCH', 10)"
+                )
+            )
+
+    with pytest.raises(ValueError, match="uq_batch_stock_reference"):
+        migrations.upgrade(engine)
+
+
+@pytest.mark.parametrize(
+    "statement, index",
+    [
+        (select(batch_stock).where(batch_stock.c.sku == "X"), "ix_batch_stock_sku"),
+        (
+            select(batch_stock).where(batch_stock.c.reference == "batch1"),
+            "uq_batch_stock_reference",
+        ),
+        (
+            select(allocations).where(allocations.c.batch_id == 1),
+            "uq_allocations_batch_id_orderline_id",
+        ),
+        (
+            select(allocations).where(allocations.c.orderline_id == 1),
+            "ix_allocations_orderline_id",
+        ),
+        (
+            select(order_lines).where(
+                order_lines.c.orderid == "o1", order_lines.c.sku == "X"
+            ),
+            "ix_order_lines_orderid_sku",
+        ),
+    ],
+)
+def test_hot_queries_use_an_index(in_memory_db, statement, index):
+    plan = query_plan(in_memory_db, statement)
+    assert f"USING INDEX {index}" in plan or f"USING COVERING INDEX {index}" in plan
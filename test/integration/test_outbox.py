@@ -0,0 +1,151 @@
+""" """
+
+# Boilerplate Modules
+# -------------------
+
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import select, text
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.adapters import outbox
+from batch_allocations.adapters.orm import outbox as outbox_table
+from batch_allocations.domain.events import OutOfStock
+from batch_allocations.domain.model import OrderLine
+from batch_allocations.service_layer import messagebus
+from batch_allocations.service_layer.outbox import OutboxDispatcher
+from batch_allocations.service_layer.unit_of_work import SqlAlchemyUnitOfWork
+from test.integration.test_uow import insert_batch
+from test.random_refs import random_batchref, random_orderid, random_sku
+
+# Helper Functions and Classes
+# ----------------------------
+
+
+@pytest.fixture
+def handled(monkeypatch):
+    events = []
+    monkeypatch.setitem(messagebus.HANDLERS, OutOfStock, [events.append])
+    return events
+
+
+def add_out_of_stock_events(engine, *skus):
+    with engine.begin() as conn:
+        conn.execute(
+            outbox_table.insert(),
+            [
+                dict(
+                    event_type="OutOfStock",
+                    payload=f'{{"sku": "{sku}"}}',
+                    created_at=outbox.utcnow(),
+                )
+                for sku in skus
+            ],
+        )
+
+
+def pending(engine):
+    with engine.connect() as conn:
+        return conn.execute(
+            select(outbox_table.c.payload).where(outbox_table.c.processed_at.is_(None))
+        ).all()
+
+
+# Test Functions
+# --------------
+
+
+def test_outbox_uow_stores_events_instead_of_dispatching(
+    session_factory, in_memory_db, handled
+):
+    sku = random_sku()
+    session = session_factory()
+    insert_batch(session, random_batchref(1), sku, 10, None)
+    session.commit()
+
+    with SqlAlchemyUnitOfWork(session_factory, use_outbox=True) as uow:
+        product = uow.products.get(sku=sku)
+        product.allocate(OrderLine(random_orderid(), sku, 20))
+        uow.commit()
+
+    assert handled == []
+    [(payload,)] = pending(in_memory_db)
+    assert sku in payload
+
+
+def test_outbox_rows_roll_back_with_the_aggregate(session_factory, in_memory_db):
+    sku = random_sku()
+    session = session_factory()
+    insert_batch(session, random_batchref(1), sku, 10, None)
+    session.commit()
+
+    with SqlAlchemyUnitOfWork(session_factory, use_outbox=True) as uow:
+        product = uow.products.get(sku=sku)
+        product.allocate(OrderLine(random_orderid(), sku, 20))
+        uow._write_outbox()  # What commit() does first, but the commit never happens
+
+    assert pending(in_memory_db) == []
+
+
+def test_dispatcher_drains_in_batches(in_memory_db, handled):
+    skus = [f"{random_sku()}-{n}" for n in range(5)]  # Distinct, so none is debounced
+    add_out_of_stock_events(in_memory_db, *skus)
+    dispatcher = OutboxDispatcher(in_memory_db, batch_size=2)
+
+    assert dispatcher.drain_once() == 2
+    assert dispatcher.drain() == 3
+
+    assert handled == [OutOfStock(sku) for sku in skus]
+    assert dispatcher.processed == 5
+    assert pending(in_memory_db) == []
+
+
+def test_failed_rows_are_retried_until_they_run_out_of_attempts(
+    in_memory_db, monkeypatch
+):
+    def failing_handler(event):
+        raise RuntimeError("smtp is down")
+
+    monkeypatch.setitem(messagebus.HANDLERS, OutOfStock, [failing_handler])
+    add_out_of_stock_events(in_memory_db, random_sku())
+    dispatcher = OutboxDispatcher(in_memory_db, max_attempts=2)
+
+    assert dispatcher.drain_once() == 1
+    assert dispatcher.drain_once() == 1
+    assert dispatcher.drain_once() == 0  # Given up
+
+    with in_memory_db.connect() as conn:
+        [[attempts, last_error]] = conn.execute(
+            text("SELECT attempts, last_error FROM outbox")
+        )
+    assert attempts == 2
+    assert "smtp is down" in last_error
+    assert dispatcher.failed == 2
+
+
+def test_expired_claims_are_picked_up_again(in_memory_db, handled):
+    add_out_of_stock_events(in_memory_db, random_sku())
+    with in_memory_db.begin() as conn:  # A dispatcher that claims and then dies
+        assert len(outbox.claim(conn, 10, timedelta(seconds=60), 5)) == 1
+
+    assert OutboxDispatcher(in_memory_db, lease=60).drain_once() == 0
+    assert OutboxDispatcher(in_memory_db, lease=0).drain_once() == 1
+    assert len(handled) == 1
+
+
+def test_processed_rows_are_purged_after_the_retention(in_memory_db, handled):
+    add_out_of_stock_events(in_memory_db, f"{random_sku()}-1", f"{random_sku()}-2")
+    OutboxDispatcher(in_memory_db).drain()
+    add_out_of_stock_events(in_memory_db, random_sku())  # Not processed yet
+
+    assert OutboxDispatcher(in_memory_db, retention=3600).purge() == 0
+    assert OutboxDispatcher(in_memory_db, retention=None).purge() == 0
+    dispatcher = OutboxDispatcher(in_memory_db, retention=0)
+    assert dispatcher.purge() == 2
+
+    with in_memory_db.connect() as conn:
+        assert conn.execute(text("SELECT count(*) FROM outbox")).scalar_one() == 1
+    assert len(pending(in_memory_db)) == 1
+    assert dispatcher.purged == 2
@@ -6,12 +6,13 @@ Testing Repository
 # -------------------
 
 
-from sqlalchemy import text
+import pytest
+from sqlalchemy import event, text
 
 # Domain Model Modules
 # --------------------
-from batch_allocations.domain.model import Batch, OrderLine
 from batch_allocations.adapters.repository import SqlAlchemyRepository
+from batch_allocations.domain.model import Batch, OrderLine
 
 # Fixtures
 # --------
@@ -51,6 +52,41 @@ def insert_batch(session, batch_ref):
     return batch_id_result
 
 
+def insert_product_with_allocated_batches(session, sku, batch_count):
+    session.execute(text("INSERT INTO products (sku) VALUES (:sku)"), dict(sku=sku))
+    for i in range(batch_count):
+        [[batch_id]] = session.execute(
+            text(
+                "INSERT INTO batch_stock (reference, sku, _purchased_quantity, eta)"
+                " VALUES (:ref, :sku, 100, NULL) RETURNING id"
+            ),
+            dict(ref=f"batch{i}", sku=sku),
+        )
+        [[orderline_id]] = session.execute(
+            text(
+                "INSERT INTO order_lines (orderid, sku, qty)"
+                " VALUES (:orderid, :sku, 1) RETURNING id"
+            ),
+            dict(orderid=f"order{i}", sku=sku),
+        )
+        insert_allocation(session, orderline_id, batch_id)
+    session.commit()
+
+
+def count_queries(engine, fn):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        fn()
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return len(statements)
+
+
 def insert_allocation(session, orderline_id, batch_id):
     session.execute(
         text(
@@ -94,3 +130,34 @@ def test_repository_can_retrieve_a_batch_with_allocations(session):
     assert retrieved._allocations == {
         OrderLine("order1", "GENERIC-SOFA", 12),
     }
+
+
+def test_retrieved_batch_knows_its_allocated_quantity(session):
+    orderline_id = insert_order_line(session)
+    batch1_id = insert_batch(session, "batch1")
+    insert_allocation(session, orderline_id, batch1_id)
+
+    repo = SqlAlchemyRepository(session)
+    retrieved = repo.get_by_batchref("batch1")
+
+    assert retrieved.allocated_quantity == 12
+    assert retrieved.available_quantity == 88
+
+
+@pytest.mark.parametrize(
+    "loading, expected_queries",
+    [("selectin", 3), ("joined", 1), ("lazy", 1 + 1 + 5)],
+)
+def test_loading_strategy_fixes_the_number_of_queries(
+    session, in_memory_db, loading, expected_queries
+):
+    insert_product_with_allocated_batches(session, "GENERIC-SOFA", batch_count=5)
+    repo = SqlAlchemyRepository(session, loading=loading)
+
+    def get_product_and_its_allocations():
+        product = repo.get("GENERIC-SOFA")
+        assert sum(b.allocated_quantity for b in product.batches) == 5
+
+    assert count_queries(in_memory_db, get_product_and_its_allocations) == (
+        expected_queries
+    )
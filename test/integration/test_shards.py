@@ -0,0 +1,286 @@
+"""
+Tests the sharded unit of work and the shard tooling, with SQLite files as shards
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import json
+import threading
+
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.orm import clear_mappers
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.adapters import metrics, orm
+from batch_allocations.adapters.database import dispose_engines
+from batch_allocations.adapters.hashring import HashRing
+from batch_allocations.adapters.shards import (
+    CrossShardError,
+    ShardMap,
+    _copy_rows,
+    add_shard,
+    move_sku,
+    purge_strays,
+    rebalance,
+    strays,
+    upgrade_shards,
+)
+from batch_allocations.domain.model import Batch, OrderLine, Product
+from batch_allocations.entrypoints import shards as shards_cli
+from batch_allocations.service_layer import services
+from batch_allocations.service_layer.unit_of_work import (
+    ConcurrentUpdateError,
+    ShardedUnitOfWork,
+    SqlAlchemyUnitOfWork,
+)
+from test.random_refs import random_batchref, random_orderid, random_sku
+
+# Fixture Definitions
+# -------------------
+
+
+@pytest.fixture
+def shard_map(tmp_path):
+    orm.start_mappers()
+    shard_map = ShardMap(
+        {name: f"sqlite:///{tmp_path / name}.db" for name in ("a", "b", "c")}
+    )
+    upgrade_shards(shard_map)
+    shard_map.save(str(tmp_path / "shards.json"))
+    yield shard_map
+    clear_mappers()
+    dispose_engines()
+
+
+# Helper Functions
+# ----------------
+
+
+def stock(shard_map, count, qty=100):
+    skus = [f"{random_sku()}-{n}" for n in range(count)]
+    for sku in skus:
+        services.add_batch(
+            random_batchref(1), sku, qty, None, ShardedUnitOfWork(shard_map)
+        )
+    return skus
+
+
+def sku_for_new_shard(shard_map, name):
+    """A SKU the ring sends to shard `name` once it is added"""
+    ring = HashRing(sorted(shard_map.shards) + [name], shard_map.replicas)
+    return next(sku for sku in iter(random_sku, None) if ring.node_for(sku) == name)
+
+
+def count_rows(shard_map, shard, table, sku):
+    with shard_map.engine(shard).connect() as conn:
+        query = select(func.count()).select_from(table).where(table.c.sku == sku)
+        return conn.execute(query).scalar_one()
+
+
+# Test Functions
+# --------------
+
+
+def test_each_sku_lives_on_its_shard(shard_map):
+    skus = stock(shard_map, 30)
+
+    for sku in skus:
+        services.allocate(random_orderid(), sku, 10, ShardedUnitOfWork(shard_map))
+
+    for sku in skus:
+        home = shard_map.shard_for(sku)
+        for shard in shard_map.shards:
+            expected = 1 if shard == home else 0
+            assert count_rows(shard_map, shard, orm.batch_stock, sku) == expected
+            assert count_rows(shard_map, shard, orm.order_lines, sku) == expected
+    assert all(strays(shard_map)[shard] == [] for shard in shard_map.shards)
+    assert len({shard_map.shard_for(sku) for sku in skus}) == 3
+
+
+def test_a_unit_of_work_stays_on_one_shard(shard_map):
+    first, *skus = stock(shard_map, 10)
+    elsewhere = next(
+        sku for sku in skus if shard_map.shard_for(sku) != shard_map.shard_for(first)
+    )
+
+    with ShardedUnitOfWork(shard_map) as uow:
+        uow.products.get(first)
+        with pytest.raises(CrossShardError):
+            uow.products.get(elsewhere)
+
+
+def test_concurrent_updates_are_still_detected(shard_map):
+    [sku] = stock(shard_map, 1)
+
+    with ShardedUnitOfWork(shard_map) as uow:
+        product = uow.products.get(sku)
+        product.allocate(OrderLine(random_orderid(), sku, 10))
+        services.allocate(random_orderid(), sku, 10, ShardedUnitOfWork(shard_map))
+        with pytest.raises(ConcurrentUpdateError):
+            uow.commit()
+
+
+def test_moving_a_sku_keeps_its_allocations(shard_map):
+    [sku] = stock(shard_map, 1, qty=10)
+    services.allocate("order1", sku, 6, ShardedUnitOfWork(shard_map))
+    source = shard_map.shard_for(sku)
+    target = next(shard for shard in shard_map.shards if shard != source)
+
+    assert move_sku(shard_map, sku, target)
+
+    other_process = ShardMap.load(shard_map.path)
+    assert other_process.shard_for(sku) == target
+    assert count_rows(shard_map, source, orm.batch_stock, sku) == 0
+    uow = ShardedUnitOfWork(other_process)
+    assert services.allocate(random_orderid(), sku, 6, uow) is None
+    assert services.allocate(random_orderid(), sku, 4, uow) is not None
+    assert not move_sku(shard_map, sku, target)
+
+
+def test_a_unit_of_work_that_loaded_a_moved_sku_retries(shard_map):
+    [sku] = stock(shard_map, 1)
+    target = next(s for s in shard_map.shards if s != shard_map.shard_for(sku))
+
+    with ShardedUnitOfWork(shard_map) as uow:
+        product = uow.products.get(sku)
+        product.allocate(OrderLine(random_orderid(), sku, 10))
+        move_sku(ShardMap.load(shard_map.path), sku, target)  # Another process
+        with pytest.raises(ConcurrentUpdateError):
+            uow.commit()
+
+    # The retry sees the new map
+    assert services.allocate(random_orderid(), sku, 10, ShardedUnitOfWork(shard_map))
+    assert count_rows(shard_map, target, orm.order_lines, sku) == 1
+
+
+def test_a_sku_moved_after_the_unit_of_work_started_is_found_by_the_retry(shard_map):
+    [sku] = stock(shard_map, 1)
+    target = next(s for s in shard_map.shards if s != shard_map.shard_for(sku))
+
+    class MovedOnEntry(ShardedUnitOfWork):
+        moved = False
+
+        def __enter__(self):
+            super().__enter__()  # Reads the map
+            if not self.moved:  # Then another process moves the SKU
+                self.moved = True
+                move_sku(ShardMap.load(shard_map.path), sku, target)
+            return self
+
+    retries = metrics.uow_retries.value("allocate")
+
+    # Not on the shard the map gave on entry: the retry reads the map again
+    assert services.allocate(random_orderid(), sku, 10, MovedOnEntry(shard_map))
+    assert metrics.uow_retries.value("allocate") == retries + 1
+    assert count_rows(shard_map, target, orm.order_lines, sku) == 1
+
+
+def test_adding_a_shard_pins_skus_until_rebalanced(shard_map, tmp_path):
+    skus = stock(shard_map, 40)
+
+    pinned = add_shard(shard_map, "d", f"sqlite:///{tmp_path / 'd'}.db")
+
+    assert pinned and all(shard_map.ring.node_for(sku) == "d" for sku in pinned)
+    for sku in skus:  # Still found where they are
+        assert services.allocate(random_orderid(), sku, 1, ShardedUnitOfWork(shard_map))
+
+    assert sorted(rebalance(shard_map)) == sorted(pinned)
+    assert shard_map.overrides == {}
+    assert all(count_rows(shard_map, "d", orm.products, sku) == 1 for sku in pinned)
+    assert all(found == [] for found in strays(shard_map).values())
+    assert json.load(open(shard_map.path))["shards"]["d"].endswith("d.db")
+
+
+def test_adding_a_shard_waits_for_products_being_created(shard_map, tmp_path):
+    sku = sku_for_new_shard(shard_map, "d")
+    other_process = ShardMap.load(shard_map.path)
+    home = other_process.shard_for(sku)
+    uri = f"sqlite:///{tmp_path / 'd'}.db"
+    adding = threading.Thread(target=add_shard, args=(shard_map, "d", uri))
+
+    with ShardedUnitOfWork(other_process) as uow:
+        assert uow.products.get(sku) is None
+        batch = Batch(random_batchref(1), sku, 10, None)
+        uow.products.add(Product(sku, batches=[batch]))
+        adding.start()
+        adding.join(timeout=0.5)
+        assert adding.is_alive()  # Until the product is committed
+        uow.commit()
+    adding.join()
+
+    assert shard_map.overrides == {sku: home}  # Found by the scan
+    uow = ShardedUnitOfWork(other_process)
+    assert services.allocate(random_orderid(), sku, 10, uow)
+    assert count_rows(shard_map, "d", orm.products, sku) == 0
+
+
+def test_a_product_created_on_the_old_map_is_retried_on_the_new_shard(
+    shard_map, tmp_path
+):
+    sku = sku_for_new_shard(shard_map, "d")
+    other_process = ShardMap.load(shard_map.path)
+
+    with ShardedUnitOfWork(other_process) as uow:
+        assert uow.products.get(sku) is None  # On the old ring's shard
+        add_shard(shard_map, "d", f"sqlite:///{tmp_path / 'd'}.db")
+        with pytest.raises(ConcurrentUpdateError):
+            uow.products.add(Product(sku, batches=[]))
+
+    uow = ShardedUnitOfWork(other_process)
+    services.add_batch(random_batchref(1), sku, 10, None, uow)
+    counts = {s: count_rows(shard_map, s, orm.products, sku) for s in shard_map.shards}
+    assert sum(counts.values()) == counts["d"] == 1
+
+
+def test_purge_strays_deletes_the_copy_of_an_interrupted_move(shard_map):
+    [sku] = stock(shard_map, 1)
+    services.allocate(random_orderid(), sku, 1, ShardedUnitOfWork(shard_map))
+    source = shard_map.shard_for(sku)
+    target = next(s for s in shard_map.shards if s != source)
+    with shard_map.engine(source).connect() as src:
+        with shard_map.engine(target).begin() as dst:
+            _copy_rows(src, dst, sku)  # Died before pointing the map at it
+
+    assert strays(shard_map)[target] == [sku]
+    assert purge_strays(shard_map)[target] == [sku]
+
+    assert count_rows(shard_map, target, orm.products, sku) == 0
+    assert count_rows(shard_map, source, orm.products, sku) == 1
+
+
+def test_purge_strays_keeps_a_stray_with_allocations_of_its_own(shard_map):
+    [sku] = stock(shard_map, 1)
+    elsewhere = next(s for s in shard_map.shards if s != shard_map.shard_for(sku))
+    uow = SqlAlchemyUnitOfWork(shard_map.session_factory(elsewhere))  # Created twice
+    services.add_batch(random_batchref(1), sku, 10, None, uow)
+    services.allocate(random_orderid(), sku, 5, uow)
+
+    assert purge_strays(shard_map)[elsewhere] == []
+    assert strays(shard_map)[elsewhere] == [sku]
+    assert count_rows(shard_map, elsewhere, orm.order_lines, sku) == 1
+
+
+def test_command_line_tool(tmp_path, capsys):
+    path = str(tmp_path / "cli.json")
+    shards = [f"--shard={name}=sqlite:///{tmp_path / name}.db" for name in "xy"]
+    try:
+        assert shards_cli.main(["--map", path, "init"] + shards) == 0
+        orm.start_mappers()
+        shard_map = ShardMap.load(path)
+        [sku] = stock(shard_map, 1)
+        target = "y" if shard_map.shard_for(sku) == "x" else "x"
+
+        assert shards_cli.main(["--map", path, "move", sku, target]) == 0
+        assert shards_cli.main(["--map", path, "status"]) == 0
+        # Not where the map would look for it, or there is nothing to move
+        missing = "y" if shard_map.shard_for("NO-SUCH-SKU") == "x" else "x"
+        assert shards_cli.main(["--map", path, "move", "NO-SUCH-SKU", missing]) == 1
+    finally:
+        clear_mappers()
+        dispose_engines()
+
+    assert ShardMap.load(path).shard_for(sku) == target
+    assert f"{target}: 1 SKUs" in capsys.readouterr().out
@@ -0,0 +1,149 @@
+"""
+Tests units of work turning away unknown SKUs through a SkuIndex
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import pytest
+from sqlalchemy import text
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.adapters.sku_index import SkuIndex
+from batch_allocations.service_layer.ingest import ingest_batches
+from batch_allocations.service_layer.services import InvalidSku, add_batch, allocate
+from batch_allocations.service_layer.unit_of_work import SqlAlchemyUnitOfWork
+from test.integration.test_repository import count_queries
+from test.integration.test_uow import insert_batch
+from test.random_refs import random_batchref, random_orderid, random_sku
+
+# Helper Functions and Classes
+# ----------------------------
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def found(session_factory, sku_index, sku):
+    with SqlAlchemyUnitOfWork(session_factory, sku_index=sku_index) as uow:
+        return uow.products.get(sku=sku) is not None
+
+
+# Test Functions
+# --------------
+
+
+def test_unknown_skus_are_rejected_without_a_query(session_factory, in_memory_db):
+    sku_index = SkuIndex(negative_ttl=5)
+    uow = SqlAlchemyUnitOfWork(session_factory, sku_index=sku_index)
+    with pytest.raises(InvalidSku):
+        allocate(random_orderid(), "NO-SUCH-THING", 1, uow)  # Looked up once
+
+    def again():
+        with pytest.raises(InvalidSku):
+            allocate(random_orderid(), "NO-SUCH-THING", 1, uow)
+
+    assert count_queries(in_memory_db, again) == 0
+    assert (sku_index.lookups, sku_index.rejected) == (1, 1)
+
+
+def test_warmed_skus_are_loaded(session_factory, in_memory_db):
+    sku = random_sku()
+    session = session_factory()
+    insert_batch(session, random_batchref(1), sku, 10, None)
+    session.commit()
+    sku_index = SkuIndex()
+
+    with in_memory_db.connect() as conn:
+        assert sku_index.warm(conn) == 1
+
+    assert found(session_factory, sku_index, sku)
+    assert sku_index.lookups == 0
+
+
+def test_new_products_are_never_rejected_in_this_process(session_factory):
+    sku = random_sku()
+    sku_index = SkuIndex(negative_ttl=60)
+    assert not found(session_factory, sku_index, sku)  # Now known as unknown
+
+    add_batch(
+        random_batchref(1),
+        sku,
+        10,
+        None,
+        SqlAlchemyUnitOfWork(session_factory, sku_index=sku_index),
+    )
+
+    assert found(session_factory, sku_index, sku)
+
+
+def test_products_created_elsewhere_are_found_once_the_ttl_expires(session_factory):
+    sku = random_sku()
+    clock = FakeClock()
+    sku_index = SkuIndex(negative_ttl=5, clock=clock)
+    assert not found(session_factory, sku_index, sku)
+
+    session = session_factory()  # Another process adds the product
+    insert_batch(session, random_batchref(1), sku, 10, None)
+    session.commit()
+
+    assert not found(session_factory, sku_index, sku)
+    clock.now = 5
+    assert found(session_factory, sku_index, sku)
+    assert len(sku_index) == 1
+
+
+def test_unknown_skus_are_looked_up_every_time_by_default(session_factory):
+    sku = random_sku()
+    sku_index = SkuIndex()
+    assert not found(session_factory, sku_index, sku)
+
+    session = session_factory()  # Another process adds the product
+    insert_batch(session, random_batchref(1), sku, 10, None)
+    session.commit()
+
+    assert found(session_factory, sku_index, sku)
+
+
+def test_adding_a_batch_drops_the_negative_entry(session_factory):
+    sku = random_sku()
+    sku_index = SkuIndex(negative_ttl=60)
+    assert not found(session_factory, sku_index, sku)
+    session = session_factory()  # The product is created elsewhere meanwhile
+    insert_batch(session, random_batchref(1), sku, 10, None)
+    session.commit()
+
+    sku_index.forget(sku)  # What /add_batch does first
+    add_batch(
+        random_batchref(2),
+        sku,
+        10,
+        None,
+        SqlAlchemyUnitOfWork(session_factory, sku_index=sku_index),
+    )
+
+    with session_factory() as session:
+        [(batches,)] = session.execute(
+            text("SELECT count(*) FROM batch_stock WHERE sku = :sku"), dict(sku=sku)
+        )
+    assert batches == 2
+
+
+def test_ingested_skus_are_indexed(session_factory, in_memory_db):
+    sku = random_sku()
+    sku_index = SkuIndex(negative_ttl=60)
+    assert not found(session_factory, sku_index, sku)
+
+    ingest_batches(
+        [dict(ref=random_batchref(1), sku=sku, qty=10)],
+        in_memory_db,
+        sku_index=sku_index,
+    )
+
+    assert found(session_factory, sku_index, sku)
@@ -4,21 +4,16 @@
 # -------------------
 
 import pytest
-from typing import List
-
 from sqlalchemy import text
 
-import threading
-import time
-import traceback
-
 # Domain Model Modules
 # --------------------
-
-from batch_allocations.domain.model import OrderLine
-from batch_allocations.service_layer.unit_of_work import SqlAlchemyUnitOfWork
-
-from test.random_refs import random_sku, random_orderid, random_batchref
+from batch_allocations.domain.model import Batch, OrderLine, Product
+from batch_allocations.service_layer.services import allocate_batch
+from batch_allocations.service_layer.unit_of_work import (
+    ConcurrentUpdateError,
+    SqlAlchemyUnitOfWork,
+)
 
 # Helper Functions and Classes
 # ----------------------------
@@ -98,53 +93,135 @@ def test_rolls_back_on_error(session_factory):
     assert rows == []
 
 
-def try_to_allocate(orderid, sku, exceptions):
-    line = OrderLine(orderid, sku, 10)
-    try:
-        with SqlAlchemyUnitOfWork() as uow:
-            product = uow.products.get(sku=sku)
-            product.allocate(line)
-            time.sleep(0.2)
-            uow.commit()
-    except Exception as e:
-        print(traceback.format_exc())
-        exceptions.append(e)
-
-
-# def test_concurrent_updates_to_version_are_not_allowed(postgres_session_factory):
-#     sku, batch = random_sku(), random_batchref(1)
-#     session = postgres_session_factory()
-#     insert_batch(session, batch, sku, 100, eta=None, product_version=1)
-#     session.commit()
-
-#     order1, order2 = random_orderid(), random_orderid()
-#     exceptions = []  # type: List[Exception]
-#     try_to_allocate_order1 = lambda: try_to_allocate(order1, sku, exceptions)
-#     try_to_allocate_order2 = lambda: try_to_allocate(order2, sku, exceptions)
-#     thread1 = threading.Thread(target=try_to_allocate_order1)
-#     thread2 = threading.Thread(target=try_to_allocate_order2)
-#     thread1.start()
-#     thread2.start()
-#     thread1.join()
-#     thread2.join()
-
-#     [[version]] = session.execute(
-#         text("SELECT version_number FROM products WHERE sku=:sku"),
-#         dict(sku=sku),
-#     )
-#     assert version == 2
-#     [exception] = exceptions
-#     assert "could not serialize access due to concurrent update" in str(exception)
-
-#     orders = session.execute(
-#         text(
-#             "SELECT orderid FROM allocations"
-#             " JOIN batches ON allocations.batch_id = batches.id"
-#             " JOIN order_lines ON allocations.orderline_id = order_lines.id"
-#             " WHERE order_lines.sku=:sku"
-#         ),
-#         dict(sku=sku),
-#     )
-#     assert orders.rowcount == 1
-#     with SqlAlchemyUnitOfWork() as uow:
-#         uow.session.execute("select 1")
+def test_rolled_back_allocation_is_not_counted(session_factory):
+    session = session_factory()
+    insert_batch(session, "batch1", "TINY-LADDER", 100, None)
+    session.commit()
+
+    uow = SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        product = uow.products.get(sku="TINY-LADDER")
+        product.allocate(OrderLine("o1", "TINY-LADDER", 10))
+        [batch] = product.batches
+        assert batch.available_quantity == 90
+        uow.rollback()
+        assert batch.available_quantity == 100
+
+
+def test_allocate_batch_commits_each_sku(session_factory):
+    session = session_factory()
+    insert_batch(session, "batch1", "ROUND-MIRROR", 10, None)
+    insert_batch(session, "batch2", "SQUARE-MIRROR", 10, None)
+    session.commit()
+
+    lines = [("o1", "ROUND-MIRROR", 5), ("o2", "SQUARE-MIRROR", 5)]
+    lines += [("o3", "ROUND-MIRROR", 6)]
+    batchrefs = allocate_batch(lines, SqlAlchemyUnitOfWork(session_factory))
+
+    assert batchrefs == ["batch1", "batch2", None]
+    assert get_allocated_batch_ref(session, "o1", "ROUND-MIRROR") == "batch1"
+    assert get_allocated_batch_ref(session, "o2", "SQUARE-MIRROR") == "batch2"
+
+
+def insert_allocated_lines(session, batch_ref, sku, count):
+    [[batch_id]] = session.execute(
+        text("SELECT id FROM batch_stock WHERE reference=:ref"), dict(ref=batch_ref)
+    )
+    for i in range(count):
+        [[orderline_id]] = session.execute(
+            text(
+                "INSERT INTO order_lines (orderid, sku, qty)"
+                " VALUES (:orderid, :sku, 1) RETURNING id"
+            ),
+            dict(orderid=f"old-order{i}", sku=sku),
+        )
+        session.execute(
+            text("INSERT INTO allocations (orderline_id, batch_id) VALUES (:ol, :b)"),
+            dict(ol=orderline_id, b=batch_id),
+        )
+
+
+def loaded_order_lines(session):
+    return [obj for obj in session.identity_map.values() if isinstance(obj, OrderLine)]
+
+
+def test_aggregate_mode_allocates_without_loading_allocated_lines(
+    aggregate_session_factory,
+):
+    session = aggregate_session_factory()
+    insert_batch(session, "batch1", "GRAND-PIANO", 100, None)
+    insert_allocated_lines(session, "batch1", "GRAND-PIANO", 50)
+    session.commit()
+
+    uow = SqlAlchemyUnitOfWork(aggregate_session_factory)
+    with uow:
+        product = uow.products.get(sku="GRAND-PIANO")
+        assert product.batches[0].available_quantity == 50
+        assert product.allocate(OrderLine("o1", "GRAND-PIANO", 10)) == "batch1"
+        assert len(loaded_order_lines(uow.session)) <= 1
+        uow.commit()
+
+    assert get_allocated_batch_ref(session, "o1", "GRAND-PIANO") == "batch1"
+    with uow:
+        [batch] = uow.products.get(sku="GRAND-PIANO").batches
+        assert batch.allocated_quantity == 60
+
+
+def test_aggregate_mode_deallocates_and_stays_idempotent(aggregate_session_factory):
+    session = aggregate_session_factory()
+    insert_batch(session, "batch1", "GRAND-PIANO", 100, None)
+    session.commit()
+    line = OrderLine("o1", "GRAND-PIANO", 10)
+
+    uow = SqlAlchemyUnitOfWork(aggregate_session_factory)
+    with uow:
+        [batch] = uow.products.get(sku="GRAND-PIANO").batches
+        batch.allocate(line)
+        batch.allocate(OrderLine("o1", "GRAND-PIANO", 10))
+        uow.commit()
+    with uow:
+        [batch] = uow.products.get(sku="GRAND-PIANO").batches
+        assert batch.allocated_quantity == 10
+        batch.deallocate(OrderLine("o1", "GRAND-PIANO", 10))
+        uow.commit()
+    with uow:
+        [batch] = uow.products.get(sku="GRAND-PIANO").batches
+        assert batch.allocated_quantity == 0
+
+
+def test_aggregate_mode_handles_new_batches(aggregate_session_factory):
+    uow = SqlAlchemyUnitOfWork(aggregate_session_factory)
+    with uow:
+        product = Product("GRAND-PIANO", batches=[])
+        uow.products.add(product)
+        product.add_batch(Batch("batch1", "GRAND-PIANO", 100, eta=None))
+        assert product.allocate(OrderLine("o1", "GRAND-PIANO", 10)) == "batch1"
+        uow.commit()
+    with uow:
+        [batch] = uow.products.get(sku="GRAND-PIANO").batches
+        assert batch.allocated_quantity == 10
+
+
+def test_concurrent_updates_to_version_are_not_allowed(file_session_factory):
+    session = file_session_factory()
+    insert_batch(session, "batch1", "HOT-GADGET", 100, None, product_version=1)
+    session.commit()
+
+    first, second = (SqlAlchemyUnitOfWork(file_session_factory) for _ in range(2))
+    with first, second:
+        first.products.get(sku="HOT-GADGET").allocate(OrderLine("o1", "HOT-GADGET", 10))
+        second.products.get(sku="HOT-GADGET").allocate(
+            OrderLine("o2", "HOT-GADGET", 10)
+        )
+        first.commit()
+        with pytest.raises(ConcurrentUpdateError):
+            second.commit()
+
+    [[version]] = session.execute(
+        text("SELECT version_number FROM products WHERE sku=:sku"),
+        dict(sku="HOT-GADGET"),
+    )
+    assert version == 2
+    assert get_allocated_batch_ref(session, "o1", "HOT-GADGET") == "batch1"
+    [[count]] = session.execute(text("SELECT count(*) FROM allocations"))
+    assert count == 1
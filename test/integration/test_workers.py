@@ -0,0 +1,80 @@
+"""
+Tests the SKU-partitioned allocation worker processes
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import os
+
+import pytest
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.adapters.memory_store import ProductStore
+from batch_allocations.service_layer.services import InvalidSku
+from batch_allocations.service_layer.workers import AllocationWorkers
+from test.random_refs import random_batchref, random_orderid, random_sku
+
+# Fixture Definitions
+# -------------------
+
+
+@pytest.fixture
+def workers_dir(tmp_path):
+    return str(tmp_path / "workers")
+
+
+@pytest.fixture
+def pool(workers_dir):
+    with AllocationWorkers(workers_dir, workers=2, fsync=False) as pool:
+        yield pool
+
+
+# Test Functions
+# --------------
+
+
+def test_workers_allocate_and_reject_unknown_skus(pool):
+    sku, batchref = random_sku(), random_batchref(1)
+    pool.add_batch(batchref, sku, 10, None)
+
+    assert pool.allocate(random_orderid(), sku, 4) == batchref
+    assert pool.allocate(random_orderid(), sku, 7) is None  # Out of stock
+    with pytest.raises(InvalidSku):
+        pool.allocate(random_orderid(), "NO-SUCH-SKU", 1)
+
+
+def test_each_sku_is_kept_by_the_worker_that_owns_it(pool, workers_dir):
+    skus = [f"{random_sku()}-{n}" for n in range(20)]
+    futures = [pool.submit("add_batch", sku, "batch1", sku, 10, None) for sku in skus]
+    for future in futures:
+        future.result()
+    pool.stop()
+
+    for n in range(pool.workers):
+        store = ProductStore(os.path.join(workers_dir, f"worker-{n}"))
+        try:
+            owned = {sku for sku in skus if pool.owner(sku) == n}
+            assert {sku for sku in skus if store.get(sku) is not None} == owned
+            assert owned  # Both workers got some
+        finally:
+            store.close()
+
+
+def test_workers_recover_their_products_on_restart(pool, workers_dir):
+    sku, batchref = random_sku(), random_batchref(1)
+    pool.add_batch(batchref, sku, 10, None)
+    pool.allocate(random_orderid(), sku, 6)
+    pool.stop()
+
+    with AllocationWorkers(workers_dir, workers=2) as restarted:
+        assert restarted.allocate(random_orderid(), sku, 6) is None
+        assert restarted.allocate(random_orderid(), sku, 4) == batchref
+
+
+def test_a_directory_is_partitioned_for_one_number_of_workers(pool, workers_dir):
+    pool.stop()
+
+    with pytest.raises(ValueError, match="partitioned for 2 workers"):
+        AllocationWorkers(workers_dir, workers=3).start()
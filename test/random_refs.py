@@ -8,7 +8,7 @@ Helper function to generate fake information
 from faker import Faker
 import faker_commerce
 
-import random
+import uuid
 
 import requests
 
@@ -37,14 +37,17 @@ def random_sku():
     return f"{adj}-{obj}".upper()
 
 
+def random_suffix():
+    # Batch references are unique in the database, and the e2e tests share one database
+    return uuid.uuid4().hex[:6]
+
+
 def random_orderid():
-    random_number = str(random.randint(100, 999))
-    return f"order-{random_number}"
+    return f"order-{random_suffix()}"
 
 
 def random_batchref(num):
-    random_number = str(random.randint(100, 999)) + str(num)
-    return f"batch-{random_number}"
+    return f"batch-{random_suffix()}{num}"
 
 
 def post_to_add_batch(ref, sku, qty, eta):
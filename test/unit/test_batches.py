@@ -70,3 +70,20 @@ def test_allocation_is_idempotent():
     batch.allocate(line)
     batch.allocate(line)
     assert batch.available_quantity == 18
+
+
+def test_deallocating_restores_the_available_quantity():
+    batch, line = make_batch_and_line("ORNATE-CANDLE", 20, 2)
+    batch.allocate(line)
+    batch.deallocate(line)
+    assert batch.allocated_quantity == 0
+    assert batch.available_quantity == 20
+
+
+def test_allocated_quantity_is_rebuilt_when_unknown():
+    # This is the state the orm leaves a Batch in right after loading it
+    batch, line = make_batch_and_line("SLEEK-STOOL", 20, 5)
+    batch._allocations.add(line)
+    batch._allocated_quantity = None
+    assert batch.allocated_quantity == 5
+    assert batch.available_quantity == 15
@@ -0,0 +1,72 @@
+"""
+Tests the ProductCache bookkeeping: LRU order, limits and statistics
+"""
+
+# Boilerplate Modules
+# -------------------
+
+# Domain Model Modules
+# --------------------
+
+from batch_allocations.adapters.cache import ProductCache
+from batch_allocations.domain.model import Batch, OrderLine, Product
+
+# Helper Functions and Classes
+# ----------------------------
+
+
+def make_product(sku, batch_count=1, version_number=1):
+    batches = [Batch(f"{sku}-b{i}", sku, 10, None) for i in range(batch_count)]
+    return Product(sku, batches, version_number=version_number)
+
+
+# Test Functions
+# --------------
+
+
+def test_hits_only_when_the_version_matches():
+    cache = ProductCache()
+    product = make_product("PLAIN-MUG", version_number=3)
+    cache.put(product)
+
+    assert cache.get("PLAIN-MUG", lambda: 3) is product
+    assert cache.get("PLAIN-MUG", lambda: 4) is None  # Stale: dropped
+    assert cache.get("PLAIN-MUG", lambda: 4) is None
+    assert cache.stats() == dict(
+        entries=0, rows=0, hits=1, misses=2, stale=1, evictions=0
+    )
+
+
+def test_does_not_check_the_version_without_an_entry():
+    def unreachable():
+        raise AssertionError("queried the version")
+
+    assert ProductCache().get("PLAIN-MUG", unreachable) is None
+
+
+def test_evicts_the_least_recently_used_product():
+    cache = ProductCache(max_entries=2)
+    for sku in ("RED-MUG", "BLUE-MUG"):
+        cache.put(make_product(sku))
+    cache.get("RED-MUG", lambda: 1)
+
+    cache.put(make_product("GREEN-MUG"))
+
+    assert "RED-MUG" in cache and "GREEN-MUG" in cache
+    assert "BLUE-MUG" not in cache
+    assert cache.evictions == 1
+
+
+def test_row_limit_counts_batches_and_allocations():
+    cache = ProductCache(max_rows=10)
+    busy = make_product("BUSY-MUG", batch_count=2)
+    busy.allocate(OrderLine("o1", "BUSY-MUG", 1))
+    cache.put(busy)  # 1 product + 2 batches + 1 allocation
+    assert cache.rows == 4
+
+    cache.put(make_product("HUGE-MUG", batch_count=10))  # Heavier than the whole cache
+    cache.put(make_product("SMALL-MUG", batch_count=6))  # 7 rows: BUSY-MUG must go
+
+    assert "HUGE-MUG" not in cache
+    assert list(cache._entries) == ["SMALL-MUG"]
+    assert cache.rows == 7
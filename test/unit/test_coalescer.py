@@ -0,0 +1,111 @@
+"""
+Tests the per-SKU micro-batching of allocate requests
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import threading
+import time
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.adapters import metrics
+from batch_allocations.service_layer.coalescer import AllocationCoalescer
+from batch_allocations.service_layer.services import InvalidSku, add_batch
+from test.unit.test_services import FakeUnitOfWork
+
+# Helper Functions and Classes
+# ----------------------------
+
+
+class CountingUnitOfWork(FakeUnitOfWork):
+    def __init__(self):
+        super().__init__()
+        self.commits = 0
+
+    def _commit(self):
+        super()._commit()
+        self.commits += 1
+
+
+class Interrupted(BaseException):
+    """Like KeyboardInterrupt, without interrupting the test run"""
+
+
+def allocate_in_threads(coalescer, requests):
+    """Starts the requests in order, each once the previous one joined its group"""
+    results = [None] * len(requests)
+
+    def run(n, request):
+        try:
+            results[n] = coalescer.allocate(*request)
+        except BaseException as e:
+            results[n] = e
+
+    threads = []
+    for n, request in enumerate(requests):
+        threads.append(threading.Thread(target=run, args=(n, request)))
+        threads[-1].start()
+        while n == 0 and not coalescer._groups:  # The leader must come first
+            time.sleep(0.001)
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+# Test Functions
+# --------------
+
+
+def test_concurrent_requests_share_one_unit_of_work_in_arrival_order():
+    uow = CountingUnitOfWork()
+    add_batch("b1", "HOT-LAMP", 10, None, uow)
+    coalescer = AllocationCoalescer(lambda: uow, window=5, max_batch=2)
+
+    calls = metrics.service_latency.count("allocate_sku")
+    requests = metrics.service_latency.count("allocate")
+    results = allocate_in_threads(
+        coalescer, [("o1", "HOT-LAMP", 8), ("o2", "HOT-LAMP", 8)]
+    )
+
+    assert results == ["b1", None]  # First come, first served
+    assert uow.commits == 2  # add_batch, then one for both requests
+    assert metrics.service_latency.count("allocate_sku") == calls + 1
+    assert metrics.service_latency.count("allocate") == requests + 2
+    assert (coalescer.batches, coalescer.coalesced) == (1, 1)
+
+
+def test_a_lone_request_waits_for_the_window_only():
+    uow = FakeUnitOfWork()
+    add_batch("b1", "QUIET-LAMP", 10, None, uow)
+    coalescer = AllocationCoalescer(lambda: uow, window=0.01)
+
+    start = time.perf_counter()
+    assert coalescer.allocate("o1", "QUIET-LAMP", 1) == "b1"
+    assert time.perf_counter() - start < 1
+    assert coalescer._groups == {}
+
+
+def test_invalid_sku_is_raised_to_every_caller():
+    coalescer = AllocationCoalescer(FakeUnitOfWork, window=5, max_batch=2)
+
+    results = allocate_in_threads(
+        coalescer, [("o1", "NO-SUCH-LAMP", 1), ("o2", "NO-SUCH-LAMP", 1)]
+    )
+
+    assert all(isinstance(result, InvalidSku) for result in results)
+
+
+def test_followers_do_not_hang_when_the_leader_is_interrupted():
+    def interrupted():
+        raise Interrupted()
+
+    coalescer = AllocationCoalescer(interrupted, window=5, max_batch=2)
+
+    results = allocate_in_threads(
+        coalescer, [("o1", "HOT-LAMP", 1), ("o2", "HOT-LAMP", 1)]
+    )
+
+    assert all(isinstance(result, Interrupted) for result in results)
+    assert coalescer._groups == {}
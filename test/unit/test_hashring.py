@@ -0,0 +1,52 @@
+"""
+Tests the consistent hashing of SKUs onto nodes
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import pytest
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.adapters.hashring import HashRing
+
+# Constants
+# ---------
+
+SKUS = [f"SKU-{n}" for n in range(10_000)]
+
+# Test Functions
+# --------------
+
+
+def test_a_sku_always_goes_to_the_same_node():
+    ring = HashRing(["a", "b", "c"])
+
+    assert [ring.node_for(sku) for sku in SKUS[:100]] == [
+        HashRing(["c", "a", "b"]).node_for(sku) for sku in SKUS[:100]
+    ]
+
+
+def test_skus_are_spread_evenly():
+    spread = HashRing([f"node-{n}" for n in range(4)]).spread(SKUS)
+
+    assert sum(spread.values()) == len(SKUS)
+    assert all(count > len(SKUS) / 4 * 0.75 for count in spread.values())
+
+
+def test_adding_a_node_only_moves_the_skus_it_takes():
+    before = HashRing([f"node-{n}" for n in range(4)])
+    after = HashRing([f"node-{n}" for n in range(5)])
+
+    moved = before.moved(after, SKUS)
+
+    assert {after.node_for(sku) for sku in moved} == {"node-4"}
+    assert len(moved) < len(SKUS) / 5 * 1.25
+
+
+def test_node_names_must_be_unique():
+    with pytest.raises(ValueError):
+        HashRing(["a", "a"])
+    with pytest.raises(ValueError):
+        HashRing([])
@@ -0,0 +1,188 @@
+"""
+Tests the message bus, in particular asynchronous dispatch and coalescing
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import threading
+import time
+from dataclasses import dataclass
+
+import pytest
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.domain.events import Event, OutOfStock
+from batch_allocations.service_layer import messagebus
+
+# Helper Functions and Classes
+# ----------------------------
+
+
+@dataclass(frozen=True)
+class Pinged(Event):
+    n: int
+
+
+@pytest.fixture
+def handled(monkeypatch):
+    """Registers a Pinged handler that records (event, thread name) pairs"""
+    calls = []
+
+    def record(event):
+        calls.append((event, threading.current_thread().name))
+
+    monkeypatch.setitem(messagebus.HANDLERS, Pinged, [record])
+    yield calls
+    messagebus.stop_async_dispatch(drain=False)
+
+
+# Test Functions
+# --------------
+
+
+def test_dispatch_is_synchronous_by_default(handled):
+    messagebus.dispatch(Pinged(1))
+    assert handled == [(Pinged(1), threading.current_thread().name)]
+
+
+def test_async_dispatch_handles_events_on_worker_threads(handled):
+    messagebus.start_async_dispatch(workers=2)
+    for n in range(10):
+        messagebus.dispatch(Pinged(n))
+    messagebus.stop_async_dispatch(drain=True, timeout=5)
+
+    assert sorted(event.n for event, _ in handled) == list(range(10))
+    assert all(thread.startswith("messagebus-handler") for _, thread in handled)
+
+
+def test_a_failing_handler_does_not_stop_the_others(handled, monkeypatch):
+    def explode(event):
+        raise RuntimeError("smtp down")
+
+    monkeypatch.setitem(messagebus.HANDLERS, Pinged, [explode, handled.append])
+    dispatcher = messagebus.start_async_dispatch(workers=1)
+    messagebus.dispatch(Pinged(1))
+    messagebus.stop_async_dispatch(drain=True, timeout=5)
+
+    assert handled == [Pinged(1)]
+    assert dispatcher.errors == 1
+
+
+def test_slow_handlers_time_out(handled, monkeypatch):
+    release = threading.Event()
+    monkeypatch.setitem(
+        messagebus.HANDLERS, Pinged, [lambda event: release.wait(), handled.append]
+    )
+    dispatcher = messagebus.start_async_dispatch(workers=2, handler_timeout=0.05)
+    messagebus.dispatch(Pinged(1))
+    messagebus.stop_async_dispatch(drain=True, timeout=5)
+    release.set()
+
+    assert dispatcher.timeouts == 1
+    assert handled == [Pinged(1)]
+
+
+def test_full_queue_applies_backpressure_without_dropping_events(handled, monkeypatch):
+    release = threading.Event()
+
+    def blocked(event):
+        release.wait()
+        handled.append(event)
+
+    monkeypatch.setitem(messagebus.HANDLERS, Pinged, [blocked])
+    dispatcher = messagebus.start_async_dispatch(
+        workers=1, queue_size=1, put_timeout=0.01, handler_timeout=5
+    )
+    messagebus.dispatch(Pinged(1))  # Picked up by the worker, which then blocks
+    time.sleep(0.05)
+    messagebus.dispatch(Pinged(2))  # Waits in the queue
+    threading.Timer(0.1, release.set).start()
+    messagebus.dispatch(Pinged(3))  # Queue full: handled in this thread
+    messagebus.stop_async_dispatch(drain=True, timeout=5)
+
+    assert dispatcher.handled_inline == 1
+    assert sorted(event.n for event in handled) == [1, 2, 3]
+
+
+def test_shutdown_returns_in_time_with_a_full_queue_and_stuck_workers(
+    handled, monkeypatch
+):
+    release = threading.Event()
+    monkeypatch.setitem(messagebus.HANDLERS, Pinged, [lambda event: release.wait()])
+    messagebus.start_async_dispatch(workers=1, queue_size=1, handler_timeout=5)
+    messagebus.dispatch(Pinged(1))  # Picked up by the worker, which then blocks
+    time.sleep(0.05)
+    messagebus.dispatch(Pinged(2))  # Fills the queue
+
+    started = time.monotonic()
+    messagebus.stop_async_dispatch(drain=True, timeout=0.2)
+    release.set()
+
+    assert time.monotonic() - started < 1
+
+
+def test_hung_handlers_are_counted_until_they_return(handled, monkeypatch):
+    release = threading.Event()
+    monkeypatch.setitem(messagebus.HANDLERS, Pinged, [lambda event: release.wait()])
+    dispatcher = messagebus.start_async_dispatch(
+        workers=1, handler_threads=3, handler_timeout=0.01
+    )
+    for n in range(2):
+        messagebus.dispatch(Pinged(n))
+    messagebus.stop_async_dispatch(drain=True, timeout=5)
+
+    assert (dispatcher.handler_threads, dispatcher.hung) == (3, 2)
+    release.set()
+    time.sleep(0.05)
+    assert dispatcher.hung == 0
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_publish_handles_identical_events_once(handled):
+    messagebus.publish([Pinged(1), Pinged(2), Pinged(1), Pinged(1)])
+
+    assert [event for event, _ in handled] == [Pinged(1), Pinged(2)]
+    assert messagebus.coalescer.deduplicated == 2
+
+
+def test_out_of_stock_is_debounced_per_sku(monkeypatch):
+    notified = []
+    monkeypatch.setitem(messagebus.HANDLERS, OutOfStock, [notified.append])
+    clock = FakeClock()
+    coalescer = messagebus.configure_coalescing(window=60, clock=clock)
+
+    for _ in range(3):
+        messagebus.publish([OutOfStock("SOLD-OUT-LAMP")])
+    messagebus.publish([OutOfStock("OTHER-LAMP")])
+    clock.now = 61
+    messagebus.publish([OutOfStock("SOLD-OUT-LAMP")])
+
+    assert notified == [
+        OutOfStock("SOLD-OUT-LAMP"),
+        OutOfStock("OTHER-LAMP"),
+        OutOfStock("SOLD-OUT-LAMP"),
+    ]
+    assert coalescer.debounced_count == 2
+    assert coalescer.suppressed == 2
+
+
+def test_other_events_and_a_zero_window_are_not_debounced(handled, monkeypatch):
+    notified = []
+    monkeypatch.setitem(messagebus.HANDLERS, OutOfStock, [notified.append])
+    messagebus.configure_coalescing(window=0)
+
+    for _ in range(2):
+        messagebus.publish([Pinged(1)])
+        messagebus.publish([OutOfStock("SOLD-OUT-LAMP")])
+
+    assert len(handled) == 2
+    assert len(notified) == 2
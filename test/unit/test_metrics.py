@@ -0,0 +1,104 @@
+"""
+Tests the per thread sharded collectors and their Prometheus exposition
+"""
+
+# Boilerplate Modules
+# -------------------
+
+import threading
+
+# Domain Model Modules
+# --------------------
+from batch_allocations.adapters import metrics
+from batch_allocations.adapters.metrics import Counter, Gauge, Histogram, Registry
+from batch_allocations.service_layer import services
+from test.unit.test_services import FakeUnitOfWork
+
+# Helper Functions and Classes
+# ----------------------------
+
+
+def run_threads(count, target):
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+# Test Functions
+# --------------
+
+
+def test_counter_adds_up_every_thread():
+    counter = Counter("things_total", "Things", ["kind"])
+
+    def work():
+        for _ in range(1000):
+            counter.inc("a")
+        counter.inc("b", amount=2)
+
+    run_threads(8, work)
+
+    assert counter.value("a") == 8000
+    assert counter.value("b") == 16
+
+
+def test_finished_threads_are_folded_into_the_totals(monkeypatch):
+    monkeypatch.setattr(metrics, "MAX_SHARDS", 4)
+    counter = Counter("things_total", "Things")
+
+    for _ in range(20):  # One shard per thread
+        run_threads(1, counter.inc)
+
+    assert len(counter._shards) <= 4
+    assert counter.value() == 20
+
+
+def test_histogram_exposition():
+    histogram = Histogram("work_seconds", "Work", ["op"], buckets=[0.1, 1.0])
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, "x")
+    registry = Registry()
+    registry.register(histogram)
+
+    assert registry.render().splitlines() == [
+        "# HELP work_seconds Work",
+        "# TYPE work_seconds histogram",
+        'work_seconds_bucket{op="x",le="0.1"} 2',
+        'work_seconds_bucket{op="x",le="1.0"} 3',
+        'work_seconds_bucket{op="x",le="+Inf"} 4',
+        'work_seconds_sum{op="x"} 3.65',
+        'work_seconds_count{op="x"} 4',
+    ]
+
+
+def test_label_values_are_escaped():
+    counter = Counter("things_total", "Things", ["kind"])
+    counter.inc('say "hi"\n')
+
+    assert counter.render()[-1] == 'things_total{kind="say \\"hi\\"\\n"} 1'
+
+
+def test_gauge_is_read_when_scraped():
+    depth = [3]
+    gauge = Gauge("depth", "Depth", lambda: depth[0])
+    depth[0] = 5
+
+    assert gauge.render()[-1] == "depth 5"
+
+
+def test_services_record_latency_and_outcomes():
+    allocated = metrics.allocations.value(services.ALLOCATED)
+    out_of_stock = metrics.allocations.value(services.OUT_OF_STOCK)
+    calls = metrics.service_latency.count("allocate")
+    uow = FakeUnitOfWork()
+    services.add_batch("b1", "CRUNCHY-ARMCHAIR", 10, None, uow)
+
+    services.allocate("o1", "CRUNCHY-ARMCHAIR", 10, uow)
+    services.allocate("o2", "CRUNCHY-ARMCHAIR", 1, uow)
+
+    assert metrics.allocations.value(services.ALLOCATED) == allocated + 1
+    assert metrics.allocations.value(services.OUT_OF_STOCK) == out_of_stock + 1
+    assert metrics.service_latency.count("allocate") == calls + 2
+    assert "messagebus_queue_depth 0" in metrics.registry.render()
@@ -5,14 +5,15 @@ Testing Domain Model in v1.2.0
 # Boilerplate Modules
 # -------------------
 
+import random
 from datetime import date, timedelta
+
 import pytest
 
 # Domain Model Modules
 # --------------------
-
-from batch_allocations.domain.model import Product, OrderLine, Batch
 from batch_allocations.domain.events import OutOfStock
+from batch_allocations.domain.model import Batch, BatchIndex, OrderLine, Product
 
 today = date.today()
 tomorrow = today + timedelta(days=1)
@@ -81,3 +82,98 @@ def test_increments_version_number():
     product.version_number = 7
     product.allocate(line)
     assert product.version_number == 8
+
+
+def test_skips_sold_out_batches():
+    earliest = Batch("speedy-batch", "SHINY-KETTLE", 10, eta=today)
+    medium = Batch("normal-batch", "SHINY-KETTLE", 100, eta=tomorrow)
+    product = Product(sku="SHINY-KETTLE", batches=[medium, earliest])
+
+    assert product.allocate(OrderLine("order1", "SHINY-KETTLE", 10)) == "speedy-batch"
+    assert product.allocate(OrderLine("order2", "SHINY-KETTLE", 10)) == "normal-batch"
+
+
+def test_added_batches_take_their_place_in_eta_order():
+    product = Product(sku="PLUSH-OTTOMAN", batches=[])
+    product.add_batch(Batch("slow-batch", "PLUSH-OTTOMAN", 100, eta=later))
+    product.add_batch(Batch("speedy-batch", "PLUSH-OTTOMAN", 100, eta=today))
+    product.add_batch(Batch("in-stock-batch", "PLUSH-OTTOMAN", 100, eta=None))
+
+    assert (
+        product.allocate(OrderLine("order1", "PLUSH-OTTOMAN", 10)) == "in-stock-batch"
+    )
+
+
+def test_uses_a_sold_out_batch_again_once_it_has_stock():
+    batch = Batch("batch1", "WOBBLY-TABLE", 10, eta=today)
+    product = Product(sku="WOBBLY-TABLE", batches=[batch])
+    first_line = OrderLine("order1", "WOBBLY-TABLE", 10)
+    product.allocate(first_line)
+
+    batch.deallocate(first_line)
+
+    assert product.allocate(OrderLine("order2", "WOBBLY-TABLE", 5)) == "batch1"
+
+
+def test_deallocating_refreshes_only_the_index_holding_the_batch(monkeypatch):
+    batch = Batch("batch1", "WOBBLY-TABLE", 10, eta=today)
+    product = Product(sku="WOBBLY-TABLE", batches=[batch])
+    other = Product(sku="RETRO-CLOCK", batches=[Batch("b2", "RETRO-CLOCK", 10, None)])
+    line = OrderLine("order1", "WOBBLY-TABLE", 10)
+    product.allocate(line)
+    other.allocate(OrderLine("order2", "RETRO-CLOCK", 1))
+    rebuilds = []
+    monkeypatch.setattr(BatchIndex, "_rebuild", lambda index: rebuilds.append(index))
+
+    batch.deallocate(line)
+
+    assert other.allocate(OrderLine("order3", "RETRO-CLOCK", 9)) == "b2"
+    assert product.allocate(OrderLine("order4", "WOBBLY-TABLE", 10)) == "batch1"
+    assert rebuilds == []
+
+
+def test_allocate_many_allocates_in_arrival_order():
+    batch = Batch("batch1", "RUSTIC-BENCH", 10, eta=today)
+    product = Product(sku="RUSTIC-BENCH", batches=[batch])
+    lines = [
+        OrderLine("order1", "RUSTIC-BENCH", 6),
+        OrderLine("order2", "RUSTIC-BENCH", 6),
+        OrderLine("order3", "RUSTIC-BENCH", 4),
+    ]
+
+    assert product.allocate_many(lines) == ["batch1", None, "batch1"]
+
+
+def test_allocate_many_records_one_out_of_stock_event():
+    product = Product(sku="RUSTIC-BENCH", batches=[])
+    lines = [OrderLine(f"order{i}", "RUSTIC-BENCH", 1) for i in range(3)]
+
+    product.allocate_many(lines)
+
+    assert list(product.events) == [OutOfStock(sku="RUSTIC-BENCH")]
+
+
+def test_skips_batches_too_small_for_the_line():
+    small = [Batch(f"small{i}", "HEAVY-DESK", 5, eta=today) for i in range(50)]
+    big = Batch("big", "HEAVY-DESK", 50, eta=later)
+    product = Product(sku="HEAVY-DESK", batches=small + [big])
+
+    assert product.allocate(OrderLine("order1", "HEAVY-DESK", 20)) == "big"
+    assert product.allocate(OrderLine("order2", "HEAVY-DESK", 5)) == "small0"
+
+
+def test_allocates_like_sorting_the_batches_every_time():
+    rng = random.Random(42)
+    etas = [None, today, tomorrow, later]
+    product = Product(sku="LAMP", batches=[])
+    reference = []  # Same batches, allocated the way Product used to
+    for i in range(200):
+        ref, qty, eta = f"batch{i}", rng.randint(1, 30), rng.choice(etas)
+        product.add_batch(Batch(ref, "LAMP", qty, eta=eta))
+        reference.append(Batch(ref, "LAMP", qty, eta=eta))
+        line = OrderLine(f"order{i}", "LAMP", rng.randint(1, 40))
+        expected = next((b for b in sorted(reference) if b.can_allocate(line)), None)
+        if expected is not None:
+            expected.allocate(line)
+
+        assert product.allocate(line) == (expected and expected.reference)
@@ -13,8 +13,19 @@ from typing import Protocol
 
 from batch_allocations.adapters.repository import ProductRepositoryProtocol
 from batch_allocations.domain.model import OrderLine, Batch, Product
-from batch_allocations.service_layer.services import allocate, add_batch, InvalidSku
-from batch_allocations.service_layer.unit_of_work import UnitOfWorkProtocol
+from batch_allocations.domain.events import OutOfStock
+from batch_allocations.service_layer import messagebus, services
+from batch_allocations.service_layer.services import (
+    allocate,
+    allocate_batch,
+    allocate_stream,
+    add_batch,
+    InvalidSku,
+)
+from batch_allocations.service_layer.unit_of_work import (
+    ConcurrentUpdateError,
+    UnitOfWorkProtocol,
+)
 
 # Helper Functions and Classes
 # ----------------------------
@@ -74,6 +85,20 @@ class FakeUnitOfWork(UnitOfWorkProtocol):
         pass
 
 
+class ConflictingUnitOfWork(FakeUnitOfWork):
+    """Loses the optimistic concurrency race on its first `conflicts` commits"""
+
+    def __init__(self, conflicts):
+        super().__init__()
+        self.conflicts = conflicts
+
+    def _commit(self):
+        if self.conflicts:
+            self.conflicts -= 1
+            raise ConcurrentUpdateError("version_number moved")
+        super()._commit()
+
+
 # Test Functions
 # --------------
 
@@ -112,3 +137,157 @@ def test_allocate_commits():
     add_batch("b1", "OMINOUS-MIRROR", 100, None, uow)
     allocate("o1", "OMINOUS-MIRROR", 10, uow)
     assert uow.committed
+
+
+def test_allocate_batch_returns_one_result_per_line_in_order():
+    uow = FakeUnitOfWork()
+    add_batch("b1", "STURDY-SHELF", 10, None, uow)
+    add_batch("b2", "QUIET-FAN", 100, None, uow)
+    lines = [
+        ("o1", "STURDY-SHELF", 8),
+        ("o2", "QUIET-FAN", 5),
+        ("o3", "STURDY-SHELF", 8),
+        ("o4", "NONEXISTENTSKU", 1),
+    ]
+
+    assert allocate_batch(lines, uow) == ["b1", "b2", None, None]
+
+
+def test_allocate_stream_yields_one_result_per_record_in_order():
+    uow = FakeUnitOfWork()
+    add_batch("b1", "STURDY-SHELF", 10, None, uow)
+    records = [
+        dict(orderid="o1", sku="STURDY-SHELF", qty=8),
+        dict(orderid="o2", sku="NONEXISTENTSKU", qty=1),
+        dict(orderid="o3", sku="STURDY-SHELF"),
+        None,  # Not even JSON
+        dict(orderid="o5", sku="STURDY-SHELF", qty="8"),
+    ]
+
+    results = list(allocate_stream(iter(records), uow, chunk_size=2))
+
+    assert [(r["line"], r["status"]) for r in results] == [
+        (1, "allocated"),
+        (2, "invalid_sku"),
+        (3, "invalid"),
+        (4, "invalid"),
+        (5, "out_of_stock"),
+    ]
+    assert results[0]["batchref"] == "b1"
+    assert results[4] == dict(
+        line=5,
+        orderid="o5",
+        sku="STURDY-SHELF",
+        qty=8,
+        batchref=None,
+        status="out_of_stock",
+    )
+
+
+def test_allocate_stream_reads_one_chunk_ahead_at_most():
+    uow = FakeUnitOfWork()
+    add_batch("b1", "LONG-TABLE", 1000, None, uow)
+    read = []
+
+    def records():
+        for i in range(10):
+            read.append(i)
+            yield dict(orderid=f"o{i}", sku="LONG-TABLE", qty=1)
+
+    results = allocate_stream(records(), uow, chunk_size=3)
+    next(results)
+
+    assert read == [0, 1, 2]
+
+
+def test_allocate_stream_rejects_quantities_below_one():
+    uow = FakeUnitOfWork()
+    add_batch("b1", "STURDY-SHELF", 10, None, uow)
+    records = [
+        dict(orderid="o1", sku="STURDY-SHELF", qty=0),
+        dict(orderid="o2", sku="STURDY-SHELF", qty=-5),
+        dict(orderid="o3", sku="STURDY-SHELF", qty=1),
+    ]
+
+    results = list(allocate_stream(iter(records), uow))
+
+    assert [r["status"] for r in results] == ["invalid", "invalid", "allocated"]
+    assert "qty must be positive" in results[1]["error"]
+    assert uow.products.get("STURDY-SHELF").batches[0].available_quantity == 9
+
+
+def test_allocate_stream_reports_conflicts_per_sku(monkeypatch):
+    monkeypatch.setattr(services, "BACKOFF_SECONDS", 0)
+    uow = ConflictingUnitOfWork(conflicts=0)
+    add_batch("b1", "BUSY-KIOSK", 100, None, uow)
+    add_batch("b2", "QUIET-LAMP", 100, None, uow)
+    uow.conflicts = services.MAX_ATTEMPTS  # Every try for the first SKU
+    records = [
+        dict(orderid="o1", sku="BUSY-KIOSK", qty=1),
+        dict(orderid="o2", sku="QUIET-LAMP", qty=1),
+        dict(orderid="o3", sku="BUSY-KIOSK", qty=1),
+    ]
+
+    results = list(allocate_stream(iter(records), uow))
+
+    assert [(r["line"], r["status"]) for r in results] == [
+        (1, "conflict"),
+        (2, "allocated"),
+        (3, "conflict"),
+    ]
+    assert results[1]["batchref"] == "b2"
+
+
+def test_allocate_batch_publishes_one_out_of_stock_event_per_sku(monkeypatch):
+    handled = []
+    monkeypatch.setattr(messagebus, "dispatch", handled.append)
+    uow = FakeUnitOfWork()
+    add_batch("b1", "STURDY-SHELF", 1, None, uow)
+
+    allocate_batch([(f"o{i}", "STURDY-SHELF", 1) for i in range(5)], uow)
+
+    assert handled == [OutOfStock(sku="STURDY-SHELF")]
+
+
+def test_a_sellout_sends_one_notification_per_sku(monkeypatch):
+    handled = []
+    monkeypatch.setattr(messagebus, "dispatch", handled.append)
+    uow = FakeUnitOfWork()
+    add_batch("b1", "LAST-SOFA", 1, None, uow)
+
+    for i in range(5):
+        allocate(f"o{i}", "LAST-SOFA", 1, uow)
+
+    assert handled == [OutOfStock(sku="LAST-SOFA")]
+    assert messagebus.coalescer.debounced_count == 3
+
+
+def test_allocate_retries_after_a_concurrent_update(monkeypatch):
+    monkeypatch.setattr(services, "BACKOFF_SECONDS", 0)
+    uow = ConflictingUnitOfWork(conflicts=0)
+    add_batch("b1", "BUSY-KIOSK", 100, None, uow)
+    uow.conflicts = 2
+
+    assert allocate("o1", "BUSY-KIOSK", 10, uow) == "b1"
+    assert uow.committed
+
+
+def test_allocate_gives_up_after_max_attempts(monkeypatch):
+    monkeypatch.setattr(services, "BACKOFF_SECONDS", 0)
+    uow = ConflictingUnitOfWork(conflicts=0)
+    add_batch("b1", "BUSY-KIOSK", 100, None, uow)
+    uow.conflicts = services.MAX_ATTEMPTS
+
+    with pytest.raises(ConcurrentUpdateError):
+        allocate("o1", "BUSY-KIOSK", 10, uow)
+
+
+def test_retry_delay_backs_off_until_the_last_attempt(monkeypatch):
+    monkeypatch.setattr(services, "BACKOFF_SECONDS", 1)
+
+    delays = [
+        services.retry_delay(allocate, n) for n in range(1, services.MAX_ATTEMPTS)
+    ]
+
+    assert all(0.5 * 2**n <= delay <= 1.5 * 2**n for n, delay in enumerate(delays))
+    assert services.retry_delay(allocate, services.MAX_ATTEMPTS) is None